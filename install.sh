@@ -1,6 +1,6 @@
 #!/bin/bash
 
-## Updated: version-v1.03 03/05/17 
+## Updated: version-v1.04 18/10/26 
 
 printf "\nIn case of any issue at any point in PHASIS analyses, contact authors at:\n"
 # printf "Atul Kakrana: kakrana@udel.edu\n"
@@ -72,6 +72,48 @@ else
   rm ./phastrigs.py
 fi
 
+#### Compile phasbench #########
+
+if [ -d ./__pycache__ ]; then
+  rm -r __pycache__/ 
+fi
+
+if [ ! -f ./phasbench.py ]
+then
+  printf "phasbench source not found in current directory\n"
+  printf "Please check that you downloaded complete archive\n"
+  printf "Download complete package and rerun script\n\n"
+  exit 1
+else
+  python3 -m py_compile phasbench.py
+  cd __pycache__ && mv phasbench.*.pyc phasbench 
+  chmod u+x phasbench && cp phasbench ../
+  printf "Done:      phasbench\n"
+  cd ..
+  rm ./phasbench.py
+fi
+
+#### Compile phastpk - module imported by phasdetect and phasmerge #########
+
+if [ -d ./__pycache__ ]; then
+  rm -r __pycache__/ 
+fi
+
+if [ ! -f ./phastpk.py ]
+then
+  printf "phastpk source not found in current directory\n"
+  printf "Please check that you downloaded complete archive\n"
+  printf "Download complete package and rerun script\n\n"
+  exit 1
+else
+  python3 -m py_compile phastpk.py
+  cd __pycache__ && mv phastpk.*.pyc phastpk.pyc 
+  cp phastpk.pyc ../
+  printf "Done:      phastpk\n"
+  cd ..
+  rm ./phastpk.py
+fi
+
 #### Place core scripts ######
 
 if [ -d ~/phasis ]
@@ -144,4 +186,7 @@ exit 1
 ## V1.0 -> v1.01
 ## Edited names of phasis-core scripts
 ## v1.01 -> v1.02
-## Added sPARTA script
\ No newline at end of file
+## Added sPARTA script
+## v1.03 -> v1.04
+## Compile phasbench, benchmark of phasdetect stages
+## Compile phastpk module to phastpk.pyc next to phasdetect and phasmerge, these import it
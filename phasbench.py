@@ -0,0 +1,270 @@
+#!/usr/local/bin/python3
+
+## phasbench    : benchmark of phasdetect stages on synthetic genome and libraries
+## Updated      : version-v1.00 18/10/26
+## author       : kakrana@udel.edu
+
+## Copyright (c): 2016, by University of Delaware
+##              Contributor : Atul Kakrana
+##              Affilation  : Meyers Lab (Donald Danforth Plant Science Center, St. Louis, MO)
+##              License copy: Included and found at https://opensource.org/licenses/Artistic-2.0
+
+#### FUNCTIONS ###########################################
+
+import os,sys,time,shutil,subprocess,datetime,collections,json,random,argparse
+import importlib.util
+from importlib.machinery import SourceFileLoader,SourcelessFileLoader
+
+#### USER SETTINGS ########################################
+bench_genome    = 10                                ## Synthetic genome size (Mb)
+bench_depth     = 1000000                           ## Reads in each synthetic library
+bench_libs      = 2                                 ## Number of synthetic libraries
+bench_loci      = 100                               ## Planted phased loci for each of 21 and 24-nt
+anc_folder      = "ancillary"                       ## Folder with stored baseline (bench_baseline.json)
+#############################################################
+#############################################################
+
+parser      = argparse.ArgumentParser()
+parser.add_argument('--save', action='store_true', default=False, help=
+    'Store this benchmark as the new baseline')
+
+args = parser.parse_args()
+
+def phasLoad():
+    '''
+    Loads phasdetect from folder of this script - source, or sourceless one made by install.sh.
+    phasdetect reads its arguments at import, so these are set to numpy engine first
+    '''
+    adir        = os.path.dirname(os.path.abspath(__file__))
+    sys.argv    = ["phasdetect","--engine","numpy"]
+    for aname,aloader in (("phasdetect.py",SourceFileLoader),("phasdetect",SourcelessFileLoader)):
+        apath   = os.path.join(adir,aname)
+        if os.path.isfile(apath):
+            aspec = importlib.util.spec_from_loader("phasdetect",aloader("phasdetect",apath))
+            pd    = importlib.util.module_from_spec(aspec)
+            sys.modules["phasdetect"] = pd ## Pool workers find stage functions by module name
+            aspec.loader.exec_module(pd)
+            return pd
+
+    print("** phasdetect not found in %s - keep phasbench in same folder as phasdetect" % (adir))
+    sys.exit()
+
+def phasBench(pd):
+    '''
+    Benchmark of phasdetect stages on synthetic data - genome with planted 21 and 24-nt phased
+    loci, and FASTA libraries with background noise. Stages are timed one after other on
+    the core pool, alignments are scored by in-process scorer which writes same results as
+    phasis-core. Timings are written as JSON and compared against stored baseline
+    '''
+    print ("\n#### Fn: Benchmark ##########################")
+
+    if not hasattr(pd,'np'):
+        print("** numpy is required for phasbench, install it with: pip3 install numpy")
+        sys.exit()
+    if not shutil.which("bowtie") or not shutil.which("bowtie-build"):
+        print("** 'bowtie' and 'bowtie-build' are required for phasbench, is Bowtie installed and in PATH?")
+        sys.exit()
+
+    settingsD   = {"genome_mb":bench_genome,"depth":bench_depth,"libs":bench_libs,"loci":bench_loci,"cores":int(pd.nproc)}
+    ancDir      = os.path.abspath(anc_folder)
+    baseFile    = "%s/bench_baseline.json" % (ancDir)
+    outFile     = os.path.abspath("phasbench_%s.json" % (datetime.datetime.now().strftime("%m_%d_%H_%M")))
+    benchDir    = os.path.abspath("phasbench")
+    shutil.rmtree(benchDir,ignore_errors=True)
+    os.mkdir(benchDir)
+    os.chdir(benchDir) ## Cleaned reference is written to working directory
+
+    ## Run settings are read by pipeline stages from phasdetect
+    pd.runType      = 'G'
+    pd.phase        = [21,24]
+    pd.minDepth     = 3
+    pd.libFormat    = 'F'
+    pd.res_folder   = 'res'
+    pd.anc_folder   = ancDir
+    clustBuffer     = 300
+    os.mkdir(pd.res_folder)
+    pd.pvalPrepare(pd.phase)
+
+    ### Synthetic data - not timed ######
+    tstart      = time.time()
+    rnd         = random.Random(1)
+    chromD,lociL = benchGenome(rnd,"genome.fa")
+    pd.libs     = [benchLib(rnd,chromD,lociL,"lib%s.fa" % (i+1)) for i in range(bench_libs)]
+    print("Synthetic data: %sMb genome | %s loci | %s libraries x %s reads | %.1fs" % (bench_genome,
+        len(lociL),bench_libs,bench_depth,time.time()-tstart))
+
+    stageD      = collections.OrderedDict() ## stage:seconds
+
+    ### FASTAClean ######################
+    tstart      = time.time()
+    fastaclean,fastasumm = pd.FASTAClean("genome.fa",0)
+    stageD['FASTAClean'] = time.time()-tstart
+
+    ### Index build - same as indexBuilder, on cleaned reference
+    tstart      = time.time()
+    genoIndex   = "%s/genome.clean" % (benchDir)
+    retcode     = subprocess.call(["bowtie-build","-f"]+pd.indexParams()+[fastaclean,genoIndex],stdout=subprocess.DEVNULL)
+    if retcode != 0:
+        print("** bowtie-build failed on synthetic genome")
+        sys.exit()
+    stageD['indexBuild'] = time.time()-tstart
+
+    ### De-duplication ##################
+    tstart      = time.time()
+    countL      = pd.PPResults(pd.dedup_process,pd.libs)
+    stageD['dedup'] = time.time()-tstart
+
+    ### Alignment and scoring ###########
+    stageD['alignment'] = 0.0
+    stageD['scoring']   = 0.0
+    recovered   = 0
+    for alib in countL:
+        out_file = './%s/%s.txt' % (pd.res_folder,alib.rpartition(".")[0])
+        tstart   = time.time()
+        sh2,hits,totalAbun = pd.libAlign(alib,genoIndex,int(pd.nproc),out_file)
+        stageD['alignment'] += time.time()-tstart
+
+        tstart   = time.time()
+        scoredD  = {}
+        for rl in pd.phase:
+            scoredL = []
+            for achr in pd.chrSort(sh2):
+                scoredL.extend(pd.phasScore(achr,sh2[achr],rl))
+            scoredD[rl] = scoredL
+        pd.phasWriter(out_file,scoredD,hits,totalAbun,clustBuffer)
+        stageD['scoring'] += time.time()-tstart
+        recovered += benchLoci(lociL,"%s.cluster.boundary.without.PARE.validation.list" % (out_file))
+
+    os.chdir("..")
+    resD        = {"timestamp":datetime.datetime.now().strftime("%m_%d_%H_%M"),"settings":settingsD,
+                    "stages":dict((akey,round(aval,3)) for akey,aval in stageD.items()),
+                    "loci":{"planted":len(lociL)*bench_libs,"recovered":recovered}}
+    fh_out      = open(outFile,'w')
+    json.dump(resD,fh_out,indent=1)
+    fh_out.close()
+    shutil.rmtree(benchDir)
+
+    ### Compare with baseline ###########
+    baseD       = None
+    if os.path.isfile(baseFile):
+        fh_in   = open(baseFile,'r')
+        baseD   = json.load(fh_in)
+        fh_in.close()
+        if baseD.get("settings") != settingsD:
+            print("Baseline has different bench settings or cores, not compared: %s" % (baseFile))
+            baseD = None
+
+    print("\n%-12s %10s %10s %8s" % ("Stage","Time(s)","Base(s)","Ratio"))
+    for astage,atime in resD["stages"].items():
+        if baseD and baseD["stages"].get(astage):
+            aratio = atime/baseD["stages"][astage]
+            aflag  = "  ** slower" if aratio > 1.1 and atime-baseD["stages"][astage] > 0.1 else "" ## Ignore jitter of short stages
+            print("%-12s %10.3f %10.3f %8.2f%s" % (astage,atime,baseD["stages"][astage],aratio,aflag))
+        else:
+            print("%-12s %10.3f %10s %8s" % (astage,atime,"-","-"))
+    print("Planted loci recovered           : %s/%s" % (recovered,resD["loci"]["planted"]))
+    if baseD and baseD["loci"]["recovered"] != recovered:
+        print("** Recovered loci differ from baseline: %s" % (baseD["loci"]["recovered"]))
+
+    if args.save or not os.path.isfile(baseFile):
+        os.makedirs(ancDir, exist_ok=True)
+        shutil.copy(outFile,baseFile)
+        print("Benchmark stored as baseline     : %s" % (baseFile))
+    print("Benchmark results                : %s" % (outFile))
+
+    return None
+
+def benchGenome(rnd,afile):
+    '''
+    Writes random genome with phased loci planted as coordinates, each chromosome is ~2Mb
+    '''
+    nchr        = max(1,int(round(bench_genome/2)))
+    chrLen      = int(bench_genome*1000000/nchr)
+    chromD      = {}
+    fh_out      = open(afile,'w')
+    for i in range(nchr):
+        achr    = str(i+1)
+        aseq    = "".join(rnd.choices("ACGT",k=chrLen))
+        chromD[achr] = aseq
+        fh_out.write(">%s\n" % (achr))
+        for j in range(0,chrLen,60): ## Multi-line FASTA, as references usually are
+            fh_out.write("%s\n" % (aseq[j:j+60]))
+    fh_out.close()
+
+    lociL       = [] ## (chr,start,end,rl) - 0-based start of first phase
+    for rl in (21,24):
+        for i in range(bench_loci):
+            achr    = rnd.choice(list(chromD))
+            astart  = rnd.randrange(100,chrLen-12*rl-100)
+            lociL.append((achr,astart,astart+10*rl,rl))
+
+    return chromD,lociL
+
+def benchLib(rnd,chromD,lociL,afile):
+    '''
+    Writes FASTA library of reads - a fifth are from phased loci in both strands (with
+    2-nt overhang), rest is noise from random sites of 20-24nt
+    '''
+    comp        = str.maketrans("ACGT","TGCA")
+    chrL        = list(chromD)
+    noiseL      = [] ## Noise sites - (chr,start,len,strand)
+    for i in range(max(1,bench_depth//20)):
+        achr    = rnd.choice(chrL)
+        alen    = rnd.randint(20,24)
+        noiseL.append((achr,rnd.randrange(0,len(chromD[achr])-alen),alen,rnd.choice("+-")))
+
+    fh_out      = open(afile,'w')
+    for i in range(bench_depth):
+        if rnd.random() < 0.2:
+            achr,astart,aend,rl = rnd.choice(lociL)
+            apos    = astart+rnd.randrange(10)*rl
+            astrand = rnd.choice("+-")
+            if astrand == "-":
+                apos -= 2
+            alen    = rl
+        else:
+            achr,apos,alen,astrand = rnd.choice(noiseL)
+        aseq    = chromD[achr][apos:apos+alen]
+        if astrand == "-":
+            aseq = aseq.translate(comp)[::-1]
+        fh_out.write(">r%s\n%s\n" % (i,aseq))
+    fh_out.close()
+
+    return afile
+
+def benchLoci(lociL,listFile):
+    '''
+    Counts planted loci that overlap a cluster of same phase in list file
+    '''
+    clustD      = collections.defaultdict(list) ## (chr,rl):[(start,end),...]
+    fh_in       = open(listFile,'r')
+    for line in fh_in:
+        ent     = line.strip().split("|")
+        if len(ent) < 3 or "=" not in ent[2]:
+            continue
+        achr,_,coords = ent[2].partition("=")[2].strip().partition(":")
+        astart,_,aend = coords.partition("..")
+        clustD[(achr,int(ent[1]))].append((int(astart),int(aend)))
+    fh_in.close()
+
+    recovered   = 0
+    for achr,astart,aend,rl in lociL:
+        for cstart,cend in clustD[(achr,rl)]:
+            if cstart <= aend and astart+1 <= cend:
+                recovered += 1
+                break
+
+    return recovered
+
+#### MAIN ###############################################
+
+if __name__ == '__main__':
+
+    pd          = phasLoad()
+    pd.nproc    = pd.coreReserve(pd.cores)
+    phasBench(pd)
+    sys.exit()
+
+## v1.00
+## Times FASTAClean, index build, dedup, alignment and scoring of phasdetect on synthetic genome/libraries with
+#### planted phased loci, JSON vs. baseline
@@ -4,6 +4,7 @@ use warnings;
 use Getopt::Long;
 use Scalar::Util qw(looks_like_number);
 use File::Basename;
+use Parallel::ForkManager;
 
 ######################################################################
 #  Copyright 2013 University of Delaware
@@ -31,7 +32,7 @@ Ptime("Phasing analysis begins...");
 no 5.12;
 my %sum = ();
 GetOptions(my $options = {},
-              "-i=s","-f=s","-d=s","-v=i","-o=s","-rl=s","-s=s","-p=s","-cpu=i","-px=s","-n=i","-g=i","-t=i","-ht=i","-q=s","-k=i"#"-z=s",
+              "-i=s","-f=s","-d=s","-v=i","-o=s","-rl=s","-s=s","-p=s","-cpu=i","-px=s","-n=i","-g=i","-t=i","-ht=i","-q=s","-k=i","-pt=s","-st","-al=s"#"-z=s",
 );
 ########### USAGE ##############
 my $USAGE = <<USAGE;
@@ -60,6 +61,8 @@ my $cpu = ($options->{cpu})?$options->{cpu}:2;
 my $mm = (defined $options->{m})?$options->{m}:0;
 my $input = $options->{i};
 my $k = ($options->{k})?"-k $options->{k}" :"-a";  #bowtie options for hits reports limitation.
+my $pval_dir = ($options->{pt})?$options->{pt}:0; # folder with precomputed p-value tables (pvalues_<rl>nt.bin) from phasdetect
+my %pval_table = (); # rl => p-values, indexed by n*23+k
 
 $options->{o} = ($options->{o})?$options->{o}:"output";
 $options->{s} = ($options->{s})?$options->{s}:'score';
@@ -77,7 +80,7 @@ my %miscandidate = ();
 push(@temp_files,$prefix.".".$bowtie_output);
 # -----------tag count processing if the input is tagcount---------------
 my $t_i = 0;
-if ($options->{f} =~ /t/i) {
+if ($options->{f} =~ /t/i && !$options->{al}) {
 	my $fasta_file = generate_rand_filename(11);
 	push(@temp_files,$fasta_file);
 	
@@ -101,12 +104,23 @@ Ptime("aligning...");
 Ptime("script version is $version..");
 my @parameters = join(" ", "-f",  "-a -v $mm","-m 45", "-p $cpu", "$options->{d}", "$input", " >$prefix.$bowtie_output");
 
-my @bowtie_out = system("bowtie @parameters");
-Ptime("aligning is done");
+if ($options->{al}) {
+	# alignments made by phasdetect - read from its alignment cache, or made against shards of a sharded index with the -m ceiling applied across shards
+	open(DATA, $options->{al}) || die "Cannot open the alignment file $options->{al}";
+}
+elsif ($options->{st}) {
+	# streaming mode, alignments are read from the bowtie pipe as these are produced and never written to disk
+	my $stream_parameters = join(" ", "-f",  "-a -v $mm", "-m 45", "-p $cpu", "$options->{d}", "$input");
+	open(DATA, "bowtie $stream_parameters |") || die "Cannot open the bowtie pipe";
+}
+else {
+	my @bowtie_out = system("bowtie @parameters");
+	Ptime("aligning is done");
+}
 
 #put all the signature and their information into the HASH %sh
 #--------bowtie out put pre processing, organized as the position, deposited into the HASH, MYSQL processing will be better with lowere RAM requirement-------------------
-open(DATA, "$prefix.$bowtie_output") || die "Cannot open the bowtie outputed DATA";
+open(DATA, "$prefix.$bowtie_output") || die "Cannot open the bowtie outputed DATA" unless ($options->{st} || $options->{al});
 while(my $line=<DATA>) {# input small RNA mapping data
         chomp $line;
         my ($seqid, $strand, $target, $pos,  $seq, @other)=split(/\t/, $line);
@@ -136,6 +150,10 @@ while(my $line=<DATA>) {# input small RNA mapping data
         push(@{$sh{$target}->{$pos}->{$strand}},[$seqid,$seq,$abun]);
 }
 Ptime("finished the loading of sRNA alignment data.");
+if ($options->{st}) {
+	close DATA or die "bowtie alignment failed, exit code: $?\n";
+	Ptime("aligning is done");
+}
 # ------------ end of preprocessing ---------------
 close DATA;
 
@@ -201,124 +219,86 @@ foreach my $cluster_ref (@pre_splitted_cluster) {
 Ptime("total $total_cluster presplitted sRNA clusters");
 
 # -------------------------------- scoreing each of the cluster parallelly --------------------------------------------------
+# targets are independent, these are sharded into groups balanced by sRNA hits and each group is scored in a forked worker
+my @shard_cluster = shard_targets(\@qualified_cluster,$cpu);
+Ptime("scoring in ".scalar(@shard_cluster)." shards");
+
 foreach my $rl (sort {$a <=> $b} @rl) {
 	
-	my @file_list = ();# save the temporary filenames
-	# the below loops will spend a lot of time,  if this part can be optimized by parallel, then the efficiency woulbe be greatly improved-
-	my $i = 0;
-	my $j = 1;
+	pval_table($rl); # load once, before forking
 	
-	while (my ($cluster_idx, $cluster_ref) = each @qualified_cluster) { # the each for @array only works on the perl over 5.12
-		$i++;
-		if ($i/500 == $j ) {
-			Ptime("processed $i clusters");
-			$j++;
-		}
-		my $filename = phasing_analysis_v2($cluster_ref, $rl, $cluster_idx);		
-		#push(@file_list,$filename);
-	}
-	# ----------------------------------end of score loop ---------------------------------------------------------------
-
-	open(OUT,  ">$prefix.$options->{o}\_all_sRNA_$rl\_out.txt"); # outfile of all small RNA clusters
-	open(out2, ">$prefix.$options->{s}\_p$p_cutoff\_sRNA_$rl\_out.txt") or die "cant create the scored file\n";
-
-	#$pre_scored_sRNA{$rl}->{$chr}->{$cor}->{$str}->{$seq} = [$seqid,$seq,$abun,$n,$k,$cor_best,$p];
-	foreach my $target  (sort {$a cmp $b} keys %{$pre_scored_sRNA{$rl}}) {
-		foreach my $cor (sort {$a <=> $b} keys %{$pre_scored_sRNA{$rl}->{$target}}) {
-			foreach my $str (sort {$a cmp $b} keys %{$pre_scored_sRNA{$rl}->{$target}->{$cor}}) {
-				foreach my $seq (sort {$a cmp $b} keys %{$pre_scored_sRNA{$rl}->{$target}->{$cor}->{$str}}) {
-					my ($seqid,$abun,$n,$k,$cor_best,$p) = @{$pre_scored_sRNA{$rl}->{$target}->{$cor}->{$str}->{$seq}};
-					my $len = length($seq);
-						print OUT join ("\t",$target,$str,$cor,$seqid,$seq,$len,$abun,$n,$k,$cor_best,$p);
-						print OUT "\n";
-						                                          
-						if ($p < $p_cutoff) {#select and output small RNA clusters with p<0.001
-								print out2 join ("\t",$target,$str,$cor,$seqid,$seq,$len,$abun,$n,$k,$cor_best,$p);
-								print out2 "\n";
-						}
-				}
+	my $pm = new Parallel::ForkManager(scalar(@shard_cluster));
+	my $failed = 0;
+	$pm->run_on_finish(sub {
+		my ($pid,$exit_code) = @_;
+		$failed++ if ($exit_code);
+	});
+	foreach my $shard (0..$#shard_cluster) {
+		my $pid = $pm->start and next;
+		
+		my $i = 0;
+		my $j = 1;
+		foreach my $cluster_ref (@{$shard_cluster[$shard]}) {
+			$i++;
+			if ($i/500 == $j ) {
+				Ptime("shard $shard processed $i clusters");
+				$j++;
 			}
+			phasing_analysis_v2($cluster_ref, $rl);
 		}
+		scored_output($rl,".shard$shard");
+		
+		$pm->finish;
 	}
-	close OUT;
-	close out2;
+	$pm->wait_all_children;
+	die "scoring failed in $failed of ".scalar(@shard_cluster)." shards\n" if ($failed);
+	# ----------------------------------end of score loop ---------------------------------------------------------------
+	
+	# shards hold different targets, each sorted, so these are merged back in the target order
+	my @all_out_shard = map {"$prefix.$options->{o}\_all_sRNA_$rl\_out.shard$_.txt"} (0..$#shard_cluster);
+	my @qualified_out = map {"$prefix.$options->{s}\_p$p_cutoff\_sRNA_$rl\_out.shard$_.txt"} (0..$#shard_cluster);
+	
+	merge_shards(\@all_out_shard,"$prefix.$options->{o}\_all_sRNA_$rl\_out.txt");
+	merge_shards(\@qualified_out,"$prefix.$options->{s}\_p$p_cutoff\_sRNA_$rl\_out.txt");
 	
 	Ptime("The scoring is done...");
 
 	#----------------cluster the outputed data-----------------------
+	# the cutoffs are nested, so a single pass over the qualified output
+	# assigns each sRNA to the clusters of every cutoff it passes
 	my @cutArrange = (5e-3,1e-3,5e-4,1e-4,5e-5,1e-5,5e-6,1e-6,5e-7,1e-7);
-	foreach my $cut (sort {$b <=> $a} @cutArrange) {
-		
-		my %cluster = ();#record all the qualified small RNA under the p-value cutoff
-		my $cluster = 0;
-		my $phaseNumb = 0;
-		my $i = 0;
-		my $temp_chr = 0;
-		my $temp_pos = 0;
-		my $temp_row = '';
-		
-		# open the qualified scored output
-		open(IN,"$prefix.$options->{s}\_p$p_cutoff\_sRNA_$rl\_out.txt");
-		open(TEMP1,     ">$prefix.temp.sorted.$cut.cluster.minimal.$rl.requirement.txt");
-		push(@temp_files,"$prefix.temp.sorted.$cut.cluster.minimal.$rl.requirement.txt");
-		while (<IN>) {
-			chomp;
-			my @array = split/\t/,$_;
-			if ($array[-1] <= $cut) {
-				print TEMP1 "$_\n";
-			}
-		}
-		close TEMP1;
-		close IN;
-
-		open(TEMP2,"$prefix.temp.sorted.$cut.cluster.minimal.$rl.requirement.txt");
-		while (<TEMP2>) {
-		
-				chomp;$i++;
-				my (@array) = split/\t/,$_;
-				if ($i == 1) {#this sub will only execute once
-						$cluster++;
-						
-						push(@{$cluster{$cluster}},[$array[0],$array[1],$array[2],$array[3],$array[4],$array[5],$array[6],"n=$array[7]","k=$array[8]","hts=$hits{$array[3]}",$array[9],$array[10]]);
-						
-						$temp_chr = $array[0];
-						$temp_pos = $array[2];
-						next;
-				}
+	my @cutOrder = sort {$b <=> $a} @cutArrange;
+	my %cluster = ();#record all the qualified small RNA under each p-value cutoff
+	my %cluster_n = ();
+	my %temp_chr = ();
+	my %temp_pos = ();
+	
+	# open the qualified scored output
+	open(IN,"$prefix.$options->{s}\_p$p_cutoff\_sRNA_$rl\_out.txt");
+	while (<IN>) {
+		chomp;
+		my @array = split/\t/,$_;
+		my $record;
+		foreach my $cut (@cutOrder) {
+				last if ($array[-1] > $cut);#fails this cutoff and every stricter one
+				$record ||= [$array[0],$array[1],$array[2],$array[3],$array[4],$array[5],$array[6],"n=$array[7]","k=$array[8]","hts=$hits{$array[3]}",$array[9],$array[10]];
 				
-				if ($temp_chr eq $array[0]) {
-						#judge the pos, 2 possibilities
-						if ($array[2] - $gap_len <= $temp_pos) {
-								
-								push(@{$cluster{$cluster}},[$array[0],$array[1],$array[2],$array[3],$array[4],$array[5],$array[6],"n=$array[7]","k=$array[8]","hts=$hits{$array[3]}",$array[9],$array[10]]);
-								
-								$temp_chr = $array[0];
-								$temp_pos = $array[2];
-								
-						}
-						else {#gap is bigger than predified gap length, such as 300bp
-								
-								$cluster++;
-								push(@{$cluster{$cluster}},[$array[0],$array[1],$array[2],$array[3],$array[4],$array[5],$array[6],"n=$array[7]","k=$array[8]","hts=$hits{$array[3]}",$array[9],$array[10]]);
-								
-								$temp_chr = $array[0];
-								$temp_pos = $array[2];
-						}
+				if (exists $temp_chr{$cut} and $temp_chr{$cut} eq $array[0] and $array[2] - $gap_len <= $temp_pos{$cut}) {
+						push(@{$cluster{$cut}->{$cluster_n{$cut}}},$record);
 				}
-				else {
-						#output the data to the last, update the cluste #
-						$cluster++;
-
-						push(@{$cluster{$cluster}},[$array[0],$array[1],$array[2],$array[3],$array[4],$array[5],$array[6],"n=$array[7]","k=$array[8]","hts=$hits{$array[3]}",$array[9],$array[10]]);
-
-						$temp_chr = $array[0];
-						$temp_pos = $array[2];
+				else {#first sRNA, another chromosome or gap is bigger than predified gap length, such as 300bp
+						$cluster_n{$cut}++;
+						push(@{$cluster{$cut}->{$cluster_n{$cut}}},$record);
 				}
+				$temp_chr{$cut} = $array[0];
+				$temp_pos{$cut} = $array[2];
 		}
-		close TEMP2;
-		
-		# the check will save those cluster which  mainly have the interested small RNA
-		cluster_abundance_check(\%cluster,$rl,$ta_cf,$cut);
+	}
+	close IN;
+	
+	# the check will save those cluster which  mainly have the interested small RNA
+	foreach my $cut (@cutOrder) {
+		cluster_abundance_check($cluster{$cut} || {},$rl,$ta_cf,$cut);
 	}
 }
 
@@ -612,6 +592,106 @@ sub phasing_analysis_v2 {
 }
 
 
+# group clusters by target and deal the targets to shards balanced by sRNA hits, largest first.
+# clusters of a shard keep the original order, which is by target and position
+sub shard_targets {
+	my ($cluster_ref,$nshard) = @_;
+	my %target_cluster = ();
+	my %target_hits = ();
+	foreach my $cluster (@{$cluster_ref}) {
+		my $target = $cluster->[0]->[0];
+		push(@{$target_cluster{$target}},$cluster);
+		$target_hits{$target} += scalar(@{$cluster});
+	}
+	my @targets = sort {$target_hits{$b} <=> $target_hits{$a} or $a cmp $b} keys %target_hits;
+	$nshard = scalar(@targets) if ($nshard > scalar(@targets));
+	$nshard = 1 if ($nshard < 1);
+	
+	my @shard_hits = (0) x $nshard;
+	my @shard_target = map {[]} (1..$nshard);
+	foreach my $target (@targets) {
+		my $min = 0;
+		foreach my $shard (1..$nshard-1) {
+			$min = $shard if ($shard_hits[$shard] < $shard_hits[$min]);
+		}
+		push(@{$shard_target[$min]},$target);
+		$shard_hits[$min] += $target_hits{$target};
+	}
+	
+	my @shard_cluster = ();
+	foreach my $shard (0..$nshard-1) {
+		push(@shard_cluster,[map {@{$target_cluster{$_}}} sort {$a cmp $b} @{$shard_target[$shard]}]);
+	}
+	return @shard_cluster;
+}
+
+# write all and qualified scored sRNAs of a register length, sorted by target and position
+sub scored_output {
+	my ($rl,$suffix) = @_;
+	open(OUT,  ">$prefix.$options->{o}\_all_sRNA_$rl\_out$suffix.txt"); # outfile of all small RNA clusters
+	open(out2, ">$prefix.$options->{s}\_p$p_cutoff\_sRNA_$rl\_out$suffix.txt") or die "cant create the scored file\n";
+
+	#$pre_scored_sRNA{$rl}->{$chr}->{$cor}->{$str}->{$seq} = [$seqid,$seq,$abun,$n,$k,$cor_best,$p];
+	foreach my $target  (sort {$a cmp $b} keys %{$pre_scored_sRNA{$rl}}) {
+		foreach my $cor (sort {$a <=> $b} keys %{$pre_scored_sRNA{$rl}->{$target}}) {
+			foreach my $str (sort {$a cmp $b} keys %{$pre_scored_sRNA{$rl}->{$target}->{$cor}}) {
+				foreach my $seq (sort {$a cmp $b} keys %{$pre_scored_sRNA{$rl}->{$target}->{$cor}->{$str}}) {
+					my ($seqid,$abun,$n,$k,$cor_best,$p) = @{$pre_scored_sRNA{$rl}->{$target}->{$cor}->{$str}->{$seq}};
+					my $len = length($seq);
+						print OUT join ("\t",$target,$str,$cor,$seqid,$seq,$len,$abun,$n,$k,$cor_best,$p);
+						print OUT "\n";
+						                                          
+						if ($p < $p_cutoff) {#select and output small RNA clusters with p<0.001
+								print out2 join ("\t",$target,$str,$cor,$seqid,$seq,$len,$abun,$n,$k,$cor_best,$p);
+								print out2 "\n";
+						}
+				}
+			}
+		}
+	}
+	close OUT;
+	close out2;
+}
+
+# merge the scored shards, every target is whole in one shard and each shard is sorted by target
+sub merge_shards {
+	my ($file_ref,$output) = @_;
+	my @fh = ();
+	my @line = ();
+	foreach my $file (@{$file_ref}) {
+		open(my $fh_in, $file) or die "Cannot open the scored shard $file\n";
+		push(@fh,$fh_in);
+		push(@line,scalar(<$fh_in>));
+	}
+	
+	open(my $fh_out,">$output") or die "cant create the scored file\n";
+	while (1) {
+		my $next = -1;
+		my $next_target = '';
+		foreach my $idx (0..$#fh) {
+			next unless (defined $line[$idx]);
+			my ($target) = split/\t/,$line[$idx],2;
+			if ($next < 0 or $target lt $next_target) {
+				$next = $idx;
+				$next_target = $target;
+			}
+		}
+		last if ($next < 0);
+		
+		my $fh_in = $fh[$next];
+		while (defined $line[$next] and (split/\t/,$line[$next],2)[0] eq $next_target) {
+			print $fh_out $line[$next];
+			$line[$next] = <$fh_in>;
+		}
+	}
+	close $fh_out;
+	
+	foreach my $idx (0..$#fh) {
+		close $fh[$idx];
+		unlink $file_ref->[$idx];
+	}
+}
+
 sub generate_rand_filename {
 
      my $length_of_randomstring = shift;# the length of
@@ -634,6 +714,12 @@ sub hm_chen { #v.2
 	my ($n,$k,$rl) = @_;
 	#$k = ($k>=22)?21:$k;
 	
+	# lookup from the precomputed table if available, computed by the same series as below
+	my $table = pval_table($rl);
+	if ($table and $n <= 22*$rl and $k <= 22) {
+		return $table->[$n*23 + $k];
+	}
+	
 	my $p = 0;
 	my $pr;
 
@@ -671,6 +757,25 @@ sub hm_chen { #v.2
 	return $p;
 }
 #
+# read the p-value table of a register length once, the table is little-endian doubles
+sub pval_table {
+	my ($rl) = @_;
+	return 0 unless ($pval_dir);
+	
+	unless (exists $pval_table{$rl}) {
+		my $file = "$pval_dir/pvalues_$rl"."nt.bin";
+		$pval_table{$rl} = 0;
+		if (-e $file and -s $file == (22*$rl + 1)*23*8) {
+			open(my $fh_pt, '<:raw', $file) or die "Cannot open the p-value table $file\n";
+			local $/;
+			my $data = <$fh_pt>;
+			close $fh_pt;
+			$pval_table{$rl} = [unpack('d<*', $data)];
+		}
+	}
+	return $pval_table{$rl};
+}
+
 sub minimal {
 	my @array = @_;
 	my @array_sorted = map{$array[$_]} sort {$array[$a]->[0]<=>$array[$b]->[0]} 0..$#array;
@@ -885,4 +990,10 @@ sub top3_phase_judge {
 ## Log Change [PHASworks]
 ## Removed -k mode in bowtie and added -a, replaced -n mode with -v and added -m ceiling. 
 ## In case of transcriptome/scaffold version -m ceiling is kept high as these can match to multiple isoforms
-## Functions trimmed and organized
\ No newline at end of file
+## Functions trimmed and organized
+## hm_chen uses precomputed p-value table from phasdetect (-pt), when available
+## Added streaming mode (-st), bowtie alignments are read from pipe instead of a temporary file
+## Clusters for all p-value cutoffs are made in a single pass over the scored file, no per-cutoff temp files
+## Scoring is sharded by target into groups balanced by sRNA hits, groups are scored in forked workers (-cpu) and merged in target order
+## Alignments made by phasdetect can be given as a file (-al), bowtie is not run then
+## '-al' also takes alignments made by phasdetect against a sharded index
@@ -28,7 +28,7 @@ no 5.12;
 my %sum = ();
 
 GetOptions(my $options = {},
-              "-i=s","-f=s","-d=s","-p=s","-cpu=i","-rl=s","-px=s","-n=i","-g=i","-t=i","-ht=i","-q=s","-k=i"#"-o=s","-s=s","-a=s",
+              "-i=s","-f=s","-d=s","-p=s","-cpu=i","-rl=s","-px=s","-n=i","-g=i","-t=i","-ht=i","-q=s","-k=i","-pt=s","-st","-al=s"#"-o=s","-s=s","-a=s",
 );
 ########### USAGE ##############
 my $USAGE = <<USAGE;
@@ -56,6 +56,8 @@ my $cpu = ($options->{cpu})?$options->{cpu}:2;
 my $mm = (defined $options->{m})?$options->{m}:0;
 my $input = $options->{i};
 my $k = ($options->{k})?"-k $options->{k}" :"-a";  #bowtie options for hits reports limitation.
+my $pval_dir = ($options->{pt})?$options->{pt}:0; # folder with precomputed p-value tables (pvalues_<rl>nt.bin) from phasdetect
+my %pval_table = (); # rl => p-values, indexed by n*23+k
 
 
 $options->{o} = ($options->{o})?$options->{o}:"output";
@@ -78,7 +80,7 @@ my %candidate_vague = ();
 push(@temp_files,$prefix.".".$bowtie_output);
 # -----------tag count processing if the input is tagcount---------------
 my $t_i = 0;
-if ($options->{f} =~ /t/i) {
+if ($options->{f} =~ /t/i && !$options->{al}) {
 	my $fasta_file = generate_rand_filename(11);
 	push(@temp_files,$fasta_file);
 	
@@ -103,12 +105,23 @@ Ptime("script version is $version..");
 # my @parameters = join(" ", "-f",  "$k -n $mm", "-p $cpu", "$options->{d}", "$input", " >$prefix.$bowtie_output"); ### Old-mode increases in mapped reads by 4% as these are filtered by -m criteria in new mode below
 my @parameters = join(" ", "-f",  "-a -v $mm", "-m 12" ,"-p $cpu", "$options->{d}", "$input", " >$prefix.$bowtie_output"); ### Faster Mode and removes multimappers
 # print @parameters;
-my @bowtie_out = system("bowtie @parameters");
-Ptime("aligning is done");
+if ($options->{al}) {
+	# alignments made by phasdetect - read from its alignment cache, or made against shards of a sharded index with the -m ceiling applied across shards
+	open(DATA, $options->{al}) || die "Cannot open the alignment file $options->{al}";
+}
+elsif ($options->{st}) {
+	# streaming mode, alignments are read from the bowtie pipe as these are produced and never written to disk
+	my $stream_parameters = join(" ", "-f",  "-a -v $mm", "-m 12", "-p $cpu", "$options->{d}", "$input");
+	open(DATA, "bowtie $stream_parameters |") || die "Cannot open the bowtie pipe";
+}
+else {
+	my @bowtie_out = system("bowtie @parameters");
+	Ptime("aligning is done");
+}
 
 #put all the signature and their information into the HASH %sh
 #--------bowtie out put pre processing -------------------
-open(DATA, "$prefix.$bowtie_output") || die "Cannot open the bowtie outputed DATA";
+open(DATA, "$prefix.$bowtie_output") || die "Cannot open the bowtie outputed DATA" unless ($options->{st} || $options->{al});
 while(my $line=<DATA>) {# input small RNA mapping data
 	chomp $line;
 	my ($seqid, $strand, $target, $pos,  $seq, @other)=split(/\t/, $line);
@@ -148,6 +161,10 @@ while(my $line=<DATA>) {# input small RNA mapping data
 	
 }
 Ptime("finished the loading of sRNA alignment data.");
+if ($options->{st}) {
+	close DATA or die "bowtie alignment failed, exit code: $?\n";
+	Ptime("aligning is done");
+}
 # ------------end of preprocessing ---------------
 
 
@@ -226,6 +243,8 @@ foreach my $rl (sort {$a <=> $b} @rl) {#rl, register length
 	
 	
 	
+	pval_table($rl); # load once, before forking
+	
 	# fork the processing, the nubmer is eqaul to the chromosomes
 	my $pm = new Parallel::ForkManager($#tchr + 1); 
 	foreach my $chr(sort {$a<=>$b} @tchr) {
@@ -244,78 +263,41 @@ foreach my $rl (sort {$a <=> $b} @rl) {#rl, register length
 	merge_files(\@qualified_out,"$prefix.$options->{s}\_p$p_cutoff\_sRNA_$rl\_out.txt");
 
 	#----------------cluster the outputed data-----------------------
+	# the cutoffs are nested, so a single pass over the qualified output
+	# assigns each sRNA to the clusters of every cutoff it passes
 	my @cutArrange = (5e-3,1e-3,5e-4,1e-4,5e-5,1e-5,5e-6,1e-6,5e-7,1e-7);
-	foreach my $cut (sort {$b <=> $a} @cutArrange) {
-		
-		my %cluster = ();#record all the qualified small RNA under the p-value cutoff
-		my $cluster = 0;
-		my $phaseNumb = 0;
-		my $i = 0;
-		my $temp_chr = 0;
-		my $temp_pos = 0;
-		my $temp_row = '';
-		
-		# open the qualified scored output
-		open(IN,"$prefix.$options->{s}\_p$p_cutoff\_sRNA_$rl\_out.txt");
-		open(TEMP1,     ">$prefix.temp.sorted.$cut.cluster.minimal.$rl.requirement.txt");
-		push(@temp_files,"$prefix.temp.sorted.$cut.cluster.minimal.$rl.requirement.txt");
-		while (<IN>) {
-			chomp;
-			my @array = split/\t/,$_;
-			if ($array[-1] <= $cut) {
-				print TEMP1 "$_\n";
-			}
-		}
-		close TEMP1;
-		close IN;
-
-		open(TEMP2,"$prefix.temp.sorted.$cut.cluster.minimal.$rl.requirement.txt");
-		while (<TEMP2>) {
-		
-				chomp;$i++;
-				my (@array) = split/\t/,$_;
-				if ($i == 1) {#this sub will only execute once
-						$cluster++;
-						
-						push(@{$cluster{$cluster}},[$array[0],$array[1],$array[2],$array[3],$array[4],$array[5],$array[6],"n=$array[7]","k=$array[8]","hts=$hits{$array[3]}",$array[9],$array[10]]);
-						
-						$temp_chr = $array[0];
-						$temp_pos = $array[2];
-						next;
-				}
-				if ($temp_chr == $array[0]) {
-						#judge the pos, 2 possibilities
-						if ($array[2] - $gap_len <= $temp_pos) {
-								
-								push(@{$cluster{$cluster}},[$array[0],$array[1],$array[2],$array[3],$array[4],$array[5],$array[6],"n=$array[7]","k=$array[8]","hts=$hits{$array[3]}",$array[9],$array[10]]);
-								
-								$temp_chr = $array[0];
-								$temp_pos = $array[2];
-						}
-						else {#gap is bigger than predified gap length, such as 300bp
-								
-								$cluster++;
-
-								push(@{$cluster{$cluster}},[$array[0],$array[1],$array[2],$array[3],$array[4],$array[5],$array[6],"n=$array[7]","k=$array[8]","hts=$hits{$array[3]}",$array[9],$array[10]]);
-								
-								$temp_chr = $array[0];
-								$temp_pos = $array[2];
-						}
+	my @cutOrder = sort {$b <=> $a} @cutArrange;
+	my %cluster = ();#record all the qualified small RNA under each p-value cutoff
+	my %cluster_n = ();
+	my %temp_chr = ();
+	my %temp_pos = ();
+	
+	# open the qualified scored output
+	open(IN,"$prefix.$options->{s}\_p$p_cutoff\_sRNA_$rl\_out.txt");
+	while (<IN>) {
+		chomp;
+		my @array = split/\t/,$_;
+		my $record;
+		foreach my $cut (@cutOrder) {
+				last if ($array[-1] > $cut);#fails this cutoff and every stricter one
+				$record ||= [$array[0],$array[1],$array[2],$array[3],$array[4],$array[5],$array[6],"n=$array[7]","k=$array[8]","hts=$hits{$array[3]}",$array[9],$array[10]];
+				
+				if (exists $temp_chr{$cut} and $temp_chr{$cut} == $array[0] and $array[2] - $gap_len <= $temp_pos{$cut}) {
+						push(@{$cluster{$cut}->{$cluster_n{$cut}}},$record);
 				}
-				else {
-						#output the data to the last, update the cluste #
-						$cluster++;
-
-						push(@{$cluster{$cluster}},[$array[0],$array[1],$array[2],$array[3],$array[4],$array[5],$array[6],"n=$array[7]","k=$array[8]","hts=$hits{$array[3]}",$array[9],$array[10]]);
-
-						$temp_chr = $array[0];
-						$temp_pos = $array[2];
+				else {#first sRNA, another chromosome or gap is bigger than predified gap length, such as 300bp
+						$cluster_n{$cut}++;
+						push(@{$cluster{$cut}->{$cluster_n{$cut}}},$record);
 				}
+				$temp_chr{$cut} = $array[0];
+				$temp_pos{$cut} = $array[2];
 		}
-		close TEMP2;
-		
-		# the check will save those cluster which  mainly have the interested small RNA
-		cluster_abundance_check(\%cluster,$rl,$ta_cf,$cut);
+	}
+	close IN;
+	
+	# the check will save those cluster which  mainly have the interested small RNA
+	foreach my $cut (@cutOrder) {
+		cluster_abundance_check($cluster{$cut} || {},$rl,$ta_cf,$cut);
 	}
 }
 
@@ -648,6 +630,12 @@ sub hm_chen { #v.2
 	my ($n,$k,$rl) = @_;
 	#$k = ($k>=22)?21:$k;
 	
+	# lookup from the precomputed table if available, computed by the same series as below
+	my $table = pval_table($rl);
+	if ($table and $n <= 22*$rl and $k <= 22) {
+		return $table->[$n*23 + $k];
+	}
+	
 	my $p = 0;
 	my $pr;
 
@@ -685,6 +673,25 @@ sub hm_chen { #v.2
 	return $p;
 }
 
+# read the p-value table of a register length once, the table is little-endian doubles
+sub pval_table {
+	my ($rl) = @_;
+	return 0 unless ($pval_dir);
+	
+	unless (exists $pval_table{$rl}) {
+		my $file = "$pval_dir/pvalues_$rl"."nt.bin";
+		$pval_table{$rl} = 0;
+		if (-e $file and -s $file == (22*$rl + 1)*23*8) {
+			open(my $fh_pt, '<:raw', $file) or die "Cannot open the p-value table $file\n";
+			local $/;
+			my $data = <$fh_pt>;
+			close $fh_pt;
+			$pval_table{$rl} = [unpack('d<*', $data)];
+		}
+	}
+	return $pval_table{$rl};
+}
+
 sub merge_files {
 	my ($file_ref,$output) = @_;
 	my %file = ();
@@ -918,3 +925,8 @@ sub top3_phase_judge {
 ## Removed -k mode in bowtie and added -a, replaced -n mode with -v and added -m ceiling. 
 ## In case of transcriptome/scaffold version -m ceiling is kept high as these can match to multiple isoforms
 ## Cleaned up a little
+## hm_chen uses precomputed p-value table from phasdetect (-pt), when available
+## Added streaming mode (-st), bowtie alignments are read from pipe instead of a temporary file
+## Clusters for all p-value cutoffs are made in a single pass over the scored file, no per-cutoff temp files
+## Alignments made by phasdetect can be given as a file (-al), bowtie is not run then
+## '-al' also takes alignments made by phasdetect against a sharded index
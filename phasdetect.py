@@ -1,7 +1,7 @@
 #!/usr/local/bin/python3
 
 ## phasdetect   : identifies phased siRNA clusters
-## Updated      : version-v1.07 24/04/17 
+## Updated      : version-v1.08 18/10/26 
 ## author       : kakrana@udel.edu
 
 ## Copyright (c): 2016, by University of Delaware
@@ -11,12 +11,14 @@
 
 #### FUNCTIONS ###########################################
 
-import os,sys,subprocess,multiprocessing,time,getpass,shutil,hashlib,datetime,collections,re,argparse
+import os,sys,subprocess,multiprocessing,time,getpass,shutil,hashlib,datetime,collections,re,argparse,struct,pickle,queue,fcntl,threading,itertools,heapq,zlib,gzip,json,resource,array,mmap
 from importlib.machinery import SourceFileLoader
 from multiprocessing import Process, Queue, Pool
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import check_output
 import os.path
 from os.path import expanduser
+from phastpk import tagPack,tagUnpack
 # from dedup import dedup_main,dedup_process,dedup_fastatolist,deduplicate,dedup_writer
 
 #### USER SETTINGS ########################################
@@ -26,6 +28,14 @@ from os.path import expanduser
 setFile         = "phasis.set"
 memFile         = "phasis.mem"
 res_folder      = "phased_%s"   % (datetime.datetime.now().strftime("%m_%d_%H_%M"))
+anc_folder      = "ancillary"                       ## Ancillary data that is reused between runs, like p-value tables
+hashJobs        = {}                                ## Background hashing - file:result of hash pool
+hashPool        = None                              ## Processes for background hashing, made before other pools and threads
+libOrigin       = {}                                ## Output prefix:(user library,hash) for completion markers
+runKey          = ''                                ## Parameters deciding results, recorded in run manifest and markers
+nconc           = 0                                 ## Libraries phased in parallel, from concPlanner - 0: cores/threads
+stageFile       = ''                                ## JSON-lines log of stages with time and resource use, next to runtime file
+alignIndex      = ''                                ## Index hash of run, part of alignment cache key - empty: cache not used
 home            = expanduser("~")
 phaster_path    = "%s/.phasis" % (home)
 
@@ -35,6 +45,14 @@ PARE            = 'GuturGu'                         ## If deg = 'Y' then File fo
 
 ## ADVANCED SETTINGS #######################################
 cores           = 0                                 ## 0: Most cores considered as processor pool | 1-INTEGER: Cores to be considered for pool
+index_cache     = ""                                ## Bowtie indexes shared between runs, keyed by reference content and build parameters - empty: index_cache in phaster path
+index_quota     = 200                               ## Disk quota (GB) for index cache, least recently used indexes are evicted
+align_cache     = ""                                ## Alignments of libraries shared between runs and engines, keyed by library, index and bowtie parameters - empty: align_cache in phaster path
+align_quota     = 50                                ## Disk quota (GB) for alignment cache, least recently used alignments are evicted
+index_share     = 0.5                               ## Fraction of cores for index stage while libraries are de-duplicated, rest are for de-duplication
+hash_jobs       = 2                                 ## Processes hashing reference and libraries in background while libraries are de-duplicated - 0: hashed when needed
+dedup_mem       = 8                                 ## Memory budget (GB) for de-duplication of FASTA libraries, tags are spilled to disk beyond it
+mem_use         = 0.8                               ## Fraction of available memory (cgroup limit or MemAvailable) that parallel libraries can use
 # nthread         = 3                                 ## Threads perprocess
 # server          = "tarkan.ddpsc.org"              ## Server to use to fetch library information and smallRNA libraries
 # perl            = "/usr/local/bin/perl_5.18"        ## Josh updated the perl on Tarkan and its not ready yet for PHAS script FORK is missing and somemore modules -Check with Pingchuan help
@@ -50,9 +68,72 @@ parser      = argparse.ArgumentParser()
 parser.add_argument('--lowmem', action='store_true', default=True, help=
     'Flag to reduce memory usage for large genomes. Using this flag'\
     'will increase the runtime for phaser')
+parser.add_argument('--no-lowmem', dest='lowmem', action='store_false', help=
+    'Turn off --lowmem, indexes are built with --noauto --dcv 256 --bmaxdivn 6 settings of'\
+    ' bowtie-build. Shard indexes of --shards are built with same settings')
+parser.add_argument('--engine', default='perl', choices=['perl','numpy'], help=
+    'Phasing engine to score sRNAs. perl: phasis-core scripts (default) | numpy: '\
+    'in-process scorer, writes same results as phasis-core and needs numpy')
+parser.add_argument('--stream', action='store_true', default=False, help=
+    'Streaming mode, bowtie alignments are read from pipe as these are produced'\
+    ' and never written to disk')
+parser.add_argument('--schedule', action='store_true', default=False, help=
+    'Chromosome level scheduling with numpy engine. Libraries are aligned first and '\
+    'scoring of all libraries runs as (library, chromosome, register) units in one pool. '\
+    'Transcripts and scaffolds are sharded to units balanced by sRNA hits')
+parser.add_argument('--union', action='store_true', default=False, help=
+    'Align union of unique tags from all libraries once with numpy engine, alignments'\
+    ' of each library are derived from the cached tag:hits table')
+parser.add_argument('--resume', default=None, metavar='RESFOLDER', help=
+    'Resume an earlier run in its results folder. Libraries with complete and verified'\
+    ' results are skipped, missing or failed ones are phased again')
+parser.add_argument('--add', default=None, metavar='RESFOLDER', help=
+    'Add libraries to results folder of an earlier run. Reference, index and settings must'\
+    ' match that run, only new libraries are phased and phasmerge can summarize all of them')
+parser.add_argument('--clusterbin', action='store_true', default=False, help=
+    'Write a binary companion (.cluster.bin) of each .cluster file - columnar arrays, cluster'\
+    ' offsets and string table that can be memory-mapped instead of parsing text')
+parser.add_argument('--pack', nargs='+', default=None, metavar='LIB', help=
+    'Convert tag count (.txt) or de-duplicated FASTA (.fas) libraries to packed 2-bit format'\
+    ' (.tpk) that is memory-mapped by phasmerge, and exit')
+parser.add_argument('--unpack', nargs='+', default=None, metavar='TPK', help=
+    'Convert packed libraries (.tpk) back to the format these were packed from, and exit')
+parser.add_argument('--purge', action='store_true', default=False, help=
+    'Remove all cached library alignments (align_cache), report space freed and exit')
+parser.add_argument('--shards', type=int, default=0, metavar='N', help=
+    'Split cleaned reference to N shards balanced by length and build shard indexes in parallel,'\
+    ' for draft assemblies with many scaffolds. Libraries are mapped against all shards together'\
+    ' and hits are merged with the multimapper ceiling applied across shards')
+parser.add_argument('--pvalbench', action='store_true', default=False, help=
+    'Benchmark p-value table lookup against per-call evaluation, and exit')
 
 args = parser.parse_args()
 
+if args.engine == 'numpy':
+    try:
+        import numpy as np
+    except ImportError:
+        pass ## Reported by checkDependency
+
+if args.schedule and args.engine != 'numpy':
+    print("** '--schedule' splits work for in-process scorer, use it with '--engine numpy'")
+    sys.exit()
+
+if args.union and args.engine != 'numpy':
+    print("** '--union' joins alignments in-process, use it with '--engine numpy'")
+    sys.exit()
+
+if args.shards < 0:
+    print("** '--shards' is the number of reference shards, use 0 or more")
+    sys.exit()
+
+if args.resume and args.add:
+    print("** Use either '--resume' or '--add' with a results folder, not both")
+    sys.exit()
+
+if args.resume or args.add:
+    res_folder  = (args.resume or args.add).rstrip('/')
+
 def checkUser():
     '''
     Checks if user is authorized to use script
@@ -181,6 +262,15 @@ def checkDependency():
         goSignal    = False
         # print("See README for how to INSTALL")
 
+    ### Check numpy, only if in-process engine is selected
+    if args.engine == 'numpy':
+        try:
+            import numpy
+            print("--numpy (python)                 : found")
+        except ImportError:
+            print("--numpy (python)                 : missing")
+            goSignal    = False
+
     if goSignal == False:
         print("\n** Please install the missing libraries before running the analyses")
         # print("See README for how to install these")
@@ -250,7 +340,7 @@ def readSet(setFile):
                 elif param.strip() == '@libFormat':
                     global libFormat
                     libFormat = str(value.strip())
-                    if (libFormat != "T") and (libFormat != "F"):
+                    if (libFormat != "T") and (libFormat != "F") and (libFormat != "Q"):
                         print("Please input correct setting for '@libFormat' parameter in 'phasis.set' file")
                         print("Script will exit for now\n")
                         sys.exit()
@@ -259,8 +349,8 @@ def readSet(setFile):
 
                 elif param.strip() == '@phase':
                     global phase
-                    phase = int(value.strip())
-                    print('User Input for phase length      :',phase)
+                    phase = [int(x) for x in value.strip().split(',') if x.strip() != '' ] ## One or more registers, scored in same run
+                    print('User Input for phase length      :',",".join(str(x) for x in phase))
                 
                 elif param.strip() == '@path_prepro_git':
                     global phaster_path
@@ -296,6 +386,18 @@ def readSet(setFile):
     # sys.exit()
     return libs
 
+def cacheDirs():
+    '''
+    Caches default to phaster path, which is known only after settings are read
+    '''
+    global index_cache,align_cache
+    if not index_cache:
+        index_cache = "%s/index_cache" % (phaster_path)
+    if not align_cache:
+        align_cache = "%s/align_cache" % (phaster_path)
+
+    return None
+
 def PHASBatch(con,libs,runType,index,deg):
     '''
     ## Deprecated
@@ -313,7 +415,7 @@ def PHASBatch(con,libs,runType,index,deg):
         
         pro_file    = path[0][0].replace('$ALLDATA', '/alldata')###Processed sRNA file
         out_file    = '%s.txt' % (lib)
-        rl          = str(phase)
+        rl          = ",".join(str(x) for x in phase) ## Comma separated for core-scripts
         nproc2      = str(nproc)
         sRNAratio   = str(75)
         print (pro_file)
@@ -394,27 +496,47 @@ def PHASBatch2(aninput):
     pro_file    = lib ### sRNA input file 
     out_file    = './%s/%s.txt' % (res_folder,lib.rpartition(".")[0]) ## Output file suffix
     
-    rl          = str(phase)
+    rl          = ",".join(str(x) for x in phase) ## Comma separated for core-scripts
+    alnFile     = alignCacheFile(lib) ## Alignments are shared with numpy engine
+    if alnFile:
+        alignFile   = alignCacheMap(lib,index,nthread,out_file,alnFile)
+        alignL      = ["-al",alignFile]
+    elif len(indexShards(index)) > 1: ## phasis-core maps to a single index, alignments to shards are made here
+        if libFormat == "T":
+            fastaFile   = tagsToFASTA(lib,"%s.tags.fa" % (out_file))
+        else:
+            fastaFile   = lib
+        alignFile   = bowtieMap(fastaFile,index,nthread,"%s.map" % (out_file))
+        if fastaFile != lib:
+            os.remove(fastaFile)
+        alignL      = ["-al",alignFile]
+    else:
+        alignL      = []
     # nproc2 = str(nproc)
     nthread     = str(nthread)
     sRNAratio   = str(75)
     noiseLimit  = str(minDepth-1)
     # mismat      = str(mismat)
     clustBuffer = str(clustBuffer)
+    if args.stream and not alignL:
+        streamL = ["-st"]   ## Alignments read from bowtie pipe
+    else:
+        streamL = []
     print(pro_file)
 
+    amark       = stageMark()
     if runType == 'G':### Uses Whole genome as input
         full_path = "%s/phasclust.genome.v2.pl" % (phaster_path)
         # print(full_path)
         if deg == 'Y':
-            retcode = subprocess.call([perl, "%s/phasclust.genome.v2.pl" % (phaster_path), "-i", pro_file, "-q", PARE, "-f", "-t", sRNAratio, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
+            retcode = subprocess.call([perl, "%s/phasclust.genome.v2.pl" % (phaster_path), "-i", pro_file, "-q", PARE, "-f", "-t", sRNAratio, "-d", index, "-px", out_file, "-rl", rl, "-pt", anc_folder, "-cpu", nthread]+streamL+alignL)
         else:
             if libFormat == "T":
                 aformat = "t"
-                retcode = subprocess.call([perl, "%s/phasclust.genome.v2.pl" % (phaster_path), "-i", pro_file,"-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-g", clustBuffer, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
+                retcode = subprocess.call([perl, "%s/phasclust.genome.v2.pl" % (phaster_path), "-i", pro_file,"-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-g", clustBuffer, "-d", index, "-px", out_file, "-rl", rl, "-pt", anc_folder, "-cpu", nthread]+streamL+alignL)
             elif libFormat == "F":
                 aformat = "f"
-                retcode = subprocess.call([perl, "%s/phasclust.genome.v2.pl" % (phaster_path), "-i", pro_file,"-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-g", clustBuffer, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
+                retcode = subprocess.call([perl, "%s/phasclust.genome.v2.pl" % (phaster_path), "-i", pro_file,"-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-g", clustBuffer, "-d", index, "-px", out_file, "-rl", rl, "-pt", anc_folder, "-cpu", nthread]+streamL+alignL)
             else:
                 print("** Invalid '@libFormat' parameter value")
                 print("** Please check the '@libFormat' parameter value in setting file")
@@ -426,14 +548,14 @@ def PHASBatch2(aninput):
         full_path = "%s/phasclust.MUL.v2.pl" % (phaster_path)
         # print(full_path)        
         if deg == 'Y':
-            retcode = subprocess.call([perl, "%s/phasclust.MUL.v2.pl" % (phaster_path), "-i", pro_file, "-q", PARE, "-f", "-t", sRNAratio, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
+            retcode = subprocess.call([perl, "%s/phasclust.MUL.v2.pl" % (phaster_path), "-i", pro_file, "-q", PARE, "-f", "-t", sRNAratio, "-d", index, "-px", out_file, "-rl", rl, "-pt", anc_folder, "-cpu", nthread]+streamL+alignL)
         else:   
             if libFormat == "T":
                 aformat = "t"
-                retcode = subprocess.call([perl, "%s/phasclust.MUL.v2.pl" % (phaster_path), "-i", pro_file, "-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-g", clustBuffer, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
+                retcode = subprocess.call([perl, "%s/phasclust.MUL.v2.pl" % (phaster_path), "-i", pro_file, "-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-g", clustBuffer, "-d", index, "-px", out_file, "-rl", rl, "-pt", anc_folder, "-cpu", nthread]+streamL+alignL)
             elif libFormat == "F":
                 aformat = "f"
-                retcode = subprocess.call([perl, "%s/phasclust.MUL.v2.pl" % (phaster_path), "-i", pro_file,"-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-g", clustBuffer, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
+                retcode = subprocess.call([perl, "%s/phasclust.MUL.v2.pl" % (phaster_path), "-i", pro_file,"-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-g", clustBuffer, "-d", index, "-px", out_file, "-rl", rl, "-pt", anc_folder, "-cpu", nthread]+streamL+alignL)
             else:
                 print("** Invalid '@libFormat' parameter value")
                 print("** Please check the '@libFormat' parameter value in setting file")
@@ -441,6 +563,9 @@ def PHASBatch2(aninput):
                 print("** Script will exit now")
                 sys.exit()
 
+    stageLog("phasisCore",lib,amark,retcode)
+    if alignL:
+        os.remove(alignFile)
     if retcode == 0:
         pass
     else:
@@ -467,6 +592,7 @@ def PPResults(module,alist):
     res     = npool.map_async(module, alist)
     results = (res.get())
     npool.close()
+    npool.join() ## Workers are reaped, so these count in resource use of children
     return results
 
 def PPBalance(module,alist):
@@ -477,6 +603,8 @@ def PPBalance(module,alist):
     start       = time.time()
     ##PP is being used for Bowtie mappings - This will avoid overflooding of processes to server
     nprocPP     = round((nproc/int(nthread))) 
+    if nconc:
+        nprocPP = nconc ## Planned against memory too
     if nprocPP  < 1:
         nprocPP = 1 ## 1 here so as to avoid 0 processor being allocated in serial mode
     else:
@@ -484,28 +612,207 @@ def PPBalance(module,alist):
 
     print("nprocPP                          : %s" % (nprocPP))
     npool = Pool(int(nprocPP))
-    npool.map(module, alist)
+    results = npool.map(module, alist)
+    npool.close()
+    npool.join() ## Workers are reaped, so these count in resource use of children
+
+    return results
+
+def concPlanner(libs,genoIndex):
+    '''
+    Plans libraries phased in parallel and threads for each from both core pool and memory.
+    Memory of a library is estimated from index size (loaded by each bowtie) and its unique
+    tags (alignments held by phasis-core), the largest libraries are assumed to run together
+    '''
+    print ("\n#### Fn: Concurrency planner ################")
+    tagBytes    = 1024          ## Memory for a unique tag and its alignments in phasis-core
+    baseBytes   = 300*1024**2   ## Interpreter, buffers and pipes of one instance
+
+    idxBytes    = 0
+    afolder,_,aprefix = genoIndex.rpartition("/")
+    for afile in os.listdir(afolder or "."):
+        if afile.startswith("%s." % (aprefix)) and afile.endswith((".ebwt",".ebwtl")):
+            idxBytes += os.path.getsize("%s/%s" % (afolder or ".",afile))
+
+    memL        = sorted((idxBytes+baseBytes+tagBytes*libTagsEstimate(alib) for alib in libs), reverse=True)
+    memAvail    = memLimit()*mem_use
+
+    nconcMem    = 0     ## Libraries that fit in memory
+    memNeed     = 0
+    for amem in memL:
+        if memNeed+amem > memAvail:
+            break
+        memNeed += amem
+        nconcMem += 1
+    if nconcMem == 0:
+        print("** Memory available (%.1fGB) may not be enough for one library (%.1fGB), expect swapping" % (memAvail/1024**3,memL[0]/1024**3))
+        nconcMem = 1
+
+    aconc       = max(1,min(len(libs),int(nproc),nconcMem))
+    athread     = max(1,int(nproc)//aconc)
+
+    print("Memory available for libraries   : %.1fGB | Index: %.1fGB | Largest library: %.1fGB" % (memAvail/1024**3,idxBytes/1024**3,memL[0]/1024**3))
+    print("\n#### %s computing core(s) reserved for analysis ##########" % (str(nproc)))
+    print("#### %s libraries in parallel, %s core(s) for each #######\n" % (aconc,athread))
+
+    return athread,aconc
+
+def libOrder(libs):
+    '''
+    Orders libraries longest processing time first, work of a library is estimated from
+    its unique tags. Returns ordered libraries and their work
+    '''
+    workD       = dict((alib,libTagsEstimate(alib)) for alib in libs)
+    libL        = sorted(libs,key=lambda x: -workD[x])
 
-def optimize(nproc):
+    return libL,[workD[x] for x in libL]
+
+def libShare(amanager,workL):
+    '''
+    Cores shared by phasing and de-duplication of libraries in pool workers - (lock, [used
+    cores, running, dedup cores, started flag of each library], work of libraries, core
+    budget). Made on a manager, so that stages get it as argument
+    '''
+    return amanager.Lock(),amanager.list([0]*(3+len(workL))),list(workL),int(nproc)
+
+def libThreads(ashare,apos,aconc):
+    '''
+    Bowtie threads for library starting at position apos of longest-first order. Free cores
+    are shared with the longest libraries yet to start that fill the other free slots of
+    aconc libraries in parallel, in proportion to their work - so the queue's tail and the
+    large libraries at its head get more threads. Cores of libraries still being
+    de-duplicated are not free
+    '''
+    alock,astate,workL,ncores = ashare
+    alock.acquire()
+    stateL      = astate[:] ## One read of shared counters
+    used,running = stateL[0],stateL[1]
+    afree       = ncores-used-stateL[2]
+    aslots      = max(1,aconc-running)
+    awork       = max(1,workL[apos])
+    waitL       = [max(1,x) for i,x in enumerate(workL) if i != apos and not stateL[3+i]] ## Longest first
+    nextWork    = sum(waitL[:aslots-1])
+    athread     = max(1,min(afree,int(afree*awork/(awork+nextWork))))
+    astate[0]   = used+athread
+    astate[1]   = running+1
+    astate[3+apos] = 1
+    alock.release()
+
+    return athread
+
+def libThreadsFree(ashare,athread):
+    '''
+    Returns cores of a finished library to phasing pool
+    '''
+    alock,astate,workL,ncores = ashare
+    alock.acquire()
+    astate[0]  -= athread
+    astate[1]  -= 1
+    alock.release()
+
+    return None
+
+def libThreadsDedup(ashare,athread):
     '''
-    dirty optimization of threads per library
+    Adds (or with negative athread, returns) cores of a library being de-duplicated,
+    so that phasing libraries leave these to it
     '''
+    if ashare is None: ## Conversion outside of phasing DAG
+        return None
+    alock,astate,workL,ncores = ashare
+    alock.acquire()
+    astate[2]  += athread
+    alock.release()
 
-    nlibs       = len(libs)
-    ninstances  = int(nproc/nlibs) ### Number of parallel instances to use
-    # print("Libs:%s | nproc:%s | ninstance:%s" % (nlibs,nproc,ninstances))
+    return None
 
-    if ninstances > 3:
-        nthread = ninstances
+def libTagsEstimate(alib):
+    '''
+    Estimates unique tags in a tag count or de-duplicated FASTA library from its size, and
+    bytes per tag in first MB. Libraries planned before conversion are FASTA/FASTQ reads, 
+    plain or compressed - reads are counted as tags, an upper bound
+    '''
+    fh_in       = open(alib,'rb')
+    if fh_in.read(2) == b'\x1f\x8b':
+        fh_in.seek(0)
+        fh_gz   = gzip.GzipFile(fileobj=fh_in)
+        try:
+            ablock  = fh_gz.read(1048576)
+        except (OSError,EOFError,zlib.error): ## Corrupt file, reported by de-duplicater
+            ablock  = b''
+        asize   = os.path.getsize(alib)*len(ablock)/max(1,fh_in.tell()) ## Uncompressed size from ratio of first block
+        fh_gz.close()
     else:
-        nthread = 3
+        fh_in.seek(0)
+        ablock  = fh_in.read(1048576)
+        asize   = os.path.getsize(alib)
+    fh_in.close()
+    nlines      = max(1,ablock.count(b'\n'))
+    if ablock.startswith(b'>'):
+        nlines  = max(1,nlines//2) ## Header and sequence
+    elif ablock.startswith(b'@'):
+        nlines  = max(1,nlines//4) ## FASTQ record
 
-    print("\n#### %s computing core(s) reserved for analysis ##########" % (str(nproc)))
-    print("#### %s computing core(s) assigned to one lib ############\n" % (str(nthread)))
-    # time.sleep(1)
+    return int(asize*nlines/max(1,len(ablock)))
+
+def memLimit():
+    '''
+    Memory (bytes) this run can use - least of memory left in cgroup (v2 or v1) and
+    MemAvailable of machine
+    '''
+    limitL      = []
+    fh_in       = open("/proc/meminfo",'r')
+    for line in fh_in:
+        if line.startswith("MemAvailable:"):
+            limitL.append(int(line.split()[1])*1024)
+    fh_in.close()
+
+    cgroupD     = {} ## controller:path
+    if os.path.isfile("/proc/self/cgroup"):
+        fh_in   = open("/proc/self/cgroup",'r')
+        for line in fh_in:
+            ent = line.rstrip("\n").split(":",2)
+            if len(ent) == 3:
+                for actrl in ent[1].split(","):
+                    cgroupD[actrl] = ent[2]
+        fh_in.close()
+
+    ## Path of cgroup can be hidden in containers, mount root is used then
+    for adir,amax,aused in ((cgroupD.get("",None),"memory.max","memory.current"),
+            (cgroupD.get("memory",None),"memory.limit_in_bytes","memory.usage_in_bytes")):
+        if adir is None:
+            continue
+        aroot   = "/sys/fs/cgroup" if amax == "memory.max" else "/sys/fs/cgroup/memory"
+        for apath in ("%s%s" % (aroot,adir),aroot):
+            if os.path.isfile("%s/%s" % (apath,amax)) and os.path.isfile("%s/%s" % (apath,aused)):
+                alimit  = open("%s/%s" % (apath,amax)).read().strip()
+                ausage  = open("%s/%s" % (apath,aused)).read().strip()
+                if alimit.isdigit() and int(alimit) < 1<<60: ## 'max' or huge value if no limit
+                    limitL.append(max(0,int(alimit)-int(ausage)))
+                break
+
+    return min(limitL)
+
+def cpuLimit():
+    '''
+    Cores this run can use - least of CPU affinity and cgroup CPU quota
+    '''
+    if hasattr(os,"sched_getaffinity"):
+        ncores  = len(os.sched_getaffinity(0))
+    else:
+        ncores  = int(multiprocessing.cpu_count())
 
+    for aquota,aperiod in (("/sys/fs/cgroup/cpu.max",None),("/sys/fs/cgroup/cpu/cpu.cfs_quota_us","/sys/fs/cgroup/cpu/cpu.cfs_period_us")):
+        if not os.path.isfile(aquota):
+            continue
+        ent     = open(aquota).read().split()
+        if aperiod:
+            ent.append(open(aperiod).read().strip())
+        if len(ent) >= 2 and ent[0].isdigit() and int(ent[0]) > 0:
+            ncores = min(ncores,max(1,-(-int(ent[0])//int(ent[1])))) ## Ceil of quota/period
+        break
 
-    return nthread 
+    return ncores
 
 def inputList(libs,runType,index,deg,nthread,noiseLimit,hitsLimit,clustBuffer):
     '''generate raw inputs for parallel processing'''
@@ -518,9 +825,10 @@ def inputList(libs,runType,index,deg,nthread,noiseLimit,hitsLimit,clustBuffer):
 
     return rawInputs
 
-def indexBuilder(reference):
+def indexBuilder(reference,indexFolder,acores=None,apool=None):
     '''
-    Generic index building module
+    Generic index building module, index is made in the given folder. acores are cores
+    for index (all by default), apool is a pool of these made by caller for cleaning
     '''
        
     print ("\n#### Fn: indexBuilder #######################")
@@ -536,24 +844,20 @@ def indexBuilder(reference):
     #####################################
 
     ### Clean reference ################
-    fastaclean,fastasumm = FASTAClean(reference,0)
+    fastaclean,fastasumm = FASTAClean(reference,0,acores,apool)
 
     ### Prepare Index ##################
-    print ("**Deleting old index 'folder' !!!!!!!!!!!**")
-    shutil.rmtree('./index', ignore_errors=True)
-    os.mkdir('./index')
-    
-    genoIndex   = '%s/index/%s' % (os.getcwd(),fastaclean.rpartition('/')[-1].rpartition('.')[0]) ## Can be merged with genoIndex from earlier part if we use bowtie2 earlier
+    genoIndex   = '%s/%s' % (os.path.abspath(indexFolder),fastaclean.rpartition('/')[-1].rpartition('.')[0]) ## Can be merged with genoIndex from earlier part if we use bowtie2 earlier
     # genoIndex   = './index/%s' % (fastaclean.rpartition('/')[-1].rpartition('.')[0]) ## Alternative approach -Can be merged with genoIndex from earlier part if we use bowtie2 earlier
     print('Creating index of cDNA/genomic sequences:%s**\n' % (genoIndex))
-    adcv        = "256"
-    divn        = "6"
 
     ### Run based on input about the memory
-    if args.lowmem:
-        retcode     = subprocess.call(["bowtie-build","-f", fastaclean, genoIndex])
+    amark       = stageMark()
+    if args.shards > 1:
+        retcode = indexShardBuild(fastaclean,fastasumm,genoIndex,args.shards,acores)
     else:
-        retcode     = subprocess.call(["bowtie-build","-f", "--noauto", "--dcv", adcv,"--bmaxdivn", divn, fastaclean, genoIndex])
+        retcode = subprocess.call(["bowtie-build","-f"]+indexParams()+[fastaclean, genoIndex])
+    stageLog("indexBuild",reference,amark,retcode)
     
     if retcode == 0:## The bowtie mapping exit with status 0, all is well
         # print("Reference index prepared sucessfully")
@@ -572,143 +876,374 @@ def indexBuilder(reference):
     # fh_in1.close()
     ##########################################
 
-    ### Make a memory file ###################
-    fh_out      = open(memFile,'w')
-    # print("Generating MD5 hash for reference")
-    refHash     = (hashlib.md5(open('%s' % (reference),'rb').read()).hexdigest()) ### reference hash used instead of cleaned FASTA because while comparing only the user input reference is available
-    
-    print("Generating MD5 hash for Bowtie index")
-    if os.path.isfile("%s.1.ebwtl" % (genoIndex)):
-        indexHash   = (hashlib.md5(open('%s.1.ebwtl' % (genoIndex),'rb').read()).hexdigest())
-    elif os.path.isfile("%s.1.ebwt" % (genoIndex)):
-        indexHash   = (hashlib.md5(open('%s.1.ebwt' % (genoIndex),'rb').read()).hexdigest())
-    else:
-        print("File extension for index couldn't be determined properly")
-        print("It could be an issue from Bowtie")
-        print("This needs to be reported to 'PHASIS' developer - Script will exit")
-        sys.exit()
-
-    print("\n@genomehash:%s | @indexhash:%s" % (refHash, indexHash) )
-    fh_out.write("@timestamp:%s\n" % (datetime.datetime.now().strftime("%m_%d_%H_%M")))
-    fh_out.write("@genomehash:%s\n" % (refHash))
-    fh_out.write("@index:%s\n" % (genoIndex))
-    fh_out.write("@indexhash:%s\n" % (indexHash))
-
     print("Index prepared:%s\n" % (genoIndex))
 
     # sys.exit()
     
     return genoIndex
 
-def indexBuilder2(reference,fastaclean):
+def indexShardBuild(fastaclean,fastasumm,genoIndex,nshards,acores=None):
     '''
-    Prepared to work with parallelized version of FASTA cleaner - Not implemented yet - because parallel FASTA
-    cleaner is slow on bigger genomes - need trouble shooting
+    Sharded index - cleaned reference is partitioned to shards balanced by length and shard 
+    indexes are made in parallel on acores (all by default), these are listed in '<index>.shards'.
+    Returns exit code of a failed bowtie-build, 0 if all are made
     '''
-    
-    
-    print ("\n#### Fn: indexBuilder #######################")
+    shardL      = FASTAPartition(fastaclean,fastasumm,nshards)
+    if len(shardL) == 1: ## Too few entries to shard
+        return subprocess.call(["bowtie-build","-f"]+indexParams()+[fastaclean, genoIndex])
+
+    indexL      = ["%s.s%s" % (genoIndex,i) for i in range(len(shardL))]
+    print("Building %s shard indexes in parallel" % (len(shardL)))
+    apool       = ThreadPoolExecutor(max_workers=max(1,min(len(shardL),int(acores or nproc))))
+    retcodes    = list(apool.map(lambda x: subprocess.call(["bowtie-build","-f"]+indexParams()+list(x),stdout=subprocess.DEVNULL),zip(shardL,indexL)))
+    apool.shutdown()
+    for ashard in shardL:
+        os.remove(ashard)
+
+    retcode     = next((x for x in retcodes if x != 0),0)
+    if retcode == 0:
+        fh_out  = open("%s.shards" % (genoIndex),'w')
+        for aindex in indexL:
+            fh_out.write("%s\n" % (aindex.rpartition('/')[-1])) ## Relative, cache entry is renamed
+        fh_out.close()
 
-    ### Prepare Index ##################
-    print ("**Deleting old index 'folder' !!!!!!!!!!!**")
-    shutil.rmtree('./index', ignore_errors=True)
-    os.mkdir('./index')
-    
-    genoIndex   = '%s/index/%s' % (os.getcwd(),fastaclean.rpartition('/')[-1].rpartition('.')[0]) ## Can be merged with genoIndex from earlier part if we use bowtie2 earlier
-    # genoIndex   = './index/%s' % (fastaclean.rpartition('/')[-1].rpartition('.')[0]) ## Alternative approach -Can be merged with genoIndex from earlier part if we use bowtie2 earlier
-    print('Creating index of cDNA/genomic sequences:%s**\n' % (genoIndex))
+    return retcode
+
+def indexShards(genoIndex):
+    '''
+    Shard indexes of a sharded index, listed in its '.shards' file - or the index itself
+    '''
+    shardFile   = "%s.shards" % (genoIndex)
+    if not os.path.isfile(shardFile):
+        return [genoIndex]
+
+    shardL      = []
+    fh_in       = open(shardFile,'r')
+    for line in fh_in:
+        if line.strip():
+            shardL.append(os.path.join(os.path.dirname(genoIndex),line.strip()))
+    fh_in.close()
+
+    return shardL
+
+def indexExists(genoIndex):
+    '''
+    Checks that index, or all shards of a sharded index, are made
+    '''
+    for ashard in indexShards(genoIndex):
+        if not (os.path.isfile("%s.1.ebwt" % (ashard)) or os.path.isfile("%s.1.ebwtl" % (ashard))):
+            return False
+
+    return True
+
+def indexParams():
+    '''
+    bowtie-build parameters, these are part of the index cache key
+    '''
     adcv        = "256"
     divn        = "6"
 
-    ### Run based on input about the memory
     if args.lowmem:
-        retcode     = subprocess.call(["bowtie-build","-f", fastaclean, genoIndex])
+        return []
     else:
-        retcode     = subprocess.call(["bowtie-build","-f", "--noauto", "--dcv", adcv,"--bmaxdivn", divn, fastaclean, genoIndex])
-    
-    if retcode == 0:## The bowtie mapping exit with status 0, all is well
-        # print("Reference index prepared sucessfully")
-        pass
+        return ["--noauto", "--dcv", adcv,"--bmaxdivn", divn]
+
+def indexHasher(genoIndex):
+    '''
+    MD5 hash of bowtie index
+    '''
+    print("Generating MD5 hash for Bowtie index")
+    hashL       = [] ## Hash of each shard
+    for ashard in indexShards(genoIndex):
+        if os.path.isfile("%s.1.ebwtl" % (ashard)):
+            hashL.append(fileHash('%s.1.ebwtl' % (ashard)))
+        elif os.path.isfile("%s.1.ebwt" % (ashard)):
+            hashL.append(fileHash('%s.1.ebwt' % (ashard)))
+        else:
+            print("File extension for index couldn't be determined properly")
+            print("It could be an issue from Bowtie")
+            print("This needs to be reported to 'PHASIS' developer - Script will exit")
+            sys.exit()
+
+    if len(hashL) == 1:
+        indexHash   = hashL[0]
     else:
-        print("There is some problem preparing index of reference '%s'" %  (reference))
-        print("Is 'Bowtie' installed? And added to environment variable?")
-        print("Script will exit now")
+        indexHash   = hashlib.md5("|".join(hashL).encode()).hexdigest()
+
+    return indexHash
+
+def fileHash(afile):
+    '''
+    MD5 hash of file, read in fixed size chunks so memory use is capped. A stat fingerprint
+    (size, mtime, ctime, inode and sampled blocks) is checked first against hash memory, and full hashing
+    is skipped if file is unchanged. Hash started by hashStart is collected here, file is
+    hashed again if background hashing failed
+    '''
+    if afile in hashJobs: ## Hashed in background
+        aresult = hashJobs.pop(afile)
+        try:
+            return aresult.get()
+        except Exception as err:
+            print("** Background hashing of %s failed (%s) - hashed again" % (afile,err))
+
+    hash_chunk  = 8*1024**2 ## Bytes read at a time
+    apath       = os.path.abspath(afile)
+    aprint      = fileFingerprint(afile)
+    memD        = hashMemRead()
+    if apath in memD and memD[apath][0] == aprint:
+        print("File unchanged, hash re-used     : %s" % (afile))
+        return memD[apath][1]
+
+    print("Generating MD5 hash for %s" % (afile))
+    amd5        = hashlib.md5()
+    fh_in       = open(afile,'rb')
+    while True:
+        achunk  = fh_in.read(hash_chunk)
+        if not achunk:
+            break
+        amd5.update(achunk)
+    fh_in.close()
+    ahash       = amd5.hexdigest()
+
+    hashMemUpdate(apath,aprint,ahash)
+
+    return ahash
+
+def fileFingerprint(afile):
+    '''
+    Quick fingerprint of file from size, mtime, ctime, inode and three sampled blocks. A file
+    edited in place with its mtime put back still gets a new ctime, so it is hashed again
+    '''
+    blockSize   = 65536
+    astat       = os.stat(afile)
+    amd5        = hashlib.md5()
+    fh_in       = open(afile,'rb')
+    for aoffset in (0, astat.st_size//2, max(astat.st_size-blockSize,0)):
+        fh_in.seek(aoffset)
+        amd5.update(fh_in.read(blockSize))
+    fh_in.close()
+
+    return "%s:%s:%s:%s:%s" % (astat.st_size,astat.st_mtime_ns,astat.st_ctime_ns,astat.st_ino,amd5.hexdigest())
+
+def hashMemRead():
+    '''
+    Reads hash memory - file:(fingerprint,hash)
+    '''
+    memD        = {}
+    hashMem     = "%s/hash.mem" % (anc_folder)
+    if os.path.isfile(hashMem):
+        fh_in   = open(hashMem,'r')
+        for line in fh_in:
+            ent = line.rstrip("\n").split("\t")
+            if len(ent) == 3:
+                memD[ent[0]] = (ent[1],ent[2])
+        fh_in.close()
+
+    return memD
+
+def hashStop():
+    '''
+    Ends background hashing, hashes not collected by now are not needed
+    '''
+    global hashPool
+    if hashPool is not None:
+        hashPool.terminate()
+        hashPool.join()
+        hashPool    = None
+    hashJobs.clear()
+
+    return None
+
+def hashMemUpdate(apath,aprint,ahash):
+    '''
+    Adds a file to hash memory. Read and write are done under a lock so that updates of
+    background hashing and other runs are not lost, file is atomically replaced so that
+    readers see a complete file
+    '''
+    os.makedirs(anc_folder, exist_ok=True)
+    hashMem     = "%s/hash.mem" % (anc_folder)
+    fh_lock     = open("%s.lock" % (hashMem),'w')
+    fcntl.flock(fh_lock, fcntl.LOCK_EX)
+    memD        = hashMemRead()
+    memD[apath] = (aprint,ahash)
+    tmpFile     = "%s.%s.%s.tmp" % (hashMem,os.getpid(),threading.get_ident())
+    fh_out      = open(tmpFile,'w')
+    for bpath,(bprint,bhash) in memD.items():
+        fh_out.write("%s\t%s\t%s\n" % (bpath,bprint,bhash))
+    fh_out.close()
+    os.replace(tmpFile,hashMem)
+    fcntl.flock(fh_lock, fcntl.LOCK_UN)
+    fh_lock.close()
+
+    return None
+
+def hashStart(afile):
+    '''
+    Starts hashing file in background process, if hash_jobs is set. Hash pool is made at
+    first call, this is before any other pool or thread of run so nothing is forked mid-print
+    '''
+    global hashPool
+    if not hash_jobs or afile in hashJobs:
+        return None
+
+    if hashPool is None:
+        hashPool    = Pool(int(hash_jobs))
+    hashJobs[afile] = hashPool.apply_async(fileHash,(afile,))
+
+    return None
+
+def indexCache(reference,acores=None,apool=None):
+    '''
+    Content-addressed cache of bowtie indexes shared between runs and references. Index
+    is keyed by reference hash and bowtie-build parameters, made in a temporary folder
+    and published by atomic rename. Only one run builds an index, others wait and re-use it.
+    acores and apool are passed to indexBuilder
+    '''
+    print ("\n#### Fn: Index cache ########################")
+    ### Sanity check #####################
+    if not os.path.isfile(reference):
+        print("'%s' reference file not found" % (reference))
+        print("Please check the genomeFile - Is it in specified directory? Did you input wrong name?")
+        print("Script will exit for now\n")
         sys.exit()
-    ##########################################
+    else:
+        pass
+    #####################################
 
-    ### Test for index files #################
-    # ## Close this code if not testing
-    # fh_in1 = open("./index/Triticum_aestivum.TGACv1.dna.toplevel.clean.1.ebwtl",'w')
-    # fh_in1.write("Atul is a developer for PHASIS")
-    # fh_in1.close()
-    ##########################################
+    os.makedirs(index_cache, exist_ok=True)
+    refHash     = fileHash(reference) ### reference hash used instead of cleaned FASTA because while comparing only the user input reference is available
+    ashards     = "|shards%s" % (args.shards) if args.shards > 1 else "" ## Sharded indexes are kept apart
+    akey        = hashlib.md5(("%s|%s%s" % (refHash," ".join(indexParams()),ashards)).encode()).hexdigest()
+    entryDir    = "%s/%s" % (index_cache,akey)
+    print("Index cache key                  : %s" % (akey))
+
+    ### Lookup - build lock is held till index is marked in use, so that it is not evicted in between
+    fh_build    = open("%s/%s.lock" % (index_cache,akey),'w')
+    fcntl.flock(fh_build, fcntl.LOCK_EX)
+    genoIndex,indexHash = indexLookup(entryDir)
+    if genoIndex:
+        print("Index status                     : Re-use from cache")
+    else:
+        print("Index status                     : Make")
+        for afile in os.listdir(index_cache): ## Left by crashed builds, builder holds the lock
+            if afile.startswith(".tmp_%s_" % (akey)):
+                shutil.rmtree("%s/%s" % (index_cache,afile), ignore_errors=True)
+        tmpDir      = "%s/.tmp_%s_%s" % (index_cache,akey,os.getpid())
+        os.mkdir(tmpDir)
+        tmpIndex    = indexBuilder(reference,tmpDir,acores,apool)
+        fh_out      = open("%s/entry.mem" % (tmpDir),'w')
+        fh_out.write("@genomehash:%s\n" % (refHash))
+        fh_out.write("@index:%s\n" % (tmpIndex.rpartition('/')[-1]))
+        fh_out.write("@indexhash:%s\n" % (indexHasher(tmpIndex)))
+        fh_out.write("@params:%s\n" % (" ".join(indexParams())))
+        fh_out.write("@shards:%s\n" % (len(indexShards(tmpIndex))))
+        fh_out.close()
+        open("%s/last.use" % (tmpDir),'w').close()
+        if os.path.isdir(entryDir): ## Broken entry
+            shutil.rmtree(entryDir)
+        os.rename(tmpDir,entryDir)  ## Atomic publish
+        genoIndex,indexHash = indexLookup(entryDir)
+    fcntl.flock(fh_build, fcntl.LOCK_UN)
+    fh_build.close()
+
+    indexEvict(akey)
 
     ### Make a memory file ###################
     fh_out      = open(memFile,'w')
-    print("Generating MD5 hash for reference")
-    refHash     = (hashlib.md5(open('%s' % (reference),'rb').read()).hexdigest()) ### reference hash used instead of cleaned FASTA because while comparing only the user input reference is available
-    
-    print("Generating MD5 hash for Bowtie index")
-    if os.path.isfile("%s.1.ebwtl" % (genoIndex)):
-        indexHash   = (hashlib.md5(open('%s.1.ebwtl' % (genoIndex),'rb').read()).hexdigest())
-    elif os.path.isfile("%s.1.ebwt" % (genoIndex)):
-        indexHash   = (hashlib.md5(open('%s.1.ebwt' % (genoIndex),'rb').read()).hexdigest())
-    else:
-        print("File extension for index couldn't be determined properly")
-        print("It could be an issue from Bowtie")
-        print("This needs to be reported to 'PHASIS' developer - Script will exit")
-        sys.exit()
-
     print("\n@genomehash:%s | @indexhash:%s" % (refHash, indexHash) )
     fh_out.write("@timestamp:%s\n" % (datetime.datetime.now().strftime("%m_%d_%H_%M")))
     fh_out.write("@genomehash:%s\n" % (refHash))
     fh_out.write("@index:%s\n" % (genoIndex))
     fh_out.write("@indexhash:%s\n" % (indexHash))
+    fh_out.close()
 
-    print("Index prepared:%s\n" % (genoIndex))
-
-    # sys.exit()
-    
     return genoIndex
 
-def indexIntegrityCheck(index):
-    '''
-    Checks the integrity of index and the extension
-    '''
-    indexFolder     = index.rpartition("/")[0]
-    # print("This is the folder from earlier run:%s" % (indexFolder))
-    if os.path.isfile("%s.1.ebwtl" % (index)): ## Check if this extension exists in folder
-        indexExt    = "ebwtl"
-        indexFiles  = [i for i in os.listdir('%s' % (indexFolder)) if i.endswith('.ebwtl')]
-        if len(indexFiles) >= 6:
-            # print("Index has all six parts")
-            indexIntegrity = True
-
-    elif os.path.isfile("%s.1.ebwt" % (index)):
-        indexExt    = "ebwt"
-        indexFiles  = [i for i in os.listdir('%s' % (indexFolder)) if i.endswith('.ebwt')]
-        if len(indexFiles) >= 6:
-            # print("Index has all six parts")
-            indexIntegrity = True
-    else:
-        print("Existing index extension couldn't be determined")
-        print("Genome index will be remade")
-        indexExt        = False
-        indexIntegrity  = False
+def indexLookup(entryDir):
+    '''
+    Looks up published index in cache, and marks it in use. A shared lock on 'last.use' 
+    is held till end of run, its timestamp orders the eviction
+    '''
+    global indexLock
+    memEntry    = "%s/entry.mem" % (entryDir)
+    if not os.path.isfile(memEntry):
+        return False,False
+
+    entryD      = {}
+    fh_in       = open(memEntry,'r')
+    for line in fh_in:
+        if line.startswith('@'):
+            akey,aval = line.strip("\n").split(':',1)
+            entryD[akey.strip()] = aval.strip()
+    fh_in.close()
 
-    print("Ancillary data integrity         :",indexIntegrity)
-    # print("Number of files:%s" % (len(indexFiles)))
+    genoIndex   = "%s/%s" % (entryDir,entryD.get('@index',''))
+    if not indexExists(genoIndex):
+        print("Cached index is incomplete - it will be remade")
+        return False,False
+
+    useFile     = "%s/last.use" % (entryDir)
+    indexLock   = open(useFile,'a')
+    fcntl.flock(indexLock, fcntl.LOCK_SH)
+    os.utime(useFile)
+    print("Cached index location            : %s" % (genoIndex))
+
+    return genoIndex,entryD.get('@indexhash')
+
+def indexEvict(keepKey):
+    '''
+    Evicts least recently used indexes from cache till it fits in quota, indexes
+    in use by other runs are skipped
+    '''
+    quota       = index_quota*1024**3
+    entries     = [] ## (last use,key,size)
+    for akey in os.listdir(index_cache):
+        adir    = "%s/%s" % (index_cache,akey)
+        useFile = "%s/last.use" % (adir)
+        if akey.startswith('.trash_'): ## Left by crashed eviction
+            shutil.rmtree(adir, ignore_errors=True)
+            continue
+        if akey.startswith('.') or not os.path.isfile(useFile):
+            continue
+        asize   = sum(os.path.getsize("%s/%s" % (adir,afile)) for afile in os.listdir(adir))
+        entries.append((os.path.getmtime(useFile),akey,asize))
+
+    total       = sum(x[2] for x in entries)
+    for ause,akey,asize in sorted(entries):
+        if total <= quota:
+            break
+        if akey == keepKey:
+            continue
+        adir        = "%s/%s" % (index_cache,akey)
+        fh_build    = open("%s/%s.lock" % (index_cache,akey),'w')
+        fh_use      = open("%s/last.use" % (adir),'a')
+        try:
+            fcntl.flock(fh_build, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fh_use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: ## In use
+            fh_use.close()
+            fh_build.close()
+            continue
+        trashDir    = "%s/.trash_%s_%s" % (index_cache,akey,os.getpid())
+        os.rename(adir,trashDir)
+        fh_use.close()
+        fh_build.close()
+        shutil.rmtree(trashDir, ignore_errors=True)
+        total      -= asize
+        print("Evicted cached index             : %s (%s GB)" % (akey,round(asize/1024**3,2)))
+
+    if total > quota:
+        print("Index cache is over quota        : %s GB in use" % (round(total/1024**3,2)))
 
-    return indexIntegrity,indexExt
+    return None
 
-def FASTAClean(filename,mode):
+def FASTAClean(filename,mode,acores=None,apool=None):
     
-    '''Cleans FASTA file - multi-line fasta to single line, header clean, empty lines removal'''
+    '''Cleans FASTA file - multi-line fasta to single line, header clean, empty lines removal. 
+    Big references are split to shards at entry boundaries and cleaned in parallel on acores
+    (all by default) - in apool if caller made one, so that nothing is forked here'''
 
-    ## Read seqeunce file
-    fh_in       = open(filename, 'r')
     print ("phasdetect uses FASTA header as key for identifying the phased loci")
-    print ("Caching '%s' reference FASTA file" % (filename))
     
     ## Write file
     if mode == 0:
@@ -719,60 +1254,31 @@ def FASTAClean(filename,mode):
         sys.exit()
 
     ### Outfiles
-    fh_out1     = open(fastaclean, 'w')
+    fh_out1     = open(fastaclean, 'wb', buffering=1048576)
     fastasumm   = ('%s/%s.summ.txt' % (os.getcwd(),filename.rpartition('/')[-1].rpartition('.')[0]))
-    fh_out2     = open(fastasumm, 'w')
-    fh_out2.write("Name\tLen\n")
+    fh_out2     = open(fastasumm, 'wb')
+    fh_out2.write(b"Name\tLen\n")
     
-    ### Read files
-    fasta       = fh_in.read()
-    fasta_splt  = fasta.split('>')
-
-    fastaD      = {}    ## Store FASTA as dict
-    acount      = 0     ## count the number of entries
-    empty_count = 0
-    for i in fasta_splt[1:]:
-        ent     = i.split('\n')
-        aname   = ent[0].split()[0].strip()
-        
-        if runType == 'G':
-            ## To match with phasing-core script for genome version which removed non-numeric and preceding 0s
-            name = re.sub("[^0-9]", "", aname).lstrip('0')
-        else:
-            name = aname
-        
-        seq     = ''.join(x.strip() for x in ent[1:]) ## Sequence in multiple lines
-        alen    = len(seq)
-        if alen > 200:
-            fh_out1.write('>%s\n%s\n' % (name,seq))
-            fh_out2.write('%s\t%s\n' % (name,alen))
-            acount+=1
+    ### Clean shards #####################
+    offsets     = FASTAShards(filename,int(acores or nproc))
+    print ("Streaming '%s' reference FASTA file in %s shard(s)" % (filename,len(offsets)-1))
+    if len(offsets) == 2:
+        acount,empty_count = FASTACleanRange(filename,0,offsets[1],fh_out1,fh_out2)
+    else:
+        shardL  = [(filename,offsets[i],offsets[i+1],"%s.shard%s" % (fastaclean,i)) for i in range(len(offsets)-1)]
+        if apool:
+            resL    = apool.map(FASTACleanShard,shardL)
         else:
-            empty_count+=1
-            pass
-
-    #### Prepare a dictionary - Not Tested
-    # for line in fh_in:
-    #     if line.startswith('>'):
-    #       name          = line[1:].rstrip('\n').split()[0]
-    #       fastaD[name]  = ''
-    #     else:
-    #       fastaD[name]  += line.rstrip('\n').rstrip('*')
-
-    #### Write results - Not tested
-    # for name,seq in fastaD.items():
-    #     alen = len(seq)
-
-    #     if alen > 200:
-    #         fh_out1.write('>%s\n%s\n' % (name,seq))
-    #         fh_out2.write('%s\t%s\n' % (name,alen))
-    #         acount+=1
-    #     else:
-    #         empty_count+=1
-    #         pass
-
+            resL    = PPResults(FASTACleanShard,shardL)
+        for afilename,astart,aend,ashard in shardL: ## Concatenate in order
+            for afile,fh_out in (("%s.fa" % (ashard),fh_out1),("%s.summ" % (ashard),fh_out2)):
+                fh_in = open(afile,'rb')
+                shutil.copyfileobj(fh_in,fh_out,1048576)
+                fh_in.close()
+                os.remove(afile)
+        acount      = sum(x[0] for x in resL)
+        empty_count = sum(x[1] for x in resL)
     
-    fh_in.close()
     fh_out1.close()
     fh_out2.close() 
 
@@ -781,63 +1287,6 @@ def FASTAClean(filename,mode):
     
     return fastaclean,fastasumm
 
-def readMem(memFile):
-    '''
-    Reads memory file and gives global variables
-    '''
-    print ("#### Fn: memReader ############################")
-    fh_in       = open(memFile,'r')
-    memRead     = fh_in.readlines()
-    fh_in.close()
-
-    memflag     = True
-    varcount    = 0 
-    for line in memRead:
-        if line: ## Not empty
-            if line.startswith('@'):
-                line        = line.strip("\n")
-                # print(line)
-                akey,aval   = line.split(':')
-                param       = akey.strip()
-                value       = aval.strip()
-                # print(param,value)
-
-                if param == '@genomehash':
-                    global existRefHash
-                    varcount+=1
-                    existRefHash = str(value)
-                    print('Existing reference hash          :',existRefHash)
-
-                elif param == '@indexhash':
-                    global existIndexHash
-                    varcount+=1
-                    existIndexHash = str(value)
-                    print('Existing index hash              :',existIndexHash)
-
-                elif param == '@index':
-                    global index
-                    varcount+=1
-                    index = str(value)
-                    print('Existing index location          :',index)
-                
-                else:
-                    pass
-
-    ## Sanity Check - Memory file is not empty, from a crash
-    # if existRefHash.strip() == '':
-    #     memflag = False
-    # elif existIndexHash.strip() == '':
-    #     memflag = False
-    # elif index.strip() == '':
-    #     memflag = False
-
-    if varcount == 3:
-        memflag = True
-    else:
-        memflag = False
-
-    return memflag
-
 def coreReserve(cores):
     '''
     Decides the core pool for machine - written to make PHASIS comaptible with machines that 
@@ -846,7 +1295,7 @@ def coreReserve(cores):
 
     if cores == 0:
         ## Automatic assignment of cores selected
-        totalcores = int(multiprocessing.cpu_count())
+        totalcores = cpuLimit()
         if totalcores   == 4: ## For quad core system
             nproc = 3
         elif totalcores == 6: ## For hexa core system
@@ -854,281 +1303,2420 @@ def coreReserve(cores):
         elif totalcores > 6 and totalcores <= 10: ## For octa core system and those with less than 10 cores
             nproc = 7
         else:
-            nproc = int(totalcores*0.9)
+            nproc = max(1,int(totalcores*0.9)) ## Containers can be limited to a core or two
     else:
         ## Reserve user specifed cores
         nproc = int(cores)
 
     return nproc
 
-#### FASTA CLEAN P - IN DEV
+#### FASTA CLEAN P ####
 
-def FASTAread(filename):
-    
+def FASTAShards(filename,nshards):
     '''
-    Reads FASTA file to alist
+    Splits FASTA file to shards by byte offset, each shard starts at an entry header.
+    Returns shard boundaries, small files are not split
     '''
-    ### Sanity check #####################
-    if not os.path.isfile(reference):
-        print("'%s' reference file not found" % (reference))
-        print("Please check the genomeFile - Is it in specified directory? Did you input wrong name?")
-        print("Script will exit for now\n")
-        sys.exit()
-    else:
-        print("Reference file located - Preparing to create index")
-        pass
-    #####################################
-
-    ### Read seqeunce file ##############
-    fh_in       = open(filename, 'r')
-    print ("phasdetect uses FASTA header as key for identifying the phased loci")
-    print ("Caching reference '%s' FASTA file" % (filename))
-
-    fasta       = fh_in.read()
-    fasta_splt  = fasta.split('>')
-    print("Cached FASTA file with %s entries" % (len(fasta_splt[1:])))
-
+    shardMin    = 64*1024**2 ## Minimum bytes in a shard
+    fsize       = os.path.getsize(filename)
+    nshards     = max(1,min(nshards,fsize//shardMin))
+
+    offsets     = [0]
+    fh_in       = open(filename,'rb')
+    for i in range(1,nshards):
+        apos    = max(fsize*i//nshards,offsets[-1])
+        fh_in.seek(apos)
+        abuf    = b'' ## Carries last byte of previous block
+        while True:
+            ablock  = fh_in.read(1048576)
+            if not ablock:
+                apos = fsize
+                break
+            ahit    = (abuf+ablock).find(b'\n>')
+            if ahit != -1:
+                apos = apos-len(abuf)+ahit+1
+                break
+            apos   += len(ablock)
+            abuf    = ablock[-1:]
+        if apos > offsets[-1] and apos < fsize:
+            offsets.append(apos)
     fh_in.close()
+    offsets.append(fsize)
 
-    return fasta_splt[1:]
+    return offsets
 
-def FASTAclean(ent):
+def FASTACleanShard(ashard):
     '''
-    Cleans one entry of FASTA file - multi-line fasta to single line, header clean, empty lines removal
+    Cleans one shard of FASTA file to its own files, reads only its own byte range
     '''
+    filename,start,end,ashardFile = ashard
+    fh_out1     = open("%s.fa" % (ashardFile),'wb',buffering=1048576)
+    fh_out2     = open("%s.summ" % (ashardFile),'wb')
+    acount,empty_count = FASTACleanRange(filename,start,end,fh_out1,fh_out2)
+    fh_out1.close()
+    fh_out2.close()
 
-    ent_splt    = ent.split('\n')
-    aname       = ent_splt[0].split()[0].strip()
-    # print("Cleaning - %s" % (aname))
-    
-    if runType == 'G':
-        ## To match with phasing-core script for genome version which removed non-numeric and preceding 0s
-        bname = re.sub("[^0-9]", "", aname).lstrip('0')
-    else:
-        bname = aname
-    
-    bseq     = ''.join(x.strip() for x in ent[1:]) ## Sequence in multiple lines
-
-    return bname,bseq
+    return acount,empty_count
 
-def FASTAwrite(filename,alist,mode):
+def FASTACleanRange(filename,start,end,fh_out1,fh_out2):
     '''
-    Writes list of processed/cleaned FASTA
+    Cleans entries in a byte range of FASTA file, one entry at a time. Entries are written 
+    as they go, memory is bounded by longest line
     '''
+    fh_in       = open(filename,'rb',buffering=1048576)
+    fh_in.seek(start)
+    apos        = start
+    acount      = 0     ## count the number of entries
+    empty_count = 0
+    name        = None  ## Current entry
+    for line in itertools.chain(fh_in,[None]):
+        if line is not None:
+            if apos >= end: ## Next shard
+                line = None
+            else:
+                apos += len(line)
 
-    ## Write file
-    if mode == 0:
-        fastaclean = ('%s/%s.clean.fa' % (os.getcwd(),filename.rpartition('/')[-1].rpartition('.')[0])) ## os.getcwd(),fastaclean.rpartition('/')[-1].rpartition('.')[0]
-    else:
-        print("Input correct mode- 0: Normal | 1: Seqeunces reversed | 2: Seqeunces reverse complemented | 3: Seqeunces complemented only")
-        print("USAGE: cleanFasta.v.x.x.py FASTAFILE MODE")
-        sys.exit()
+        if line is None or line.startswith(b'>'):
+            ### Close the last entry
+            if name is None:
+                pass
+            elif written:
+                fh_out1.write(b'\n')
+                fh_out2.write(b'%s\t%d\n' % (name,alen))
+                acount+=1
+            else:
+                empty_count+=1
 
-    ### Outfiles
-    fh_out1     = open(fastaclean, 'w')
-    fastasumm   = ('%s/%s.summ.txt' % (os.getcwd(),filename.rpartition('/')[-1].rpartition('.')[0]))
-    fh_out2     = open(fastasumm, 'w')
-    fh_out2.write("Name\tLen\n")
+            if line is None:
+                break
 
-    acount      = 0     ## count the number of entries
-    empty_count = 0     ## count empty entries
-    
-    for ent in alist:
-        aname,aseq  = ent
-        alen        = len(aseq)
-    
-        if alen > 200:
-            fh_out1.write('>%s\n%s\n' % (aname,aseq))
-            fh_out2.write('%s\t%s\n' % (aname,alen))
-            acount+=1
+            aname   = line[1:].split()[0].strip()
+            if runType == 'G':
+                ## To match with phasing-core script for genome version which removed non-numeric and preceding 0s
+                name = re.sub(b"[^0-9]", b"", aname).lstrip(b'0')
+            else:
+                name = aname
+            seqL    = []    ## Sequence lines till entry qualifies
+            alen    = 0
+            written = False
+            continue
+
+        if name is None: ## Text before first header
+            continue
+
+        aseq    = line.strip() ## Sequence in multiple lines
+        alen   += len(aseq)
+        if written:
+            fh_out1.write(aseq)
         else:
-            empty_count+=1
-            pass
+            seqL.append(aseq)
+            if alen > 200:
+                fh_out1.write(b'>%s\n%s' % (name,b''.join(seqL)))
+                seqL    = []
+                written = True
+    fh_in.close()
 
+    return acount,empty_count
 
-    fh_out1.close()
-    fh_out2.close() 
+def FASTAPartition(fastaclean,fastasumm,nshards):
+    '''
+    Partitions cleaned reference to shards balanced by length - longest entries are placed
+    first, each on the lightest shard. Entries keep their order within a shard. Returns
+    shard FASTA files, or cleaned reference if there are too few entries to shard
+    '''
+    lenL        = [] ## Length of entries, in order of cleaned reference
+    fh_in       = open(fastasumm,'r')
+    fh_in.readline() ## Header
+    for line in fh_in:
+        lenL.append(int(line.rstrip("\n").split("\t")[1]))
+    fh_in.close()
 
-    print("Fasta file with reduced header: '%s' with total entries %s is prepared" % (fastaclean, acount))
-    print("There were %s entries with empty/short sequences,these were removed\n" % (empty_count))
-    
-    return fastaclean,fastasumm
+    nshards     = max(1,min(nshards,len(lenL)))
+    if nshards == 1:
+        return [fastaclean]
+
+    loadL       = [(0,i) for i in range(nshards)] ## Heap of (bases,shard)
+    shardOf     = [0]*len(lenL)
+    for k in sorted(range(len(lenL)),key=lambda x: -lenL[x]):
+        aload,i     = heapq.heappop(loadL)
+        shardOf[k]  = i
+        heapq.heappush(loadL,(aload+lenL[k],i))
+    loadL.sort()
+
+    shardL      = ["%s.s%s.fa" % (fastaclean.rpartition('.')[0],i) for i in range(nshards)]
+    fhL         = [open(x,'wb',buffering=1048576) for x in shardL]
+    fh_in       = open(fastaclean,'rb',buffering=1048576)
+    k           = -1    ## Current entry
+    atStart     = True  ## Chunk starts a line
+    while True:
+        achunk  = fh_in.readline(1048576) ## Bounded, long sequences are copied in pieces
+        if not achunk:
+            break
+        if atStart and achunk.startswith(b'>'):
+            k  += 1
+        fhL[shardOf[k]].write(achunk)
+        atStart = achunk.endswith(b'\n')
+    fh_in.close()
+    for fh_out in fhL:
+        fh_out.close()
 
-#### DE-DUPLICATOR MODULES ####
+    print("Reference shards: %s | Smallest: %s bp | Largest: %s bp" % (nshards,loadL[0][0],loadL[-1][0]))
 
-def dedup_process(alib):
+    return shardL
+
+#### DE-DUPLICATOR MODULES ####
+
+def dedup_process(alib,ashare=None):
+    '''
+    To parallelize the process. Cores used are recorded in ashare of phasing DAG
+    '''
+    print("\n#### Fn: De-duplicater #######################")
+
+    ninstances  = max(1,min(int(nproc),len(libs))) ## Libraries are de-duplicated in parallel, budget and cores are shared
+    abudget     = dedup_mem*1024**3/ninstances
+    athreads    = max(1,int(nproc)//ninstances) ## Decompression threads
+    amark       = stageMark()
+    libThreadsDedup(ashare,athreads)
+    try:
+        countFile   = dedup_external(alib,abudget,athreads)
+    finally:
+        libThreadsDedup(ashare,-athreads)
+    stageLog("dedup",alib,amark)
+
+    return countFile
+
+def dedup_reader(alib,athreads):
+    '''
+    Yields tags from FASTA or FASTQ file, plain or gzip/bgzip compressed
+    '''
+    ### Sanity check
+    if not os.path.isfile(alib):
+        print ("The file, %s, does not exist" % (alib))
+        return None
+
+    if libFormat == "Q":
+        for i,line in enumerate(dedup_lines(alib,athreads)):
+            if i % 4 == 1: ## Sequence line of a record
+                yield line.rstrip('\n')
+    else:
+        for line in dedup_lines(alib,athreads):
+            if line.startswith('>'):
+                pass
+            else:
+                yield line.rstrip('\n')
+
+def dedup_lines(alib,athreads):
+    '''
+    Yields lines of library, compressed files are decompressed on the fly without temporary
+    files - bgzip blocks in parallel threads, gzip by pigz (or gzip) in a separate process
+    '''
+    fh_in       = open(alib,'rb')
+    amagic      = fh_in.read(18)
+    fh_in.close()
+
+    if amagic[:2] != b'\x1f\x8b': ## Plain text
+        fh_in   = open(alib,'r',buffering=1048576)
+        for line in fh_in:
+            yield line
+        fh_in.close()
+
+    elif len(amagic) >= 14 and amagic[3] & 4 and amagic[12:14] == b'BC': ## BGZF - gzip with block size in extra field
+        acarry  = b''
+        for adata in bgzf_reader(alib,athreads):
+            lines   = (acarry+adata).split(b'\n')
+            acarry  = lines.pop()
+            for line in lines:
+                yield line.decode()+'\n'
+        if acarry:
+            yield acarry.decode()
+
+    else:
+        if shutil.which("pigz"):
+            acmd    = ["pigz","-dc","-p",str(athreads),alib]
+        elif shutil.which("gzip"):
+            acmd    = ["gzip","-dc",alib]
+        else:
+            acmd    = None
+
+        if acmd:
+            aproc   = subprocess.Popen(acmd, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1048576)
+            try:
+                for line in aproc.stdout:
+                    yield line
+            finally: ## Generator could be closed early
+                aproc.stdout.close()
+                if aproc.poll() is None:
+                    aproc.kill()
+                retcode = aproc.wait()
+            if retcode != 0:
+                print("** Problem with decompression of %s - Return code not 0" % (alib))
+                sys.exit()
+        else:
+            fh_in   = gzip.open(alib,'rt')
+            for line in fh_in:
+                yield line
+            fh_in.close()
+
+def bgzf_reader(alib,athreads):
+    '''
+    Yields decompressed data of BGZF (bgzip) file in order. Blocks are independent 
+    deflate streams, and are inflated in a thread pool
+    '''
+    inFlight    = athreads*8 ## Blocks being inflated, bounds the memory
+    fh_in       = open(alib,'rb',buffering=1048576)
+    apool       = ThreadPoolExecutor(max_workers=athreads)
+    futureQ     = collections.deque()
+    while True:
+        ablock  = bgzf_block(fh_in,alib)
+        if ablock is None:
+            break
+        futureQ.append(apool.submit(bgzf_inflate,ablock,alib))
+        if len(futureQ) >= inFlight:
+            yield futureQ.popleft().result()
+    while futureQ:
+        yield futureQ.popleft().result()
+    apool.shutdown()
+    fh_in.close()
+
+def bgzf_block(fh_in,alib):
+    '''
+    Reads one BGZF block - deflate data, CRC and uncompressed size
+    '''
+    aheader     = fh_in.read(12)
+    if not aheader:
+        return None
+    if len(aheader) < 12 or aheader[:4] != b'\x1f\x8b\x08\x04':
+        print("** %s is not a valid bgzip file - Block header is broken" % (alib))
+        sys.exit()
+
+    xlen        = struct.unpack('<H',aheader[10:12])[0]
+    aextra      = fh_in.read(xlen)
+    bsize       = None
+    i           = 0
+    while i+4 <= xlen: ## Subfields
+        slen    = struct.unpack('<H',aextra[i+2:i+4])[0]
+        if aextra[i:i+2] == b'BC':
+            bsize = struct.unpack('<H',aextra[i+4:i+6])[0]
+        i      += 4+slen
+    if bsize is None:
+        print("** %s is not a valid bgzip file - Block size is missing" % (alib))
+        sys.exit()
+
+    adata       = fh_in.read(bsize-xlen-19)
+    acrc,isize  = struct.unpack('<II',fh_in.read(8))
+
+    return adata,acrc,isize
+
+def bgzf_inflate(ablock,alib):
+    '''
+    Inflates a BGZF block and checks its integrity, zlib releases GIL so threads run in parallel
+    '''
+    adata,acrc,isize = ablock
+    try:
+        aout    = zlib.decompress(adata,-15)
+    except zlib.error:
+        aout    = None
+    if aout is None or len(aout) != isize or zlib.crc32(aout) != acrc:
+        print("** %s is corrupt - bgzip block failed CRC check" % (alib))
+        sys.exit()
+
+    return aout
+
+def dedup_external(alib,abudget,athreads):
+    '''
+    De-duplicates tags with a memory budget - tags are counted in a hash table that is spilled to
+    disk as a sorted run when budget is hit, and runs are k-way merged. Counts file is same as in-memory
+    '''
+    print("Reading FASTA file:%s" % (alib))
+    read_start  = time.time()
+    entryBytes  = 240   ## Approx. memory for a tag in hash tables, besides sequence
+    tmpDir      = "%s.dedup" % (alib.rpartition('.')[0])
+    
+    acounter    = {}    ## seq:count
+    firstD      = {}    ## seq:first occurence, to keep order of in-memory Counter
+    runL        = []    ## Spilled runs
+    amem        = 0
+    acount      = 0
+    for seq in dedup_reader(alib,athreads):
+        if seq in acounter:
+            acounter[seq] += 1
+        else:
+            acounter[seq]   = 1
+            firstD[seq]     = acount
+            amem           += len(seq)+entryBytes
+            if amem >= abudget:
+                runL.append(dedup_spill(acounter,firstD,tmpDir,len(runL)))
+                acounter    = {}
+                firstD      = {}
+                amem        = 0
+        acount += 1
+
+    read_end    = time.time()
+    print("Cached file: %s | Tags: %s | Spilled runs: %s" % (alib,acount,len(runL)))
+    # print("-- Read time: %ss" % (str(round(read_end-read_start,2))))
+
+    if not runL: ## Fits in budget
+        countFile   = dedup_writer(acounter.items(),alib)
+    else:
+        if acounter:
+            runL.append(dedup_spill(acounter,firstD,tmpDir,len(runL)))
+        acounter    = None
+        firstD      = None
+        countFile   = dedup_merge(runL,alib,abudget,tmpDir)
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+    return countFile
+
+def dedup_spill(acounter,firstD,tmpDir,arun):
+    '''
+    Writes hash table to disk as a run sorted by sequence
+    '''
+    os.makedirs(tmpDir, exist_ok=True)
+    runFile     = "%s/run%s.txt" % (tmpDir,arun)
+    fh_out      = open(runFile,'w',buffering=1048576)
+    for seq in sorted(acounter):
+        fh_out.write("%s\t%s\t%s\n" % (seq,acounter[seq],firstD[seq]))
+    fh_out.close()
+
+    return runFile
+
+def dedup_runreader(runFile,akey):
+    '''
+    Yields entries of a run - akey 0: (seq,count,first) sorted by sequence | 1: (first,seq,count) sorted by first occurence
+    '''
+    fh_in       = open(runFile,'r',buffering=1048576)
+    for line in fh_in:
+        ent     = line.rstrip('\n').split('\t')
+        if akey == 0:
+            yield ent[0],int(ent[1]),int(ent[2])
+        else:
+            yield int(ent[0]),ent[1],int(ent[2])
+    fh_in.close()
+
+def dedup_merge(runL,alib,abudget,tmpDir):
+    '''
+    K-way merges sorted runs - counts of a sequence are summed, and tags are put back in order
+    of first occurence with another external sort if needed
+    '''
+    entryBytes  = 240
+    ordL        = []    ## (first,seq,count)
+    ordRuns     = []    ## Spilled runs in order of first occurence
+    amem        = 0
+    runL        = dedup_fanin(runL,0,tmpDir)
+    amerged     = heapq.merge(*[dedup_runreader(x,0) for x in runL])
+    for seq,agroup in itertools.groupby(amerged, key=lambda x: x[0]):
+        acount  = 0
+        afirst  = None
+        for aseq,acnt,aidx in agroup:
+            acount += acnt
+            if afirst is None or aidx < afirst:
+                afirst = aidx
+        ordL.append((afirst,seq,acount))
+        amem   += len(seq)+entryBytes
+        if amem >= abudget:
+            ordL.sort()
+            ordRuns.append(dedup_ordspill(ordL,tmpDir,len(ordRuns)))
+            ordL    = []
+            amem    = 0
+
+    if ordRuns:
+        if ordL:
+            ordL.sort()
+            ordRuns.append(dedup_ordspill(ordL,tmpDir,len(ordRuns)))
+        ordRuns  = dedup_fanin(ordRuns,1,tmpDir)
+        aordered = heapq.merge(*[dedup_runreader(x,1) for x in ordRuns])
+    else:
+        ordL.sort()
+        aordered = ordL
+
+    countFile   = dedup_writer(((seq,acount) for afirst,seq,acount in aordered),alib)
+
+    return countFile
+
+def dedup_fanin(runL,akey,tmpDir):
+    '''
+    Merges runs in groups till these can be opened together, entries of a sequence 
+    are kept as such and combined in final merge
+    '''
+    fanIn       = 256 ## Runs open at a time
+    apass       = 0
+    while len(runL) > fanIn:
+        newL    = []
+        for i in range(0,len(runL),fanIn):
+            runFile = "%s/pass%s_%s_%s.txt" % (tmpDir,akey,apass,len(newL))
+            fh_out  = open(runFile,'w',buffering=1048576)
+            for ent in heapq.merge(*[dedup_runreader(x,akey) for x in runL[i:i+fanIn]]):
+                fh_out.write("%s\t%s\t%s\n" % ent)
+            fh_out.close()
+            for x in runL[i:i+fanIn]:
+                os.remove(x)
+            newL.append(runFile)
+        runL    = newL
+        apass  += 1
+
+    return runL
+
+def dedup_ordspill(ordL,tmpDir,arun):
+    '''
+    Writes a run sorted by first occurence
+    '''
+    runFile     = "%s/ord%s.txt" % (tmpDir,arun)
+    fh_out      = open(runFile,'w',buffering=1048576)
+    for afirst,seq,acount in ordL:
+        fh_out.write("%s\t%s\t%s\n" % (afirst,seq,acount))
+    fh_out.close()
+
+    return runFile
+
+def dedup_writer(aitems,alib):
+    '''
+    writes rtag count to a file, from (tag,count) pairs
+    '''
+
+    print("Writing counts file for %s" % (alib))
+    countFile   = "%s.fas" % alib.rpartition('.')[0]  ### Writing in de-duplicated FASTA format as required for phaster-core
+    fh_out       = open(countFile,'w')
+
+    acount      = 0
+    seqcount    = 1 ## TO name seqeunces
+    for i,j in aitems:
+        # fh_out.write("%s\t%s\n" % (i,j))
+        fh_out.write(">seq_%s|%s\n%s\n" % (seqcount,j,i))
+        acount      += 1
+        seqcount    += 1
+
+    print("Total unique entries written for %s: %s" % (alib,acount))
+
+    fh_out.close()
+
+    return countFile
+
+#### PHASING ENGINE - NUMPY ####
+
+def PHASBatchNP(aninput):
+    '''
+    Phasing analysis - in-process scorer, a port of phasis-core scripts that
+    computes n and k for every coordinate with prefix sums and strided views
+    '''
+
+    print ("\n#### Fn: phaser [numpy] #####################")
+    lib,runType,index,deg,nthread,noiseLimit,hitsLimit,clustBuffer = aninput
+
+    ### Sanity check #####################
+    if not os.path.isfile(lib):
+        print("** %s - sRNA library file not found" % (lib))
+        print("** Please check the library- Is it in specified directory? Did you input wrong name?")
+        print("** Script will exit for now\n")
+        sys.exit()
+    else:
+        print("sRNA library located - Running phasing analysis")
+        pass
+    #####################################
+
+    out_file    = './%s/%s.txt' % (res_folder,lib.rpartition(".")[0]) ## Output file suffix
+    rls         = list(phase)
+    print(lib)
+
+    ### Align ############################
+    amark       = stageMark()
+    sh2,hits,totalAbun = libAlign(lib,index,nthread,out_file)
+    stageLog("alignment",lib,amark)
+
+    ### Score and cluster ################
+    amark       = stageMark()
+    chrs        = chrSort(sh2)
+    scoredD     = {} ## Scored sRNAs for each register length
+    for rl in rls:
+        scoredL = []
+        for achr in chrs:
+            scoredL.extend(phasScore(achr,sh2[achr],rl))
+        scoredD[rl] = scoredL
+
+    phasWriter(out_file,scoredD,hits,totalAbun,clustBuffer)
+    stageLog("scoring",lib,amark)
+
+    return None
+
+def libAlign(lib,index,nthread,out_file):
+    '''
+    Maps library and returns pre-splitted alignments, hits and total abundance
+    '''
+    noise       = minDepth-1
+
+    if args.union:
+        sh,hits,totalAbun = unionJoin(lib,noise)
+        return preSplit(sh),hits,totalAbun
+
+    ### Alignments don't depend on noise, all of these are cached and noise is filtered after
+    alnFile     = alignCacheFile(lib)
+    cached      = alignCacheLoad(alnFile) if alnFile else None
+    if cached:
+        sh,hits,totalAbun = cached
+    else:
+        readNoise   = -1 if alnFile else noise
+        if libFormat == "T":
+            fastaFile   = tagsToFASTA(lib,"%s.tags.fa" % (out_file))
+        else:
+            fastaFile   = lib
+        
+        if args.stream:
+            sh,hits,totalAbun = bowtieStream(fastaFile,index,nthread,readNoise)
+        else:
+            mapFile     = "%s.map" % (out_file)
+            bowtieMap(fastaFile,index,nthread,mapFile)
+            fh_in       = open(mapFile,'r')
+            sh,hits,totalAbun = alignReader(fh_in,readNoise)
+            fh_in.close()
+            os.remove(mapFile)
+        if fastaFile != lib:
+            os.remove(fastaFile)
+        if alnFile:
+            alignCacheStore(alnFile,sh,hits,totalAbun)
+    if alnFile:
+        sh      = noiseFilter(sh,noise)
+
+    sh2         = preSplit(sh)
+
+    return sh2,hits,totalAbun
+
+def PHASSchedule(rawInputs):
+    '''
+    Chromosome level scheduler for numpy engine - libraries are aligned first, then scoring
+    of all libraries is split in (library, chromosome, register) units that run in a single
+    shared pool, largest first, so cores stay busy till the last unit finishes. A library
+    that fails to align, score or write is left without results, others continue
+    '''
+    print ("\n#### Fn: Scheduler ##########################")
+    rls         = list(phase)
+    clustBuffer = rawInputs[0][-1]
+
+    ### Align - bowtie threads balanced against core pool
+    alignL      = [x for x in PPBalance(PHASAlignLib,rawInputs) if x[1] is not None]
+
+    unitL       = [] ## (out_file,uid,rl,records)
+    uidsD       = {} ## out_file:[uid,...]
+    pendD       = {} ## out_file:units left to score
+    failS       = set() ## out_file of failed libraries
+    for out_file,uinfo in alignL:
+        uidsD[out_file] = [uid for uid,nrecs in uinfo]
+        pendD[out_file] = len(uinfo)*len(rls)
+        for uid,nrecs in uinfo:
+            for rl in rls:
+                unitL.append((out_file,uid,rl,nrecs))
+    unitL.sort(key=lambda x: x[3], reverse=True) ## Small units fill the tail
+    print("Scoring units: %s from %s libraries | Pool: %s" % (len(unitL),len(alignL),nproc))
+
+    ### Score - only a few units are queued ahead of the pool, so that a library is clustered
+    ### and written as soon as its last unit is done, and not behind all of the remaining units
+    npool       = Pool(int(nproc))
+    doneQ       = queue.Queue()     ## (out_file,error) of scored units
+    window      = 2*int(nproc)      ## Units submitted but not done
+    writeL      = [] ## (out_file,result)
+    for out_file in uidsD:
+        if pendD[out_file] == 0: ## Nothing to score
+            writeL.append((out_file,npool.apply_async(PHASWriteNP,((out_file,uidsD[out_file],clustBuffer),))))
+    nsub        = 0
+    ndone       = 0
+    while ndone < len(unitL):
+        while nsub < len(unitL) and nsub-ndone < window:
+            aunit   = unitL[nsub]
+            nsub   += 1
+            if aunit[0] in failS: ## Rest of units of a failed library are not scored
+                doneQ.put((aunit[0],None))
+                continue
+            npool.apply_async(PHASUnitNP,(aunit,),
+                callback=lambda x: doneQ.put((x,None)),
+                error_callback=lambda x,aunit=aunit: doneQ.put((aunit[0],x)))
+        out_file,err = doneQ.get()
+        ndone  += 1
+        if err is not None and out_file not in failS:
+            print("** Scoring failed for %s (%r) - other libraries will continue" % (out_file,err))
+            failS.add(out_file)
+        pendD[out_file] -= 1
+        if pendD[out_file] == 0 and out_file not in failS:
+            writeL.append((out_file,npool.apply_async(PHASWriteNP,((out_file,uidsD[out_file],clustBuffer),))))
+    for out_file,ares in writeL:
+        try:
+            ares.get()
+        except Exception as err:
+            print("** Writing failed for %s (%r) - other libraries will continue" % (out_file,err))
+            failS.add(out_file)
+    npool.close()
+    npool.join()
+    for out_file in failS: ## Partial units are of no use to a rerun
+        shutil.rmtree("%s.units" % (out_file),ignore_errors=True)
+
+    return None
+
+def PHASAlignLib(aninput):
+    '''
+    Aligns a library for scheduler, a failed library is reported and left out of scoring
+    '''
+    try:
+        return PHASAlignNP(aninput)
+    except (Exception,SystemExit) as err: ## bowtie errors exit, in a pool worker that hangs the pool
+        print("** Alignment failed for %s (%r) - other libraries will continue" % (aninput[0],err))
+        return aninput[0],None
+
+def PHASAlignNP(aninput):
+    '''
+    Aligns a library for scheduler, and spills pre-splitted alignments to unit files. 
+    Chromosomes are packed to a unit till it has enough sRNAs, big ones get their own.
+    Transcripts/scaffolds are many and small, these are sharded to units balanced by sRNA hits
+    '''
+    print ("\n#### Fn: Aligner [numpy] ####################")
+    lib,runType,index,deg,nthread,noiseLimit,hitsLimit,clustBuffer = aninput
+    unitRecs    = 50000 ## Minimum sRNAs in a unit
+
+    ### Sanity check #####################
+    if not os.path.isfile(lib):
+        print("** %s - sRNA library file not found" % (lib))
+        print("** Please check the library- Is it in specified directory? Did you input wrong name?")
+        raise FileNotFoundError(lib) ## Runs in a pool worker, where exit would hang the pool
+    else:
+        pass
+    #####################################
+
+    out_file    = './%s/%s.txt' % (res_folder,lib.rpartition(".")[0]) ## Output file suffix
+    unitDir     = "%s.units" % (out_file)
+    print(lib)
+
+    amark       = stageMark()
+    sh2,hits,totalAbun = libAlign(lib,index,nthread,out_file)
+    stageLog("alignment",lib,amark)
+
+    if os.path.isdir(unitDir):
+        shutil.rmtree(unitDir)
+    os.mkdir(unitDir)
+    fh_out      = open("%s/meta.pkl" % (unitDir),'wb')
+    pickle.dump((hits,totalAbun),fh_out,pickle.HIGHEST_PROTOCOL)
+    fh_out.close()
+
+    if runType == 'G':
+        chunkL  = []
+        achunk  = {}
+        arecs   = 0
+        for achr in chrSort(sh2)+[None]:
+            if achr is not None:
+                achunk[achr] = sh2[achr]
+                arecs += len(sh2[achr])
+                if arecs < unitRecs:
+                    continue
+            if achunk:
+                chunkL.append(achunk)
+            achunk  = {}
+            arecs   = 0
+    else:
+        totalRecs = sum(len(x) for x in sh2.values())
+        nshard  = max(int(nproc),-(-totalRecs//unitRecs))
+        chunkL  = targetShards(sh2,nshard)
+
+    uinfo       = [] ## (uid,records)
+    for achunk in chunkL:
+        uid     = len(uinfo)
+        fh_out  = open("%s/%s.pkl" % (unitDir,uid),'wb')
+        pickle.dump(achunk,fh_out,pickle.HIGHEST_PROTOCOL)
+        fh_out.close()
+        uinfo.append((uid,sum(len(x) for x in achunk.values())))
+
+    print("%s spilled as %s units" % (lib,len(uinfo)))
+
+    return out_file,uinfo
+
+def targetShards(sh2,nshard):
+    '''
+    Deals targets to shards balanced by sRNA hits, largest first - these are independent
+    so a shard can hold any of them, writer puts results back in target order
+    '''
+    targetL     = sorted(sh2,key=lambda x: (-len(sh2[x]),x))
+    nshard      = max(1,min(nshard,len(targetL)))
+    shardL      = [{} for i in range(nshard)]
+    heap        = [(0,i) for i in range(nshard)] ## (hits,shard)
+    for achr in targetL:
+        ahits,i = heapq.heappop(heap)
+        shardL[i][achr] = sh2[achr]
+        heapq.heappush(heap,(ahits+len(sh2[achr]),i))
+
+    return [x for x in shardL if x]
+
+def PHASUnitNP(aunit):
+    '''
+    Scores one (library, chromosome, register) unit from scheduler
+    '''
+    out_file,uid,rl,nrecs = aunit
+    unitDir     = "%s.units" % (out_file)
+    amark       = stageMark()
+
+    fh_in       = open("%s/%s.pkl" % (unitDir,uid),'rb')
+    achunk      = pickle.load(fh_in)
+    fh_in.close()
+
+    scoredD     = {} ## Scored sRNAs for each chromosome/target
+    for achr in achunk:
+        scoredD[achr] = phasScore(achr,achunk[achr],rl)
+
+    fh_out      = open("%s/%s.%s.scored.pkl" % (unitDir,uid,rl),'wb')
+    pickle.dump(scoredD,fh_out,pickle.HIGHEST_PROTOCOL)
+    fh_out.close()
+    stageLog("scoring",out_file.rpartition("/")[-1],amark,unit="%s:%snt" % (uid,rl))
+
+    return out_file
+
+def PHASWriteNP(aninput):
+    '''
+    Merges scored units of a library in chromosome/target order, and writes clusters
+    '''
+    out_file,uids,clustBuffer = aninput
+    rls         = list(phase)
+    unitDir     = "%s.units" % (out_file)
+    amark       = stageMark()
+
+    fh_in       = open("%s/meta.pkl" % (unitDir),'rb')
+    hits,totalAbun = pickle.load(fh_in)
+    fh_in.close()
+
+    scoredD     = {} ## Scored sRNAs for each register length
+    for rl in rls:
+        chrD    = {}
+        for uid in uids:
+            fh_in   = open("%s/%s.%s.scored.pkl" % (unitDir,uid,rl),'rb')
+            chrD.update(pickle.load(fh_in))
+            fh_in.close()
+        scoredL = []
+        for achr in chrSort(chrD):
+            scoredL.extend(chrD[achr])
+        scoredD[rl] = scoredL
+
+    phasWriter(out_file,scoredD,hits,totalAbun,clustBuffer)
+    shutil.rmtree(unitDir)
+    if args.clusterbin:
+        clusterBin(out_file)
+    stageLog("writing",out_file.rpartition("/")[-1],amark)
+    libDone(out_file)
+
+    return None
+
+def tagsToFASTA(lib,fastaFile):
+    '''
+    Converts tag count library to FASTA with abundance in header, same as phasis-core
+    '''
+    fh_in       = open(lib,'r')
+    fh_out      = open(fastaFile,'w')
+    acount      = 0
+    for line in fh_in:
+        acount  += 1
+        ent     = line.split()
+        fh_out.write(">seq_%s|%s\n%s\n" % (acount,ent[1],ent[0]))
+    fh_in.close()
+    fh_out.close()
+
+    return fastaFile
+
+def bowtieCmd(fastaFile,index,nthread,shard=False):
+    '''
+    Bowtie command with same settings as phasis-core, multimappers
+    above the ceiling are removed. For a shard of sharded index, at most one
+    alignment above the ceiling is reported and shardMerge removes multimappers
+    '''
+    mismat,mhits = alignParams()
+
+    if shard:
+        return ["bowtie","-f","-k",str(int(mhits)+1),"-v",mismat,"-p",str(nthread),index,fastaFile]
+    return ["bowtie","-f","-a","-v",mismat,"-m",mhits,"-p",str(nthread),index,fastaFile]
+
+def alignParams():
+    '''
+    Bowtie mismatches and multimapper ceiling, these decide alignments of a library
+    along with index
+    '''
+    if runType == 'G':
+        mhits   = "12"
+    else:
+        mhits   = "45" ## Transcripts and scaffolds can match to multiple isoforms
+
+    mismat      = "0"
+
+    return mismat,mhits
+
+def bowtieMap(fastaFile,index,nthread,mapFile):
+    '''
+    Maps sRNAs to a temporary alignment file
+    '''
+    if len(indexShards(index)) > 1:
+        fh_out  = open(mapFile,'w')
+        fh_out.writelines(shardMerge(shardAlign(fastaFile,index,nthread)))
+        fh_out.close()
+        return mapFile
+
+    amark       = stageMark()
+    fh_out      = open(mapFile,'w')
+    retcode     = subprocess.call(bowtieCmd(fastaFile,index,nthread), stdout=fh_out)
+    fh_out.close()
+    stageLog("bowtie",fastaFile,amark,retcode)
+
+    if retcode == 0:
+        pass
+    else:
+        print("** Problem with bowtie mapping of %s - Return code not 0" % (fastaFile))
+        sys.exit()
+
+    return mapFile
+
+def bowtieStream(fastaFile,index,nthread,noise):
+    '''
+    Maps sRNAs and reads alignments from bowtie pipe as these are produced,
+    nothing is written to disk - except alignments of shards of sharded index
+    '''
+    if len(indexShards(index)) > 1:
+        return alignReader(shardMerge(shardAlign(fastaFile,index,nthread)),noise)
+
+    amark       = stageMark()
+    aproc       = subprocess.Popen(bowtieCmd(fastaFile,index,nthread), stdout=subprocess.PIPE, universal_newlines=True, bufsize=1048576)
+    sh,hits,totalAbun = alignReader(aproc.stdout,noise)
+    aproc.stdout.close()
+    retcode     = aproc.wait()
+    stageLog("bowtie",fastaFile,amark,retcode) ## Includes reading of alignments from pipe
+
+    if retcode == 0:
+        pass
+    else:
+        print("** Problem with bowtie mapping of %s - Return code not 0" % (fastaFile))
+        sys.exit()
+
+    return sh,hits,totalAbun
+
+def shardAlign(fastaFile,index,nthread):
+    '''
+    Maps sRNAs against all shards of sharded index together, threads are split between
+    shards. Returns alignment files of shards, in results folder
+    '''
+    shardL      = indexShards(index)
+    athread     = max(1,int(nthread)//len(shardL))
+    abase       = "./%s/%s" % (res_folder,fastaFile.rpartition('/')[-1])
+
+    amark       = stageMark()
+    mapL        = []
+    procL       = []
+    for i,ashard in enumerate(shardL):
+        mapFile = "%s.s%s.map" % (abase,i)
+        fh_out  = open(mapFile,'w')
+        procL.append(subprocess.Popen(bowtieCmd(fastaFile,ashard,athread,shard=True), stdout=fh_out))
+        fh_out.close()
+        mapL.append(mapFile)
+    retcode     = next((x for x in [aproc.wait() for aproc in procL] if x != 0),0)
+    stageLog("bowtie",fastaFile,amark,retcode)
+
+    if retcode == 0:
+        pass
+    else:
+        for mapFile in mapL:
+            os.remove(mapFile)
+        print("** Problem with bowtie mapping of %s to index shards - Return code not 0" % (fastaFile))
+        sys.exit()
+
+    return mapL
+
+def shardMerge(mapL):
+    '''
+    Merges alignments of shards - tags with more alignments than the multimapper ceiling
+    across all shards are removed, same as bowtie '-m' on whole index. Alignment files
+    are removed once read
+    '''
+    mismat,mhits = alignParams()
+    countD      = {} ## seqid:alignments in all shards
+    for mapFile in mapL:
+        fh_in   = open(mapFile,'r')
+        for line in fh_in:
+            seqid   = line.split("\t",1)[0]
+            countD[seqid] = countD.get(seqid,0)+1
+        fh_in.close()
+
+    for mapFile in mapL:
+        fh_in   = open(mapFile,'r')
+        for line in fh_in:
+            if countD[line.split("\t",1)[0]] <= int(mhits):
+                yield line
+        fh_in.close()
+        os.remove(mapFile)
+
+def alignReader(fh_in,noise):
+    '''
+    Reads bowtie alignments from file or pipe to chromosome/target specific lists, noise 
+    is filtered on the fly but counted towards hits and total abundance like phasis-core
+    '''
+    sh          = {}    ## chr/target:[(pos,strand,seqid,seq,abun),...]
+    hits        = {}    ## seqid:hits
+    totalAbun   = 0     ## Total abundance of mapped sRNAs
+
+    for line in fh_in:
+        seqid,achr,pos,strand,seq = alignRecord(line)
+        amatch  = re.search(r'\|(\d+)',seqid) or re.search(r'abun\_(\d+)',seqid)
+        if not amatch:
+            print("** Abundance can't be located from the seq_id: %s" % (seqid))
+            sys.exit()
+        abun    = amatch.group(1)
+
+        if seqid not in hits:
+            totalAbun  += int(abun)
+            hits[seqid] = 1
+        else:
+            hits[seqid] += 1
+
+        if int(abun) <= noise:
+            continue
+
+        sh.setdefault(achr,[]).append((pos,strand,seqid,seq,abun))
+
+    print("Alignments cached: %s chr/targets | %s mapped tags | Total abundance: %s" % (len(sh),len(hits),totalAbun))
+
+    return sh,hits,totalAbun
+
+def alignCacheFile(lib):
+    '''
+    Alignment cache entry of library, keyed by library hash, index hash, bowtie mismatches
+    and multimapper ceiling. False if run has no index hash
+    '''
+    if not alignIndex:
+        return False
+
+    mismat,mhits = alignParams()
+    akey        = hashlib.md5(("%s|%s|v%s|m%s" % (fileHash(lib),alignIndex,mismat,mhits)).encode()).hexdigest()
+    os.makedirs(align_cache, exist_ok=True)
+
+    return "%s/%s.aln" % (align_cache,akey)
+
+def alignCacheStore(alnFile,sh,hits,totalAbun):
+    '''
+    Writes all alignments of a library to cache - little-endian, sections start at 8-byte boundary:
+      header  - magic 'PHASALN1', tags, alignments, chr/targets, string table bytes, total
+                abundance (u64) and chr/target kind ('int' or 'str', 8 bytes)
+      tags    - hits (u32 x tags), name and sequence offsets to string table (u64 x tags+1)
+      chrs    - first alignment (u64 x chrs+1) and name offsets to string table (u64 x chrs+1)
+      aligns  - tag (u32), position (u32) and strand (u8, 0:+ 1:-) of each, in bowtie order for a chr
+      strings - chr/target names, then each tag's name and sequence
+    Older entries are evicted after, if cache is over quota
+    '''
+    tagD        = {}    ## seqid:index
+    hitsL       = array.array('I')
+    nameOff     = array.array('Q')
+    seqOff      = array.array('Q')
+    chrRec      = array.array('Q',[0])
+    chrOff      = array.array('Q',[0])
+    atag        = array.array('I')
+    apos        = array.array('I')
+    astrand     = array.array('B')
+    strtab      = bytearray()
+    tagL        = []
+    roff        = 0
+
+    chrL        = chrSort(sh)
+    for achr in chrL:
+        strtab.extend(str(achr).encode())
+        chrOff.append(len(strtab))
+    abase       = len(strtab)
+    try:
+        for achr in chrL:
+            for pos,strand,seqid,seq,abun in sh[achr]:
+                if seqid not in tagD:
+                    tagD[seqid] = len(tagD)
+                    hitsL.append(hits[seqid])
+                    nameOff.append(abase+roff)
+                    seqOff.append(abase+roff+len(seqid))
+                    roff   += len(seqid)+len(seq)
+                    tagL.append(seqid+seq)
+                atag.append(tagD[seqid])
+                apos.append(pos)
+                astrand.append(0 if strand == '+' else 1)
+            chrRec.append(len(atag))
+    except OverflowError:
+        print("** Alignments of %s have a position beyond 4Gb, these are not cached" % (alnFile))
+        return None
+    nameOff.append(abase+roff)
+    seqOff.append(abase+roff)
+    for atext in tagL:
+        strtab.extend(atext.encode())
+
+    sectionL    = [hitsL,nameOff,seqOff,chrRec,chrOff,atag,apos,astrand]
+    if sys.byteorder != "little":
+        for asection in sectionL:
+            asection.byteswap()
+
+    akind       = b"int" if runType == 'G' else b"str"
+    tmpFile     = "%s.tmp_%s" % (alnFile,os.getpid())
+    fh_out      = open(tmpFile,'wb')
+    fh_out.write(b"PHASALN1")
+    fh_out.write(struct.pack("<QQQQQ8s",len(tagD),len(atag),len(chrL),len(strtab),totalAbun,akind))
+    for asection in sectionL:
+        fh_out.write(asection.tobytes())
+        fh_out.write(b"\0"*(-fh_out.tell()%8))
+    fh_out.write(strtab)
+    fh_out.close()
+    os.replace(tmpFile,alnFile) ## Atomic publish, runs aligning same library write same entry
+    print("Alignments cached to             : %s (%s MB)" % (alnFile,round(os.path.getsize(alnFile)/1024**2,2)))
+
+    alignCacheEvict(alnFile)
+
+    return alnFile
+
+def alignCacheLoad(alnFile):
+    '''
+    Reads alignments of a library from cache, as alignReader would with noise filter off.
+    None if not cached
+    '''
+    if not os.path.isfile(alnFile):
+        return None
+
+    fh_in       = open(alnFile,'rb')
+    amap        = mmap.mmap(fh_in.fileno(),0,access=mmap.ACCESS_READ)
+    fh_in.close()
+    if amap[:8] != b"PHASALN1":
+        print("Cached alignments are broken - library will be aligned again")
+        amap.close()
+        return None
+    ntags,naln,nchr,nstr,totalAbun,akind = struct.unpack_from("<QQQQQ8s",amap,8)
+
+    aview       = memoryview(amap)
+    apos        = 56
+    alnD        = {}
+    for aname,atype,alen in (("hits",'I',ntags),("name",'Q',ntags+1),("seq",'Q',ntags+1),("chrrec",'Q',nchr+1),
+            ("chroff",'Q',nchr+1),("tag",'I',naln),("pos",'I',naln),("strand",'B',naln)):
+        asize   = alen*struct.calcsize(atype)
+        alnD[aname] = array.array(atype)
+        alnD[aname].frombytes(aview[apos:apos+asize])
+        apos   += asize+(-asize%8)
+    strtab      = bytes(aview[apos:apos+nstr])
+    aview.release()
+    amap.close()
+    if sys.byteorder != "little":
+        for aname in alnD:
+            alnD[aname].byteswap()
+
+    tagL        = [] ## (seqid,seq,abun)
+    hits        = {}
+    for i in range(ntags):
+        seqid   = strtab[alnD["name"][i]:alnD["seq"][i]].decode()
+        seq     = strtab[alnD["seq"][i]:alnD["name"][i+1]].decode()
+        amatch  = re.search(r'\|(\d+)',seqid) or re.search(r'abun\_(\d+)',seqid)
+        tagL.append((seqid,seq,amatch.group(1)))
+        hits[seqid] = alnD["hits"][i]
+
+    sh          = {}
+    strands     = ('+','-')
+    for i in range(nchr):
+        achr    = strtab[alnD["chroff"][i]:alnD["chroff"][i+1]].decode()
+        if akind.rstrip(b"\0") == b"int":
+            achr = int(achr)
+        recs    = []
+        for j in range(alnD["chrrec"][i],alnD["chrrec"][i+1]):
+            seqid,seq,abun = tagL[alnD["tag"][j]]
+            recs.append((alnD["pos"][j],strands[alnD["strand"][j]],seqid,seq,abun))
+        sh[achr] = recs
+    os.utime(alnFile) ## Orders eviction
+    print("Alignments re-used from cache    : %s | %s chr/targets | %s mapped tags | Total abundance: %s" % (alnFile,len(sh),len(hits),totalAbun))
+
+    return sh,hits,totalAbun
+
+def noiseFilter(sh,noise):
+    '''
+    Drops alignments of sRNAs at or below noise, hits and total abundance still count them
+    '''
+    shF         = {}
+    for achr in sh:
+        recs    = [x for x in sh[achr] if int(x[4]) > noise]
+        if recs:
+            shF[achr] = recs
+
+    return shF
+
+def alignCacheMap(lib,index,nthread,out_file,alnFile):
+    '''
+    Alignment file of a library for phasis-core (-al), in bowtie format. Written from cache
+    if library was aligned before, else library is mapped here and its alignments are cached
+    '''
+    mapFile     = "%s.map" % (out_file)
+    cached      = alignCacheLoad(alnFile)
+    if cached:
+        alignWrite(cached[0],mapFile)
+        return mapFile
+
+    if libFormat == "T":
+        fastaFile   = tagsToFASTA(lib,"%s.tags.fa" % (out_file))
+    else:
+        fastaFile   = lib
+    bowtieMap(fastaFile,index,nthread,mapFile)
+    if fastaFile != lib:
+        os.remove(fastaFile)
+    fh_in       = open(mapFile,'r')
+    sh,hits,totalAbun = alignReader(fh_in,-1)
+    fh_in.close()
+    alignCacheStore(alnFile,sh,hits,totalAbun)
+
+    return mapFile
+
+def alignWrite(sh,mapFile):
+    '''
+    Writes alignments back to bowtie columns read by phasis-core. Chromosomes/targets are
+    written in turn, alignments of each in bowtie order - phasis-core gets same clusters
+    '''
+    comp        = str.maketrans('ATCGN','TAGCN')
+    fh_out      = open(mapFile,'w')
+    for achr in sh:
+        for pos,strand,seqid,seq,abun in sh[achr]:
+            if strand == '+':
+                fh_out.write("%s\t+\t%s\t%s\t%s\n" % (seqid,achr,pos-1,seq))
+            else:
+                fh_out.write("%s\t-\t%s\t%s\t%s\n" % (seqid,achr,pos-len(seq),seq[::-1].translate(comp)))
+    fh_out.close()
+
+    return mapFile
+
+def alignCacheUsage():
+    '''
+    Cached alignment entries as (last use,file,size), and their total size
+    '''
+    entries     = []
+    if os.path.isdir(align_cache):
+        for afile in os.listdir(align_cache):
+            apath   = "%s/%s" % (align_cache,afile)
+            try:
+                astat   = os.stat(apath)
+            except OSError: ## Evicted by other run
+                continue
+            entries.append((astat.st_mtime,apath,astat.st_size))
+
+    return entries,sum(x[2] for x in entries)
+
+def alignCacheEvict(keepFile):
+    '''
+    Evicts least recently used alignments from cache till it fits in quota. Entries are
+    read whole when used, so an entry can be removed while other runs are going
+    '''
+    quota       = align_quota*1024**3
+    entries,total = alignCacheUsage()
+    nentry      = len(entries)
+    for ause,apath,asize in sorted(entries):
+        if total <= quota:
+            break
+        if apath == keepFile or ".tmp_" in apath: ## In use or being written
+            continue
+        try:
+            os.remove(apath)
+        except OSError:
+            continue
+        total  -= asize
+        nentry -= 1
+        print("Evicted cached alignments        : %s (%s MB)" % (apath.rpartition('/')[-1],round(asize/1024**2,2)))
+    print("Alignment cache                  : %s entries | %s GB of %s GB quota" % (nentry,round(total/1024**3,2),align_quota))
+
+    return None
+
+def alignCachePurge():
+    '''
+    Removes all cached alignments, and reports space freed
+    '''
+    print ("\n#### Fn: Alignment cache purge ##############")
+    entries,total = alignCacheUsage()
+    freed       = 0
+    npurged     = 0
+    for ause,apath,asize in entries:
+        if ".tmp_" in apath: ## Being written by a run
+            continue
+        try:
+            os.remove(apath)
+        except OSError: ## Evicted by other run
+            continue
+        freed  += asize
+        npurged += 1
+    print("Alignment cache                  : %s | %s GB in %s entries" % (align_cache,round(total/1024**3,2),len(entries)))
+    print("Purged                           : %s entries | %s GB freed" % (npurged,round(freed/1024**3,2)))
+
+    return None
+
+def alignRecord(line):
+    '''
+    Parses a bowtie alignment to seq_id, chr/target, 5' position (1-based), strand and 
+    sRNA sequence as in library
+    '''
+    comp        = str.maketrans('ATCGN','TAGCN')
+    seqid,strand,target,pos,seq = line.rstrip('\n').split('\t')[:5]
+
+    if strand == '+':
+        pos = int(pos)+1
+    else:
+        pos = int(pos)+len(seq)
+        seq = seq[::-1].translate(comp)
+
+    if runType == 'G':
+        chrmatch = re.search(r'(\d+)',target)
+        if not chrmatch:
+            print("** Chromosome '%s' is not named as number" % (target))
+            print("** Make sure all the chr including the chloroplast and mitchondria are initiated by digital number")
+            sys.exit()
+        achr = int(chrmatch.group(1))
+    else:
+        achr = target
+
+    return seqid,achr,pos,strand,seq
+
+def libTags(lib):
+    '''
+    Yields seq_id and sequence of library tags in file order, tag count libraries 
+    are named same as tagsToFASTA
     '''
-    To parallelize the process
+    fh_in       = open(lib,'r')
+    if libFormat == "T":
+        acount  = 0
+        for line in fh_in:
+            acount  += 1
+            ent     = line.split()
+            yield "seq_%s|%s" % (acount,ent[1]),ent[0]
+    else:
+        for line in fh_in:
+            if line.startswith('>'):
+                seqid = line[1:].split()[0]
+            else:
+                yield seqid,line.strip()
+    fh_in.close()
+
+def unionAlign(libs,index):
     '''
-    print("\n#### Fn: De-duplicater #######################")
+    Aligns union of unique tags from all libraries once, and caches a tag:hits table
+    that unionJoin uses to derive alignments for each library
+    '''
+    print ("\n#### Fn: Union aligner ######################")
+    global unionD
+    unionFile   = "./%s/union.tags.fa" % (res_folder)
 
-    afastaL     = dedup_fastatolist(alib)         ## Read
-    acounter    = deduplicate(afastaL )            ## De-duplicate
-    countFile   = dedup_writer(acounter,alib)   ## Write
+    useqs       = set()
+    libtags     = 0 ## Tags in all libraries
+    for alib in libs:
+        for seqid,seq in libTags(alib):
+            useqs.add(seq)
+            libtags += 1
 
-    return countFile
+    fh_out      = open(unionFile,'w')
+    acount      = 0
+    for seq in useqs:
+        acount  += 1
+        fh_out.write(">u_%s\n%s\n" % (acount,seq))
+    fh_out.close()
+    print("Unique tags: %s from %s libraries with %s tags" % (len(useqs),len(libs),libtags))
+    useqs       = None
+
+    ### Union is aligned using all the cores
+    unionD      = {} ## seq:((chr,pos,strand),...)
+    if args.stream and len(indexShards(index)) > 1:
+        unionReader(shardMerge(shardAlign(unionFile,index,nproc)))
+    elif args.stream:
+        aproc   = subprocess.Popen(bowtieCmd(unionFile,index,nproc), stdout=subprocess.PIPE, universal_newlines=True, bufsize=1048576)
+        unionReader(aproc.stdout)
+        aproc.stdout.close()
+        retcode = aproc.wait()
+        if retcode == 0:
+            pass
+        else:
+            print("** Problem with bowtie mapping of %s - Return code not 0" % (unionFile))
+            sys.exit()
+    else:
+        mapFile = "%s.map" % (unionFile)
+        bowtieMap(unionFile,index,nproc,mapFile)
+        fh_in   = open(mapFile,'r')
+        unionReader(fh_in)
+        fh_in.close()
+        os.remove(mapFile)
+    os.remove(unionFile)
+
+    print("Mapped unique tags: %s" % (len(unionD)))
 
-def dedup_fastatolist(alib):
+    return None
+
+def unionReader(fh_in):
     '''
-    New FASTA reader
+    Reads alignments of union tags to tag:hits table, hits are kept in bowtie order
     '''
+    for line in fh_in:
+        seqid,achr,pos,strand,seq = alignRecord(line)
+        unionD.setdefault(seq,[]).append((achr,pos,strand))
 
-    ### Sanity check
+    for seq in unionD:
+        unionD[seq] = tuple(unionD[seq]) ## Compact
+
+    return None
+
+def unionJoin(lib,noise):
+    '''
+    Derives alignments of library by joining its tags against union tag:hits table, 
+    results are same as alignReader on library's own bowtie alignments
+    '''
+    sh          = {}    ## chr/target:[(pos,strand,seqid,seq,abun),...]
+    hits        = {}    ## seqid:hits
+    totalAbun   = 0     ## Total abundance of mapped sRNAs
+
+    for seqid,seq in libTags(lib):
+        ahits   = unionD.get(seq)
+        if not ahits:
+            continue
+        amatch  = re.search(r'\|(\d+)',seqid) or re.search(r'abun\_(\d+)',seqid)
+        if not amatch:
+            print("** Abundance can't be located from the seq_id: %s" % (seqid))
+            sys.exit()
+        abun    = amatch.group(1)
+
+        totalAbun  += int(abun)
+        hits[seqid] = hits.get(seqid,0)+len(ahits)
+
+        if int(abun) <= noise:
+            continue
+
+        for achr,pos,strand in ahits:
+            sh.setdefault(achr,[]).append((pos,strand,seqid,seq,abun))
+
+    print("Alignments joined: %s chr/targets | %s mapped tags | Total abundance: %s" % (len(sh),len(hits),totalAbun))
+
+    return sh,hits,totalAbun
+
+def chrSort(adict):
+    '''
+    Sorts chromosomes numerically, and targets (transcripts/scaffolds) as strings
+    '''
+    return sorted(adict)
+
+def preSplit(sh):
+    '''
+    Splits sRNAs into pre-clusters at 400nt gaps, and keeps only those with
+    enough sRNAs for scoring
+    '''
+    if runType == 'G':
+        minRecs = 9
+    else:
+        minRecs = 3
+
+    sh2         = {}
+    acount      = 0 ## Qualified pre-clusters
+    for achr in chrSort(sh):
+        recs    = sorted(sh[achr],key=lambda x: x[0]) ## Stable sort, hits at same position stay in file order
+        aclust  = [recs[0]]
+        for arec in recs[1:]+[None]:
+            if arec is not None and arec[0] - 400 <= aclust[-1][0]:
+                aclust.append(arec)
+                continue
+            if len(aclust) >= minRecs:
+                sh2.setdefault(achr,[]).extend(aclust)
+                acount += 1
+            aclust = [arec]
+
+    print("Total %s pre-splitted sRNA clusters" % (acount))
+
+    return sh2
+
+def regView(arr,rl):
+    '''
+    Strided view of array where row i is arr[i], arr[i+rl] ... arr[i+10*rl] - 
+    eleven in-register positions
+    '''
+    return np.lib.stride_tricks.as_strided(arr, shape=(arr.shape[0]-10*rl,11), strides=(arr.strides[0],rl*arr.strides[0]), writeable=False)
+
+def phasScore(achr,recs,rl):
+    '''
+    Scores sRNAs of a chromosome/target for a register length. Results are same as 
+    n_calc, k_calc, hm_chen and pha_score_replace from phasis-core
+    '''
+    pad         = 11*rl+3   ## Farthest position that any window reaches
+    chunkLen    = 1 << 22   ## Max positions in one set of arrays
+    
+    pos         = np.array([x[0] for x in recs], dtype=np.int64)
+    strd        = np.array([x[1] == '-' for x in recs], dtype=np.int64)
+    skeys       = np.unique(pos*2+strd)     ## Position-strand slots sorted in order of processing, '+' before '-'
+    spos        = skeys >> 1
+    sminus      = (skeys & 1).astype(bool)
+    nslots      = skeys.shape[0]
+    nA          = np.zeros(nslots,dtype=np.int64)
+    kA          = np.zeros(nslots,dtype=np.int64)
+    best        = np.zeros(nslots,dtype=np.int64)
+
+    pAll        = np.zeros(nslots,dtype=np.float64)
+    ptable      = pvalLoad(rl)
+
+    ### Compress coordinates - gaps longer than any window are shrunk, so arrays
+    ### span only the positions with sRNAs. Very long chr/targets are processed
+    ### in chunks, split at such gaps
+    gaps        = np.minimum(np.diff(spos,prepend=0),pad+1)
+    ccum        = np.cumsum(gaps)
+    starts      = [0]
+    for abreak in np.flatnonzero(gaps > pad).tolist():
+        if abreak > starts[-1] and ccum[abreak-1] - ccum[starts[-1]] > chunkLen:
+            starts.append(abreak)
+    ends        = starts[1:]+[nslots]
+
+    for astart,aend in zip(starts,ends):
+        idx     = np.arange(astart,aend)
+        cc      = pad + np.cumsum(gaps[astart:aend])
+        alen    = int(cc[-1]) + pad + 11*rl + 1
+        isP     = ~sminus[astart:aend]
+        cp      = cc[isP]
+        cm      = cc[~isP]
+
+        plusA   = np.zeros(alen,dtype=np.int8)
+        minusA  = np.zeros(alen,dtype=np.int8)
+        plusA[cp]   = 1
+        minusA[cm]  = 1
+        cumP    = np.cumsum(plusA,dtype=np.int32)
+        cumM    = np.cumsum(minusA,dtype=np.int32)
+
+        ### n: sRNAs in window, from prefix sums
+        ssM     = np.maximum(cm-11*rl+1,pad+1) ## Window can't start before first position
+        nA[idx[isP]]    = (cumP[cp+11*rl-1] - cumP[cp-1]) + (cumM[cp+11*rl-3] - cumM[cp-3])
+        nA[idx[~isP]]   = (cumP[cm] - cumP[ssM-1]) + (cumM[cm+2] - cumM[ssM+1])
+
+        ### k: in-register sRNAs, from strided views
+        viewP   = regView(plusA,rl)
+        viewM   = regView(minusA,rl)
+        kA[idx[isP]]    = viewP[cp].sum(axis=1) + viewM[cp+rl-3].sum(axis=1)
+        kA[idx[~isP]]   = viewM[cm-10*rl].sum(axis=1) + viewP[cm+3-11*rl].sum(axis=1)
+
+        ### p-values, from precomputed table
+        pA      = ptable[nA[astart:aend]*23+kA[astart:aend]]
+        pAll[astart:aend] = pA
+
+        ### Slots in register with each window i.e. phasiRNAs that are re-scored
+        slotP   = np.full(alen,-1,dtype=np.int64)
+        slotM   = np.full(alen,-1,dtype=np.int64)
+        slotP[cp]   = idx[isP]-astart
+        slotM[cm]   = idx[~isP]-astart
+        viewSP  = regView(slotP,rl)
+        viewSM  = regView(slotM,rl)
+        cands   = np.empty((aend-astart,22),dtype=np.int64)
+        cands[isP,:11]  = viewSP[cp]
+        cands[isP,11:]  = viewSM[cp+rl-3]
+        cands[~isP,:11] = viewSM[cm-10*rl]
+        cands[~isP,11:] = viewSP[cm+3-11*rl]
+
+        ### Best window for each slot - lowest p-value, and first processed if tied
+        src     = np.repeat(np.arange(aend-astart),22)
+        tgt     = cands.ravel()
+        keep    = tgt >= 0
+        src,tgt = src[keep],tgt[keep]
+        order   = np.lexsort((src,pA[src],tgt))
+        tgt,src = tgt[order],src[order]
+        first   = np.ones(tgt.shape[0],dtype=bool)
+        first[1:]   = tgt[1:] != tgt[:-1]
+        best[astart+tgt[first]] = astart+src[first]
+
+    ### Collect unique sRNAs of each slot, first hit keeps its id and abundance
+    rslot       = np.searchsorted(skeys,pos*2+strd).tolist()
+    firsts      = {}
+    for arec,aslot in zip(recs,rslot):
+        akey = (aslot,arec[3])
+        if akey not in firsts:
+            firsts[akey] = arec
+
+    scoredL     = []
+    nL,kL,pL,bL = nA.tolist(),kA.tolist(),pAll.tolist(),best.tolist()
+    sposL       = spos.tolist()
+    for akey in sorted(firsts):
+        apos,astrand,seqid,seq,abun = firsts[akey]
+        abest   = bL[akey[0]]
+        scoredL.append((achr,astrand,apos,seqid,seq,len(seq),abun,nL[abest],kL[abest],sposL[abest],pL[abest]))
+
+    return scoredL
+
+def phasWriter(out_file,scoredD,hits,totalAbun,clustBuffer):
+    '''
+    Writes scored sRNAs, clusters at different p-value cutoffs, cluster boundaries
+    and summary - same files and format as phasis-core
+    '''
+    pcutoff     = 0.005                 ## p-value to qualify scored sRNAs
+    cutoffs     = [5e-3,1e-3,5e-4,1e-4,5e-5,1e-5,5e-6,1e-6,5e-7,1e-7]
+    taCut       = 75                    ## Minimum proportion of phase length sRNA abundance in cluster, same as sRNAratio
+    avgHits     = 10                    ## Maximum average hits of sRNAs in a cluster
+    summD       = {}                    ## cutoff:rl:[clusters,phased number]
+    clustD      = {}                    ## cutoff:rl:[qualified clusters]
+
+    for rl in sorted(scoredD):
+        fh_all  = open("%s.output_all_sRNA_%s_out.txt" % (out_file,rl),'w')
+        fh_sc   = open("%s.score_p%s_sRNA_%s_out.txt" % (out_file,perlFormat(pcutoff),rl),'w')
+        qualL   = [] ## Qualified sRNAs, as written to file
+        for ent in scoredD[rl]:
+            aline   = [str(x) for x in ent[:-1]]+[perlFormat(ent[-1])]
+            fh_all.write("%s\n" % ("\t".join(aline)))
+            if ent[-1] < pcutoff:
+                fh_sc.write("%s\n" % ("\t".join(aline)))
+                qualL.append(aline)
+        fh_all.close()
+        fh_sc.close()
+
+        cutClust = phasCluster(qualL,hits,clustBuffer,cutoffs)
+        for acut in sorted(cutoffs,reverse=True):
+            qualClust,phasedNum = clusterCheck(cutClust[acut],hits,rl,taCut,avgHits)
+            summD.setdefault(acut,{})[rl] = [len(qualClust),int(phasedNum*10000000/totalAbun) if totalAbun else 0]
+            if qualClust:
+                clustD.setdefault(acut,{})[rl] = qualClust
+
+    ### Clusters and boundaries ##########
+    if runType == 'G':
+        akey    = "chr"
+    else:
+        akey    = "target"
+
+    fh_list     = open("%s.cluster.boundary.without.PARE.validation.list" % (out_file),'w')
+    for acut in sorted(clustD):
+        for rl in sorted(clustD[acut]):
+            fh_clust = open("%s.score_p%s_sRNA_%s_out.cluster" % (out_file,perlFormat(acut),rl),'w')
+            for i,aclust in enumerate(clustD[acut][rl],1):
+                start,end,achr = clusterBoundary(aclust,rl)
+                fh_clust.write(">cluster = %s | %s = %s and pos between %s and %s\n" % (i,akey,achr,start,end))
+                fh_list.write("%s|%s|%s = %s:%s..%s\n" % (perlFormat(acut),rl,akey,achr,start,end))
+                for arec in aclust:
+                    fh_clust.write("%s\n" % ("\t".join(["o"]+arec)))
+            fh_list.write("\n")
+            fh_clust.close()
+        fh_list.write("\n")
+    fh_list.close()
+
+    ### Summary ##########################
+    fh_summ     = open("%s.summary.sRNA.v1.txt" % (out_file),'w')
+    fh_summ.write("Note:the algorithm is baed on the -m\n")
+    for acut in sorted(summD,reverse=True):
+        fh_summ.write("%s\t" % (perlFormat(acut)))
+        for rl in sorted(summD[acut]):
+            fh_summ.write("%s\t%s\t%s\t\t" % (rl,summD[acut][rl][0],summD[acut][rl][1]))
+        fh_summ.write("\n")
+    fh_summ.close()
+
+    print("Clusters written for %s" % (out_file))
+
+    return None
+
+def phasCluster(qualL,hits,clustBuffer,cutoffs):
+    '''
+    Clusters qualified sRNAs separated by less than cluster buffer, for all
+    p-value cutoffs in one pass - cutoffs are nested, so an sRNA that passes
+    a cutoff passes all the looser ones too
+    '''
+    cutL        = sorted(cutoffs,reverse=True)
+    clustD      = dict((acut,[]) for acut in cutL)  ## cutoff:[clusters]
+    tempChr     = dict((acut,None) for acut in cutL)
+    tempPos     = dict((acut,0) for acut in cutL)
+    for aline in qualL:
+        achr,astrand,apos,seqid,seq,alen,abun,n,k,abest,pval = aline
+        arec    = [achr,astrand,apos,seqid,seq,alen,abun,"n=%s" % (n),"k=%s" % (k),"hts=%s" % (hits[seqid]),abest,pval]
+        apval   = float(pval)
+        ipos    = int(apos)
+        for acut in cutL:
+            if apval > acut: ## Fails this and all stricter cutoffs
+                break
+            clustL = clustD[acut]
+            if achr == tempChr[acut] and ipos - clustBuffer <= tempPos[acut]:
+                clustL[-1].append(arec)
+            else:
+                clustL.append([arec])
+            tempChr[acut] = achr
+            tempPos[acut] = ipos
+
+    return clustD
+
+def clusterCheck(clustL,hits,rl,taCut,avgHits):
+    '''
+    Keeps clusters mainly made of phase length sRNAs, and not from highly repetitive sRNAs
+    '''
+    qualClust   = []
+    phasedNum   = 0
+    for aclust in clustL:
+        total       = 0
+        totalPhase  = 0
+        abunHNA     = 0     ## Hits normalized abundance
+        totalHits   = 0
+        for arec in aclust:
+            abun        = int(arec[6])
+            total       += abun
+            if int(arec[5]) == rl:
+                totalPhase += abun
+            abunHNA     += abun/hits[arec[3]]
+            totalHits   += hits[arec[3]]
+        if 100*totalPhase/total >= taCut and totalHits/len(aclust) <= avgHits:
+            qualClust.append(aclust)
+            phasedNum += abunHNA
+
+    return qualClust,phasedNum
+
+def clusterBoundary(aclust,rl):
+    '''
+    Cluster start and end, from 5' end of first and 3' end of last sRNA
+    '''
+    start       = int(aclust[0][2])
+    if aclust[0][1] == '-':
+        start   = start - (rl-3)
+    end         = int(aclust[-1][2])
+    if aclust[-1][1] == '+':
+        end     = end + rl - 3
+
+    return start,end,aclust[0][0]
+
+def hm_chen(n,k,rl):
+    '''
+    p-value of phasing score, port of 'hm_chen' from phasis-core. Perl's integer
+    and float arithmetic is emulated so that p-values match to the last bit
+    '''
+    p           = 0
+    for w in range(k,23):
+        c,rr,rw = 1,1,1
+        for j in range(w):
+            c   = perlDiv(perlMul(c,n-j),j+1)
+        for x in range(w):
+            rr  = perlDiv(perlMul(rr,22-x),rl*11*2-x)
+        for y in range(n-w):
+            rw  = perlDiv(perlMul(rw,rl*22-22-y),rl*11*2-w-y)
+        p       = perlAdd(p,perlMul(perlMul(c,rr),rw))
+
+    return p
+
+def pvalTable(rl):
+    '''
+    p-values for all n (0 to 22*rl) and k (0 to 22) of a register length, index is n*23+k. 
+    Same series as hm_chen but the products shared by n and k values are computed once
+    '''
+    nmax        = 22*rl
+
+    rrL         = [1]   ## rr for each w
+    for x in range(22):
+        rrL.append(perlDiv(perlMul(rrL[-1],22-x),rl*11*2-x))
+
+    rwL         = []    ## rw for each w and n
+    for w in range(23):
+        rw      = 1
+        acol    = []
+        for n in range(nmax+1):
+            if n > w:
+                y   = n-w-1
+                rw  = perlDiv(perlMul(rw,rl*22-22-y),rl*11*2-w-y)
+            acol.append(rw)
+        rwL.append(acol)
+
+    ptable      = []
+    for n in range(nmax+1):
+        c       = 1
+        prL     = []
+        for w in range(23):
+            if w > 0:
+                c = perlDiv(perlMul(c,n-w+1),w)
+            prL.append(perlMul(perlMul(c,rrL[w]),rwL[w][n]))
+        for k in range(23):
+            p = 0
+            for w in range(k,23):
+                p = perlAdd(p,prL[w])
+            ptable.append(p)
+
+    return ptable
+
+def pvalPrepare(rls):
+    '''
+    Makes p-value tables for register lengths in ancillary folder, or reuses
+    existing ones. These are read by phasis-core and numpy engine
+    '''
+    print ("\n#### Fn: p-value tables #####################")
+    if not os.path.isdir(anc_folder):
+        os.mkdir(anc_folder)
+
+    for rl in rls:
+        afile   = "%s/pvalues_%snt.bin" % (anc_folder,rl)
+        asize   = (22*rl+1)*23*8
+        if os.path.isfile(afile) and os.path.getsize(afile) == asize:
+            print("p-value table for %snt phase      : Re-use" % (rl))
+            continue
+
+        ptable  = pvalTable(rl)
+        fh_out  = open("%s.tmp" % (afile),'wb')
+        fh_out.write(struct.pack("<%sd" % (len(ptable)),*ptable))
+        fh_out.close()
+        os.replace("%s.tmp" % (afile),afile) ## Avoids a partial table from a crash
+        print("p-value table for %snt phase      : Created" % (rl))
+
+    return anc_folder
+
+def pvalLoad(rl):
+    '''
+    Reads p-value table of a register length, cached for the process
+    '''
+    if rl not in pvalD:
+        afile       = "%s/pvalues_%snt.bin" % (anc_folder,rl)
+        if not os.path.isfile(afile):
+            pvalPrepare([rl])
+        pvalD[rl]   = np.fromfile(afile,dtype='<f8')
+
+    return pvalD[rl]
+
+pvalD = {} ## rl:p-value table
+
+def pvalBench():
+    '''
+    Microbenchmark of p-value computation - per-call hm_chen vs. table lookup
+    '''
+    print ("\n#### Fn: p-value benchmark ##################")
+    for rl in (21,22,24):
+        pairs   = [(n,k) for n in range(0,22*rl+1,11) for k in range(0,23,2)]
+
+        tstart  = time.time()
+        percall = [hm_chen(n,k,rl) for n,k in pairs]
+        tcall   = time.time()-tstart
+
+        tstart  = time.time()
+        ptable  = pvalTable(rl)
+        tbuild  = time.time()-tstart
+
+        tstart  = time.time()
+        lookup  = [ptable[n*23+k] for n,k in pairs]
+        tlook   = time.time()-tstart
+
+        if percall != lookup:
+            print("** p-values from table and per-call evaluation differ for %snt" % (rl))
+            sys.exit()
+        print("%snt | pairs:%s | per-call:%.2fus | lookup:%.3fus | speedup:%sx | table build:%.2fs" % (rl,len(pairs),
+            tcall*1e6/len(pairs),tlook*1e6/len(pairs),int(tcall/max(tlook,1e-9)),tbuild))
+
+    return None
+
+def perlIV(x):
+    '''
+    Integer value of a number if Perl would use integer arithmetic on it, else None
+    '''
+    if isinstance(x,int):
+        return x
+    elif x.is_integer() and -(1 << 63) <= x < (1 << 64):
+        return int(x)
+    else:
+        return None
+
+def perlMul(a,b):
+    ai,bi       = perlIV(a),perlIV(b)
+    if ai is not None and bi is not None and -(1 << 63) <= ai*bi < (1 << 64):
+        return ai*bi
+    return float(a)*float(b)
+
+def perlDiv(a,b):
+    ai,bi       = perlIV(a),perlIV(b)
+    if ai is not None and bi is not None and abs(ai) > (1 << 53) and abs(ai) >= abs(bi) and ai % bi == 0:
+        return ai//bi ## Exact integer division, used by Perl only if float can't hold the dividend
+    return float(a)/float(b)
+
+def perlAdd(a,b):
+    ai,bi       = perlIV(a),perlIV(b)
+    if ai is not None and bi is not None and -(1 << 63) <= ai+bi < (1 << 64):
+        return ai+bi
+    return float(a)+float(b)
+
+def perlFormat(x):
+    '''
+    Formats number the way Perl prints it
+    '''
+    if isinstance(x,int):
+        return str(x)
+    return "%.15g" % (x)
+
+def clusterBin(out_file):
+    '''
+    Writes binary companion of each .cluster file of a library
+    '''
+    for apath in libOutputs(out_file):
+        if apath.endswith(".cluster"):
+            clusterBinWrite(apath)
+
+    return None
+
+def clusterBinWrite(clustFile):
+    '''
+    Converts .cluster text to binary companion (.cluster.bin) that can be memory-mapped.
+    Little-endian, each section starts at 8-byte boundary:
+      header  - magic 'PHASCLB1', nclust, nrec, nchr, string table bytes (u64) and key
+                ('chr' or 'target', 8 bytes)
+      clusters- id, chr, start, end (u32 x nclust) and first record (u64 x nclust+1)
+      records - flag, strand (u8 x nrec), chr, pos, abundance, n, k, hits, length,
+                window position (u32 x nrec), p-value (f64 x nrec), and name and sequence
+                offsets to string table (u64 x nrec+1)
+      chrs    - offsets to string table (u64 x nchr+1)
+      strings - chr names, then each record's name and sequence
+    '''
+    binFile     = "%s.bin" % (clustFile)
+    headRe      = re.compile(r"^>cluster = (\d+) \| (\S+) = (\S+) and pos between (\d+) and (\d+)$")
+
+    cluL        = [array.array('I') for i in range(4)]      ## id, chr, start, end
+    crec        = array.array('Q',[0])
+    recU8       = [array.array('B') for i in range(2)]      ## flag, strand
+    recU32      = [array.array('I') for i in range(8)]      ## chr, pos, abun, n, k, hits, len, window
+    pvals       = array.array('d')
+    nameOff     = array.array('Q')
+    seqOff      = array.array('Q')
+    chrD        = {}    ## name:index
+    strtab      = bytearray()
+    recL        = []    ## Names and sequences, after chr names in string table
+    roff        = 0
+    akey        = b"chr"
+
+    fh_in       = open(clustFile,'rb')
+    for line in fh_in:
+        line    = line.rstrip(b"\n")
+        if not line:
+            continue
+        try:
+            if line.startswith(b">"):
+                ahead   = headRe.match(line.decode())
+                akey    = ahead.group(2).encode()
+                achr    = chrD.setdefault(ahead.group(3),len(chrD))
+                for alist,aval in zip(cluL,(int(ahead.group(1)),achr,int(ahead.group(4)),int(ahead.group(5)))):
+                    alist.append(aval)
+                if len(cluL[0]) > 1:
+                    crec.append(len(pvals))
+                continue
+            ent     = line.split(b"\t")
+            achr    = chrD.setdefault(ent[1].decode(),len(chrD))
+            recU8[0].append(ent[0][0])
+            recU8[1].append(0 if ent[2] == b"+" else 1)
+            for alist,aval in zip(recU32,(achr,int(ent[3]),int(ent[7]),int(ent[8][2:]),int(ent[9][2:]),
+                    int(ent[10][4:]),int(ent[6]),int(ent[11]))):
+                alist.append(aval)
+            pvals.append(float(ent[12]))
+        except (AttributeError,IndexError,ValueError,OverflowError):
+            print("** %s has a line binary companion can't hold (format or >4Gb position), it is not written: %s" % (clustFile,line[:80]))
+            fh_in.close()
+            return None
+        nameOff.append(roff)
+        seqOff.append(roff+len(ent[4]))
+        roff   += len(ent[4])+len(ent[5])
+        recL.append(ent[4]+ent[5])
+    fh_in.close()
+    crec.append(len(pvals))
+    if not cluL[0]:
+        crec    = array.array('Q',[0])
+
+    chrOff      = array.array('Q',[0])
+    for aname in sorted(chrD,key=chrD.get):
+        strtab.extend(aname.encode())
+        chrOff.append(len(strtab))
+    abase       = len(strtab)
+    nameOff     = array.array('Q',(x+abase for x in nameOff))
+    seqOff      = array.array('Q',(x+abase for x in seqOff))
+    nameOff.append(abase+roff)
+    seqOff.append(abase+roff)
+    for arec in recL:
+        strtab.extend(arec)
+
+    sectionL    = cluL+[crec]+recU8+recU32+[pvals,nameOff,seqOff,chrOff]
+    if sys.byteorder != "little":
+        for asection in sectionL:
+            asection.byteswap()
+
+    tmpFile     = "%s.tmp" % (binFile)
+    fh_out      = open(tmpFile,'wb')
+    fh_out.write(b"PHASCLB1")
+    fh_out.write(struct.pack("<QQQQ8s",len(cluL[0]),len(pvals),len(chrD),len(strtab),akey))
+    for asection in sectionL:
+        fh_out.write(asection.tobytes())
+        fh_out.write(b"\0"*(-fh_out.tell()%8))
+    fh_out.write(strtab)
+    fh_out.close()
+    os.replace(tmpFile,binFile)
+
+    return binFile
+
+def clusterBinRead(binFile):
+    '''
+    Memory-maps binary companion of .cluster file, arrays are zero-copy views of the file.
+    Returns dict of arrays and key ('chr' or 'target')
+    '''
+    fh_in       = open(binFile,'rb')
+    amap        = mmap.mmap(fh_in.fileno(),0,access=mmap.ACCESS_READ)
+    fh_in.close()
+    if amap[:8] != b"PHASCLB1":
+        print("** %s is not a binary cluster file" % (binFile))
+        sys.exit()
+    nclust,nrec,nchr,nstr,akey = struct.unpack_from("<QQQQ8s",amap,8)
+
+    aview       = memoryview(amap)
+    apos        = 48
+    binD        = {}
+    for aname,atype,alen in (("cid",'I',nclust),("cchr",'I',nclust),("cstart",'I',nclust),("cend",'I',nclust),
+            ("crec",'Q',nclust+1),("flag",'B',nrec),("strand",'B',nrec),("chr",'I',nrec),("pos",'I',nrec),
+            ("abun",'I',nrec),("n",'I',nrec),("k",'I',nrec),("hits",'I',nrec),("len",'I',nrec),("window",'I',nrec),
+            ("pval",'d',nrec),("name",'Q',nrec+1),("seq",'Q',nrec+1),("chroff",'Q',nchr+1)):
+        asize   = alen*struct.calcsize(atype)
+        binD[aname] = aview[apos:apos+asize].cast(atype)
+        apos   += asize+(-asize%8)
+    binD["strings"] = aview[apos:apos+nstr]
+
+    return binD,akey.rstrip(b"\0").decode()
+
+def stageMark():
+    '''
+    Snapshot of clock, resource use and I/O of this process and its finished children, for stageLog
+    '''
+    return time.time(),resource.getrusage(resource.RUSAGE_SELF),resource.getrusage(resource.RUSAGE_CHILDREN),procIO()
+
+def procIO():
+    '''
+    I/O counters of this process from /proc/self/io, these include reaped children. rchar
+    and wchar are all bytes read and written (page cache too), read_bytes and write_bytes
+    the part that reached storage. None if not available (non-Linux)
+    '''
     try:
-        f = open(alib,'r')
-    except IOError:                    
-        print ("The file, %s, does not exist" % (alib))
+        fh_in   = open("/proc/self/io",'r')
+    except OSError:
         return None
+    ioD         = {}
+    for line in fh_in:
+        akey,_,aval = line.partition(":")
+        ioD[akey]   = int(aval)
+    fh_in.close()
 
+    return ioD
 
-    ## Output 
-    fastaL      = [] ## List that holds FASTA tags
+def stageLog(astage,alib,amark,retcode=None,unit=None):
+    '''
+    Appends a JSON line for a stage to run log - wall time, CPU time since amark for this
+    process and its finished child processes (bowtie, phasis-core, pool workers) separately,
+    and I/O since amark of both together. I/O is process wide, stages running at the same
+    time in threads of a process see each other's I/O. Peak RSS is not per stage - it is the
+    high-water mark of process, and of its largest finished child, till end of stage. Lines
+    are appended in one write, so workers can share the log
+    '''
+    if not stageFile:
+        return None
 
-    print("Reading FASTA file:%s" % (alib))
-    read_start  = time.time()
-    
-    acount      = 0
-    empty_count = 0
-    for line in f:
-        if line.startswith('>'):
-            seq = ''
-            pass
-        else:
-          seq = line.rstrip('\n')
-          fastaL.append(seq)
-          acount += 1
+    tend        = time.time()
+    aself       = resource.getrusage(resource.RUSAGE_SELF)
+    achild      = resource.getrusage(resource.RUSAGE_CHILDREN)
+    aio         = procIO()
+    recD        = collections.OrderedDict()
+    recD["time"]        = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    recD["stage"]       = astage
+    recD["lib"]         = alib.rpartition("/")[-1]
+    if unit is not None:
+        recD["unit"]    = unit
+    recD["pid"]         = os.getpid()
+    recD["wall_s"]      = round(tend-amark[0],3)
+    for akey,anew,aold in (("self",aself,amark[1]),("child",achild,amark[2])):
+        recD["cpu_%s_s" % (akey)]      = round((anew.ru_utime-aold.ru_utime)+(anew.ru_stime-aold.ru_stime),3)
+        recD["peakrss_%s_mb" % (akey)] = round(anew.ru_maxrss/1024,1) ## High-water mark so far, KB on Linux
+    for akey,aname in (("read_bytes","rchar"),("write_bytes","wchar"),("disk_read_bytes","read_bytes"),("disk_write_bytes","write_bytes")):
+        recD[akey]      = aio[aname]-amark[3][aname] if aio and amark[3] else None
+    recD["exit"]        = retcode
+
+    fd          = os.open(stageFile,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+    os.write(fd,("%s\n" % (json.dumps(recD))).encode())
+    os.close(fd)
 
-    read_end    = time.time()
-    # print("-- Read time: %ss" % (str(round(read_end-read_start,2))))
-    print("Cached file: %s | Tags: %s | Empty headers: %ss" % (alib,acount,empty_count)) 
+    return None
+
+def runParams():
+    '''
+    Parameters that decide results of a run, a run can be resumed only with same ones. Engines
+    write same results so engine is not one of them
+    '''
+    if index:
+        aref    = "index:%s" % (index)
+    else:
+        aref    = "reference:%s" % (fileHash(reference))
+    aparams     = "runType:%s|phase:%s|minDepth:%s|clustBuffer:%s|deg:%s|%s" % (runType,
+        ",".join(str(x) for x in phase),minDepth,clustBuffer,deg,aref)
+    if args.clusterbin:
+        aparams += "|clusterbin"
 
-    return fastaL
-                   
-def deduplicate(afastaL):
+    return aparams
+
+def libPrefix(alib):
     '''
-    De-duplicates tags using multiple threads and libraries using multiple cores
+    Output file prefix of a user library, same for tag count and converted FASTA/FASTQ
     '''
-    dedup_start  = time.time()
+    return './%s/%s.txt' % (res_folder,alib.rpartition(".")[0])
 
-    # deList = [] ## Hold deduplicated tags and their abudnaces in a tuple
+def libOutputs(out_file):
+    '''
+    Result files of a library in results folder
+    '''
+    aprefix     = "%s." % (out_file.rpartition("/")[-1])
+    outL        = []
+    for afile in sorted(os.listdir(res_folder)):
+        apath   = "%s/%s" % (res_folder,afile)
+        if afile.startswith(aprefix) and not afile[len(aprefix):].startswith("done") and os.path.isfile(apath):
+            outL.append(apath)
 
-    acounter    = collections.Counter(afastaL)
+    return outL
 
-    dedup_end  = time.time()
-    # print("-- dedup time: %ss" % (str(round(dedup_end-dedup_start,2))))
+def libDone(out_file):
+    '''
+    Writes completion marker of a library - library hash, run parameters and size, hash
+    of each result file. Marker is written last, so its presence means library finished
+    '''
+    alib,ahash  = libOrigin[out_file]
+    markFile    = "%s.done" % (out_file)
+    tmpFile     = "%s.tmp" % (markFile)
+    fh_out      = open(tmpFile,'w')
+    fh_out.write("@lib:%s\n@libhash:%s\n@params:%s\n" % (alib,ahash,runKey))
+    for apath in libOutputs(out_file):
+        fh_out.write("@file:%s\t%s\t%s\n" % (apath.rpartition("/")[-1],os.path.getsize(apath),fileMD5(apath)))
+    fh_out.close()
+    os.replace(tmpFile,markFile)
 
-    return acounter 
+    return None
 
-def dedup_writer(acounter,alib):
+def libVerify(alib,ahash):
     '''
-    writes rtag count to a file
+    Checks if results of a library are complete and unchanged since its marker was written
     '''
+    out_file    = libPrefix(alib)
+    markFile    = "%s.done" % (out_file)
+    if not os.path.isfile(markFile):
+        return False
+
+    markD       = {}
+    fileL       = []
+    fh_in       = open(markFile,'r')
+    for line in fh_in:
+        akey,_,value = line.rstrip("\n").partition(":")
+        if akey == "@file":
+            fileL.append(value.split("\t"))
+        else:
+            markD[akey] = value
+    fh_in.close()
 
-    print("Writing counts file for %s" % (alib))
-    countFile   = "%s.fas" % alib.rpartition('.')[0]  ### Writing in de-duplicated FASTA format as required for phaster-core
-    fh_out       = open(countFile,'w')
+    if markD.get("@libhash") != ahash or markD.get("@params") != runKey or not fileL:
+        return False
+    for afile,asize,amd5 in fileL:
+        apath   = "%s/%s" % (res_folder,afile)
+        if not os.path.isfile(apath) or os.path.getsize(apath) != int(asize) or fileMD5(apath) != amd5:
+            return False
 
-    acount      = 0
-    seqcount    = 1 ## TO name seqeunces
-    for i,j in acounter.items():
-        # fh_out.write("%s\t%s\n" % (i,j))
-        fh_out.write(">seq_%s|%s\n%s\n" % (seqcount,j,i))
-        acount      += 1
-        seqcount    += 1
+    return True
 
-    print("Total unique entries written for %s: %s" % (alib,acount))
+def libClean(out_file):
+    '''
+    Removes marker and partial results of a library before it is phased again
+    '''
+    for apath in libOutputs(out_file)+["%s.done" % (out_file)]:
+        if os.path.isfile(apath):
+            os.remove(apath)
+    if os.path.isdir("%s.units" % (out_file)):
+        shutil.rmtree("%s.units" % (out_file))
+
+    return None
+
+def fileMD5(afile):
+    '''
+    MD5 of a result file, read in chunks
+    '''
+    amd5        = hashlib.md5()
+    fh_in       = open(afile,'rb')
+    for achunk in iter(lambda: fh_in.read(8*1024**2), b''):
+        amd5.update(achunk)
+    fh_in.close()
+
+    return amd5.hexdigest()
 
+def manifestWrite(libs,statusD,keepL):
+    '''
+    Writes run manifest to results folder - run parameters and hash, status of each library.
+    Libraries of earlier run that are not in this one are kept as these were
+    '''
+    manFile     = "%s/phasis.run" % (res_folder)
+    tmpFile     = "%s.tmp" % (manFile)
+    fh_out      = open(tmpFile,'w')
+    fh_out.write("@params:%s\n" % (runKey))
+    for ent in keepL:
+        fh_out.write("@lib:%s\n" % ("\t".join(ent)))
+    for alib in libs:
+        fh_out.write("@lib:%s\t%s\t%s\n" % (alib,libOrigin[libPrefix(alib)][1],statusD[alib]))
     fh_out.close()
+    os.replace(tmpFile,manFile)
 
-    return countFile
+    return None
+
+def resumeCheck(libs):
+    '''
+    Checks libraries against run manifest of earlier run, ones with complete and verified
+    results are skipped and rest are returned for phasing
+    '''
+    print ("\n#### Fn: Resume check #######################")
+    aflag       = "--add" if args.add else "--resume"
+    manFile     = "%s/phasis.run" % (res_folder)
+    if not os.path.isfile(manFile):
+        print("** %s - run manifest not found, can't use '%s' with this folder" % (manFile,aflag))
+        print("** Is it a results folder from phasdetect? Start a new run without '%s'" % (aflag))
+        print("** Script will exit for now\n")
+        sys.exit()
+
+    aparams     = ''
+    keepL       = [] ## Libraries of earlier run that are not in this one - (lib,hash,status)
+    fh_in       = open(manFile,'r')
+    for line in fh_in:
+        akey,_,value = line.rstrip("\n").partition(":")
+        if akey == "@params":
+            aparams = value
+        elif akey == "@lib":
+            ent     = value.split("\t")
+            if ent[0] not in libs:
+                keepL.append(tuple(ent))
+    fh_in.close()
+
+    if aparams != runKey:
+        print("** Settings differ from the run in %s" % (res_folder))
+        print("** Earlier run : %s" % (aparams))
+        print("** This run    : %s" % (runKey))
+        print("** Start a new run without '%s' or use same settings" % (aflag))
+        print("** Script will exit for now\n")
+        sys.exit()
+
+    pendL       = []
+    for alib in libs:
+        if libVerify(alib,libOrigin[libPrefix(alib)][1]):
+            print("%s: complete and verified - skipped" % (alib))
+        else:
+            print("%s: new, missing or incomplete - will be phased" % (alib))
+            libClean(libPrefix(alib))
+            pendL.append(alib)
+    if keepL:
+        print("Libraries kept from earlier run  : %s" % (len(keepL)))
+
+    return pendL,keepL
+
+def runMem(genoIndex):
+    '''
+    Reference and index hashes of run, from memory file of index cache or hashed for
+    user specified index
+    '''
+    memD        = {}
+    if index:
+        memD['@genomehash'] = "NA"
+        memD['@index']      = genoIndex
+        memD['@indexhash']  = indexHasher(genoIndex)
+    else:
+        fh_in   = open(memFile,'r')
+        for line in fh_in:
+            akey,_,value = line.rstrip("\n").partition(":")
+            memD[akey] = value
+        fh_in.close()
+
+    return memD
+
+def runMemCheck(genoIndex):
+    '''
+    Keeps memory file of run in results folder, an earlier one is checked so libraries
+    added or resumed later are phased with same reference and index
+    '''
+    resMem      = "%s/%s" % (res_folder,memFile)
+    memD        = runMem(genoIndex)
+    if (args.resume or args.add) and os.path.isfile(resMem):
+        fh_in   = open(resMem,'r')
+        for line in fh_in:
+            akey,_,value = line.rstrip("\n").partition(":")
+            if akey in ('@genomehash','@indexhash') and memD.get(akey) != value:
+                print("** %s of this run differs from run in %s" % (akey.lstrip('@'),res_folder))
+                print("** Earlier run : %s | This run : %s" % (value,memD.get(akey)))
+                print("** Libraries must be phased with same reference and index to be summarized together")
+                print("** Script will exit for now\n")
+                sys.exit()
+        fh_in.close()
+        print("Reference and index              : same as earlier run")
+    else:
+        fh_out  = open(resMem,'w')
+        fh_out.write("@timestamp:%s\n" % (datetime.datetime.now().strftime("%m_%d_%H_%M")))
+        for akey in ('@genomehash','@index','@indexhash'):
+            fh_out.write("%s:%s\n" % (akey,memD.get(akey,'')))
+        fh_out.close()
+
+    return memD
+
+def stageDAG(stageD,poolD):
+    '''
+    Stage DAG executor - a stage starts as soon as stages it depends on are done. stageD is
+    name:(function,arguments,dependencies,where), function gets arguments followed by results
+    of dependencies. where is 'main' (run here, can set globals and make pools), 'thread'
+    (background thread, for stages waiting on subprocesses or disk) or name of a process
+    pool in poolD, that an earlier stage can fill. Returns name:result, exits if a stage fails
+    '''
+    doneQ       = queue.Queue() ## (name,success,result) of stages finished in threads and pools
+    tpool       = ThreadPoolExecutor(max_workers=max(1,sum(1 for x in stageD.values() if x[3] == 'thread')))
+    resultD     = {}
+    pendD       = dict(stageD)
+    running     = 0
+    while pendD or running:
+        readyL  = [x for x in pendD if all(y in resultD for y in pendD[x][2])]
+        inline  = False
+        for aname in readyL:
+            afunc,aargs,deps,where = pendD.pop(aname)
+            aargs   = tuple(aargs)+tuple(resultD[x] for x in deps)
+            if where == 'main':
+                resultD[aname] = afunc(*aargs)
+                inline  = True
+                break   ## Stages it unblocks are picked next
+            running += 1
+            if where == 'thread':
+                afuture = tpool.submit(stageCall,afunc,aargs)
+                afuture.add_done_callback(lambda x,aname=aname: doneQ.put((aname,x.exception() is None,x.exception() or x.result())))
+            else:
+                poolD[where].apply_async(stageCall,(afunc,aargs),
+                    callback=lambda x,aname=aname: doneQ.put((aname,True,x)),
+                    error_callback=lambda x,aname=aname: doneQ.put((aname,False,x)))
+        if inline:
+            continue
+        if not running:
+            print("** Stages %s depend on stages that are not defined" % (",".join(sorted(pendD))))
+            sys.exit()
+
+        aname,aok,ares = doneQ.get()
+        running -= 1
+        if not aok:
+            print("** Stage %s failed: %s" % (aname,ares))
+            print("** Script will exit for now\n")
+            for apool in poolD.values():
+                apool.terminate()
+            sys.exit()
+        resultD[aname] = ares
+    tpool.shutdown()
+
+    return resultD
+
+def stageCall(afunc,aargs):
+    '''
+    Runs function of a stage in pool or thread, exit is raised as error so that it
+    reaches stageDAG instead of ending the worker silently
+    '''
+    try:
+        return afunc(*aargs)
+    except SystemExit as err:
+        raise RuntimeError("%s exited (%s)" % (afunc.__name__,err.code))
+
+def indexStage(fh_run,acores,apool):
+    '''
+    Index stage of run - user specified index, or from cache where it is made if missing on
+    acores. apool is made by main for cleaning of reference, as this stage runs in a thread
+    '''
+    if index:
+        return index
+
+    tstart      = time.time()
+    amark       = stageMark()
+    genoIndex   = indexCache(reference,acores,apool)
+    if apool:
+        apool.close() ## Workers leave once index is ready, main joins these
+    stageLog("index","ALL",amark)
+    tend        = time.time()
+    fh_run.write("Indexing Time:%ss\n" % (round(tend-tstart,2)))
+
+    return genoIndex
+
+def convertStage(fh_run,tstart,amark,*countFiles):
+    '''
+    Conversion stage of run, done when all libraries are converted to counts
+    '''
+    stageLog("conversion","ALL",amark)
+    fh_run.write("FASTA conversion time:%ss\n" % (round(time.time()-tstart,2)))
+
+    return list(countFiles)
+
+def planStage(userLibs,libs,keepL,statusD,poolD,genoIndex):
+    '''
+    Planning stage of run, once index is ready - checks and records run, and plans
+    libraries phased in parallel. Phasing pool is made here, after libraries format
+    is updated for converted libraries. Returns index, threads and libraries in parallel
+    '''
+    global runKey,alignIndex,nthread,nconc
+    memD        = runMemCheck(genoIndex)
+    alignIndex  = memD.get('@indexhash','')
+    if not (args.resume or args.add):
+        runKey  = runParams()
+        for alib in userLibs:
+            libOrigin[libPrefix(alib)] = (alib,fileHash(alib))
+        statusD.update((alib,"pending") for alib in userLibs)
+        manifestWrite(userLibs,statusD,keepL)
+
+    pvalPrepare(phase)
+    nthread,nconc = concPlanner(libs,genoIndex)
+    if not (args.union or args.schedule):
+        print("nprocPP                          : %s" % (nconc))
+        poolD["phase"] = Pool(int(nconc))
+
+    return genoIndex,nthread,nconc
+
+def phaseStage(alib,apos,ashare,aplan,*countFiles):
+    '''
+    Phasing stage of a library, once index is made and library and longer ones are converted,
+    count file of library is the last one. Threads are decided as it starts, from cores in
+    ashare left by running libraries
+    '''
+    genoIndex,_,aconc = aplan
+    countFile   = countFiles[-1] if countFiles else None
+    athread     = libThreads(ashare,apos,aconc)
+    print("Bowtie threads for %s: %s" % (alib,athread))
+    aninput     = inputList([countFile or alib],runType,genoIndex,deg,athread,noiseLimit,hitsLimit,clustBuffer)[0]
+    try:
+        return PHASLib(aninput)
+    finally:
+        libThreadsFree(ashare,athread)
+
+def phaseAllStage(libs,aplan,countFiles=None):
+    '''
+    Phasing stage of all libraries together, for union alignment and scheduler
+    '''
+    genoIndex,athread,_ = aplan
+    rawInputs   = inputList(libOrder(countFiles or libs)[0],runType,genoIndex,deg,athread,noiseLimit,hitsLimit,clustBuffer)
+    if args.union:
+        amark       = stageMark()
+        unionAlign(countFiles or libs,genoIndex)
+        stageLog("unionAlign","ALL",amark)
+
+    if args.schedule:
+        PHASSchedule(rawInputs)
+    else:
+        PPBalance(PHASLib,rawInputs)
+
+    return None
+
+def PHASLib(aninput):
+    '''
+    Phases a library with selected engine. A failed library doesn't stop others, it is
+    reported at the end and can be re-run with '--resume'
+    '''
+    lib         = aninput[0]
+    out_file    = './%s/%s.txt' % (res_folder,lib.rpartition(".")[0])
+    try:
+        if args.engine == 'numpy':
+            PHASBatchNP(aninput)
+        else:
+            PHASBatch2(aninput)
+        if args.clusterbin:
+            clusterBin(out_file)
+    except (Exception,SystemExit):
+        print("** Phasing failed for %s - other libraries will continue" % (lib))
+        return lib,False
+
+    libDone(out_file)
+
+    return lib,True
 
 #### MAIN ###################################################
 #############################################################
 
 def main(libs):
 
+    global libFormat ## Updated after conversion of FASTA/FASTQ libraries
+    global runKey,stageFile
+    userLibs        = list(libs)
     ### Open the runlog
     runLog          = 'runtime_%s' % datetime.datetime.now().strftime("%m_%d_%H_%M")
     fh_run          = open(runLog, 'w')
+    stageFile       = os.path.abspath("%s.jsonl" % (runLog)) ## Per-stage and per-library records
     phaser_start    = time.time()
+    runMark         = stageMark()
 
     ### 0. Prepare index or reuse old #############
     ###############################################
 
-    ## Did user provided its index? If Yes Skip making memory files
+    ## Did user provided its index? If Yes use it, else fetch from cache
     if not index:
-        ### Check genome file and index
-        if not os.path.isfile(memFile):
-            print("This is first run - create index")
-            indexflag = False       ## index will be made on fly
-        
-        else:
-            memflag     = readMem(memFile)
-            if memflag  == False:
-                print("Memory file is empty - seems like previous run crashed")
-                print("Creating index")
-                indexflag = False   ## index will be made on fly
-
-            elif memflag  == True:
-                ## valid memory file detected - use existing index 
-                print("Generating MD5 hash for current reference file")
-                currentRefHash = hashlib.md5(open('%s' % (reference),'rb').read()).hexdigest()
-                print('Current reference hash           :',currentRefHash)
-                
-                #### Test #######
-                # if os.path.isdir(index.rpartition('/')[0]):
-                #     print("There is a folder names 'index'")
-                #     pass
-                
-                # if currentRefHash == existRefHash:
-                #     print("current ref. hash is same as exiting ref hash")
-                #     pass
-                # sys.exit()
-
-                if currentRefHash == existRefHash:
-                    # print("Current reference file matches with the earlier run")
-                    indexIntegrity,indexExt = indexIntegrityCheck(index)
-                    if indexIntegrity:          ### os.path.isdir(index.rpartition('/')[0]):
-                        print("Index status                     : Re-use")
-                        genoIndex   = index
-                        indexflag   = True
-                        fh_run.write("Indexing Time: 0s\n")
-                    else:
-                        print("Index status                     : Re-make")
-                        indexflag   = False   ## index will be made on fly
-                else:
-                    ## Different reference file - index will be remade
-                    print("Index status                     : Re-make")
-                    indexflag       = False
-                    print("Existing index does not matches specified genome - It will be recreated")
-
-
-        if indexflag == False:
-            ## index will be remade
-
-            ## original function - active
-            tstart      = time.time()
-            genoIndex   = indexBuilder(reference)
-            tend        = time.time()
-            fh_run.write("Indexing Time:%ss\n" % (round(tend-tstart,2)))
-
-            # ## parallel function - not used - slow on large genomes like wheat due to I/O of data to different cores
-            # fastaL                  = FASTAread(reference)
-            # ## Test - Serial mode
-            # # cleanFasL = []
-            # # for ent in fastaL:
-            # #     bname,bseq = FASTAclean(ent)
-            # #     cleanFasL.append((bname,bseq))
-            # cleanFasL               = PPResults(FASTAclean,fastaL)
-            # fastaclean,fastasumm    = FASTAwrite(reference,cleanFasL,0)
-            # genoIndex               = indexBuilder(reference)
-            # tend                    = time.time()
-            # fh_run.write("Indexing Time:%ss\n" % (round(tend-tstart,2)))
-
+        ## Reference is hashed while libraries are converted, index is fetched after that
+        hashStart(reference)
 
     else:        
         genoIndex = index
-        if not (os.path.isfile("%s.1.ebwt" % (genoIndex)) or os.path.isfile("%s.1.ebwtl" % (genoIndex))) :
+        if not indexExists(genoIndex):
             print("** %s - User specified index not found" % (genoIndex))
             print("** Please check the value for @index parameter in settings file")
             print("** Is it in specified directory? Did you input wrong name?")
@@ -1139,39 +3727,56 @@ def main(libs):
             fh_run.write("Indexing Time: 0s\n")
             pass
 
+    if not (args.resume or args.add):
+        ## Libraries are hashed for run manifest while these are converted
+        for alib in libs:
+            hashStart(alib)
+
 
     ### 1. Make Folders ###########################
     ###############################################
-    shutil.rmtree("%s" % (res_folder),ignore_errors=True)
-    os.mkdir("%s" % (res_folder))
+    if args.resume or args.add:
+        ## Earlier results are kept, only new or incomplete libraries are phased
+        if not os.path.isdir(res_folder):
+            print("** %s - results folder of earlier run not found" % (res_folder))
+            print("** Script will exit for now\n")
+            sys.exit()
+        runKey      = runParams()
+        for alib in libs:
+            libOrigin[libPrefix(alib)] = (alib,fileHash(alib))
+        libs,keepL  = resumeCheck(libs)
+        statusD     = dict((alib,"pending" if alib in libs else "done") for alib in userLibs)
+        manifestWrite(userLibs,statusD,keepL)
+        if not libs:
+            print("All libraries are complete in %s, nothing to phase" % (res_folder))
+            hashStop()
+            fh_run.close()
+            return None
+    else:
+        keepL       = []
+        statusD     = {} ## Filled once reference is hashed, in planStage
+        shutil.rmtree("%s" % (res_folder),ignore_errors=True)
+        os.mkdir("%s" % (res_folder))
 
     #### 2. File conversions#######################
     ###############################################
 
-    if libFormat    == "F":
-        ### Convert FASTA to Tagcount
+    if libFormat    == "F" or libFormat == "Q":
+        ### Convert FASTA/FASTQ to Tagcount, plain or gzip/bgzip compressed
         ### Sanity check
-        fh_in       = open(libs[0],'r')
-        firstline   = fh_in.readline()
-        if not firstline.startswith('>') and len(firstline.split('\t')) > 1:
+        alines      = dedup_lines(libs[0],1)
+        firstline   = next(alines,'')
+        alines.close()
+        if libFormat == "F" and not firstline.startswith('>') and len(firstline.split('\t')) > 1:
             print("** File doesn't seems to be in FASTA format")
             print("** Please provide correct setting for @libFormat in 'phasis.set' settings file")
             sys.exit()
+        elif libFormat == "Q" and not firstline.startswith('@'):
+            print("** File doesn't seems to be in FASTQ format")
+            print("** Please provide correct setting for @libFormat in 'phasis.set' settings file")
+            sys.exit()
         else:
-            print("#### Converting FASTA format to counts #######")
-            dedup_start     = time.time()
-            
-            ## TEST
-            # newList = []
-            # for alib in libs:
-            #     aname = dedup_process(alib)
-            #     newList.append(aname)
-            # libs = newList
-
-            libs            = PPResults(dedup_process,libs)
-            # print('Converted libs: %s' % (libs))
-            dedup_end       = time.time()
-            fh_run.write("FASTA conversion time:%ss\n" % (round(dedup_end-dedup_start,2)))
+            print("#### Converting %s format to counts, while index is made #######" % ("FASTA" if libFormat == "F" else "FASTQ"))
         
     elif libFormat  == "T": 
         ### Can be used as-is, check if it is really 
@@ -1188,30 +3793,99 @@ def main(libs):
 
     else:
         print("** Please provide correct setting for @libFormat in 'phasis.set' settings file")
-        print("** If sRNA data is in tag count format use 'T' and for FASTA format use 'F' ")
+        print("** If sRNA data is in tag count format use 'T', for FASTA format use 'F' and for FASTQ use 'Q'")
         sys.exit()
 
 
-    #### 3. Run Phaser ############################
+    #### 3. Index, conversion and phasing ########
     ###############################################
-
-    # print('These are the libs: %s' % (libs))
-    rawInputs = inputList(libs,runType,genoIndex,deg,nthread,noiseLimit,hitsLimit,clustBuffer)
-
-    # ### Test - Serial Mode
-    # for aninput in rawInputs:
-    #     PHASBatch2(aninput)
-
-    #### Original - Parallel mode
-    PPBalance(PHASBatch2,rawInputs)
+    ## Stages run as a DAG - index is made while libraries are converted, and a 
+    ## library is phased once index, the library and all longer libraries are ready
+    amark           = stageMark()
+    convert         = libFormat in ("F","Q")
+    libs,workL      = libOrder(libs) ## Longest first, so that a large library doesn't start last
+    amanager        = multiprocessing.Manager()
+    ashare          = libShare(amanager,workL) ## Passed to dedup and phase stages in pool workers
+    poolD           = {}
+    stageD          = {} ## name:(function,arguments,dependencies,where)
+    if index:
+        idxCores    = 0
+    elif convert:   ## Cores are split between index and de-duplication
+        idxCores    = max(1,min(int(nproc)-1,int(int(nproc)*index_share)))
+    else:
+        idxCores    = int(nproc)
+    if idxCores > 1: ## Made here and not in index thread, forking from a thread is not safe
+        poolD["index"] = Pool(idxCores)
+    stageD["index"] = (indexStage,(fh_run,idxCores,poolD.get("index")),[],'thread')
+    stageD["plan"]  = (planStage,(userLibs,libs,keepL,statusD,poolD),["index"],'main')
+    if convert:
+        poolD["dedup"] = Pool(max(1,min(len(libs),int(nproc)-idxCores)))
+        libFormat   = "F" ## Counts are written in FASTA format, dedup workers are made with user format
+        for alib in libs:
+            stageD["dedup:%s" % (alib)] = (dedup_process,(alib,ashare),[],'dedup')
+        stageD["converted"] = (convertStage,(fh_run,time.time(),stageMark()),["dedup:%s" % (x) for x in libs],'main')
+
+    if args.union or args.schedule:
+        stageD["phase"] = (phaseAllStage,(libs,),["plan"]+(["converted"] if convert else []),'main')
+    else:
+        for apos,alib in enumerate(libs):
+            ## Held until longer libraries are converted, so these are submitted (and started) first
+            stageD["phase:%s" % (alib)] = (phaseStage,(alib,apos,ashare),["plan"]+(["dedup:%s" % (x) for x in libs[:apos+1]] if convert else []),'phase')
+
+    stageDAG(stageD,poolD)
+    for apool in poolD.values():
+        apool.close()
+        apool.join() ## Workers are reaped, so these count in resource use of children
+    amanager.shutdown()
+    stageLog("phasing","ALL",amark)
+    hashStop()
+
+    ### Library is done only if its marker was written
+    failL       = []
+    for alib in userLibs:
+        if statusD[alib] == "pending":
+            if os.path.isfile("%s.done" % (libPrefix(alib))):
+                statusD[alib] = "done"
+            else:
+                statusD[alib] = "failed"
+                failL.append(alib)
+    manifestWrite(userLibs,statusD,keepL)
 
     #### close runLog
     phaser_end = time.time()
     fh_run.write("Total analysis time:%ss\n" % (round(phaser_end-phaser_start,2)))
     fh_run.close()
+    stageLog("total","ALL",runMark)
+
+    if failL:
+        print("\n** Phasing failed for %s of %s libraries: %s" % (len(failL),len(userLibs),",".join(failL)))
+        print("** Results of other libraries are kept, fix the issue and resume with:")
+        print("** python3 phasdetect --resume %s\n" % (res_folder))
+        sys.exit(1)
 
 if __name__ == '__main__':
 
+    #### p-value microbenchmark
+    if args.pvalbench:
+        pvalBench()
+        sys.exit()
+
+    #### Alignment cache
+    if args.purge:
+        if os.path.isfile(setFile): ## Phaster path of settings decides cache folder
+            readSet(setFile)
+        cacheDirs()
+        alignCachePurge()
+        sys.exit()
+
+    #### Packed library converters
+    if args.pack or args.unpack:
+        for alib in (args.pack or []):
+            tagPack(alib)
+        for apack in (args.unpack or []):
+            tagUnpack(apack)
+        sys.exit()
+
     #### Cores to use for analysis
     nproc = coreReserve(cores)
     ###############
@@ -1220,11 +3894,13 @@ if __name__ == '__main__':
     # checkHost(allowedHost)
     global reference
     libs        = readSet(setFile)
-    nthread     = optimize(nproc)
+    cacheDirs()
     main(libs)    
     print('\n\n#### Phasing Analysis finished successfully')
     print("#### Results are in folder: %s" % (res_folder))
-    print("#### 'phasmerge' can be run by command: python3 phasmerge -mode merge -dir %s\n" % (res_folder))
+    for aphase in phase:
+        print("#### 'phasmerge' can be run by command: python3 phasmerge -mode merge -dir %s -phase %s" % (res_folder,aphase))
+    print("")
     sys.exit()
 
 ########### CHANGE LOG ########
@@ -1322,6 +3998,41 @@ if __name__ == '__main__':
 ## Fixed issue with index extension determination for big genomes
 ## organized the index builder call in main(). It is now called at one place
 
+## v1.07 -> v1.08
+## Added in-process numpy phasing engine (--engine numpy), a port of phasis-core that scores with prefix sums
+#### and strided views and writes byte-compatible .cluster/.list files
+## p-value tables for each phase length are precomputed to 'ancillary' folder and used by both engines (-pt for phasis-core)
+## Added '--pvalbench' microbenchmark for p-value table lookup vs. per-call evaluation
+## Added '--stream' mode, alignments are read from bowtie pipe and noise-filtered on the fly (-st for phasis-core)
+## Added '--schedule' for numpy engine, scoring of all libraries runs as (library, chromosome, register) units in one pool
+## Added '--union' for numpy engine, unique tags from all libraries are aligned once and joined per library
+## Bowtie indexes are kept in a shared content-addressed cache (index_cache) with LRU eviction under index_quota,
+#### replaces single reference tracking and re-building of './index' when references are switched
+## Reference and index are hashed in chunks, with stat fingerprint check and background hashing during library de-duplication
+## FASTAClean streams the reference one record at a time, peak memory no longer scales with genome size
+## Big references are cleaned in parallel, shards are split at entry boundaries by byte offset and concatenated in order
+## FASTA libraries are de-duplicated within a memory budget (dedup_mem), sorted runs are spilled to disk and k-way merged
+## '@libFormat' accepts FASTQ (Q), and FASTA/FASTQ can be gzip or bgzip compressed - bgzip blocks are inflated in parallel threads,
+#### gzip by pigz in a separate process, and tags are de-duplicated straight from the stream
+## '@phase' accepts a list like 21,24 - libraries are aligned once and all registers are scored in the same run
+## Run manifest (phasis.run) and per-library completion markers in results folder, '--resume' skips verified libraries and re-runs
+#### missing or failed ones - a failed library no longer stops others
+## '--add' phases new libraries into results folder of an earlier run, reference and index hashes are checked against phasis.mem kept there
+## JSON-lines log (runtime_*.jsonl) with wall/CPU time, peak RSS high-water mark, I/O from /proc/self/io and exit code of each stage and library, children from getrusage
+## concPlanner replaces optimize - libraries in parallel and threads for each fit both cores (affinity, cgroup quota) and memory (cgroup,
+#### MemAvailable), memory of a library is estimated from index size and its unique tags
+## '--clusterbin' writes .cluster.bin next to each .cluster - columnar arrays, cluster offsets and string table, clusterBinRead memory-maps it
+## Packed 2-bit tag count library (.tpk) with '--pack'/'--unpack' converters, format is in phastpk module shared with phasmerge
+## Single pass clustering for all p-value cutoffs in phasis-core and numpy engine, no per-cutoff re-read or temp files
+## Transcript/scaffold scoring is sharded by sRNA hits - phasis-core MUL script forks shards (-cpu), '--schedule' deals targets to balanced units
+## Alignment cache (align_cache) keyed by library, index, mismatches and -m ceiling, LRU eviction under align_quota and '--purge'
+## phasis-core reads cached alignments from a file (-al) and skips bowtie
+## Stage DAG executor (stageDAG) in main - index is made in a thread on its share of cores (index_share) while libraries are de-duplicated on the rest, each library is phased once index and it are ready
+## Libraries are phased longest first (libOrder), bowtie threads of a starting library are its work share of free cores (libThreads)
+## - converted libraries are held until longer ones are converted, and cores of running de-duplication are not free; counters are on a manager, passed to stages (libShare)
+## Added '--shards', reference is partitioned to shards balanced by length and shard indexes are made in parallel; hits of all shards are merged with the -m ceiling applied across shards (phasis-core reads these with -al)
+## '--no-lowmem' turns off '--lowmem', that was always on - indexes can be built with --noauto --dcv 256 --bmaxdivn 6
+
 
 ## TO-DO
 ## Add automatic index resolution
@@ -2,7 +2,7 @@
 
 ## phasmerge    : Collapses library specific results to genome-level, generates a summary, 
 ##                matches with known annotations and compares PHAS summaries 
-## updated      : version-1.27 04/04/17
+## updated      : version-1.28 18/10/26
 ## author       : kakrana@udel.edu, atulkakrana@gmail.com
 
 ## Copyright (c): 2016, by University of Delaware
@@ -15,6 +15,7 @@ import operator,datetime,subprocess,multiprocessing,re,getpass
 from multiprocessing import Process, Queue, Pool
 from operator import itemgetter
 from itertools import groupby
+from phastpk import tagPackLoad,tagPackCount
 
 ########### PHASER DEVELOPER SETTINGS ########
 
@@ -82,6 +83,9 @@ reqflags.add_argument('-dir',  default='None', type=str, help='directory from yo
 
 mergeflags.add_argument('-pval',  default='', type=str, help='pvalue cutoff to'\
     ' filter the phased siRNAs loci or transcipts. [Optional]', required=False)
+mergeflags.add_argument('-phase',  default='', type=str, help='phase length to'\
+    ' summarize, if phasdetect was run for more than one phase (@phase = 21,24).'\
+    ' Each phase is merged in a separate run. [Optional]', required=False)
 mergeflags.add_argument('-gtf',  default='', type=str, help='GTF file from genome'\
     ' annotation or transcriptome mapped to genome. GTF file must be formatted using'\
     ' gffread (cufflinks) utility [Optional]. To convert your GFF or GTF file to '\
@@ -98,6 +102,9 @@ compflags.add_argument('-dir2',  default='None', type=str, help='another directo
 
 args = parser.parse_args()
 
+if args.phase: ## Each phase in its own folder, so that runs for different phases do not overwrite
+    res_folder  = "summary_%snt_%s" % (args.phase,datetime.datetime.now().strftime("%m_%d_%H_%M"))
+
 #### CHECKS 
 if args.mode != "merge" and args.mode != "compare":
     print("Unknown value %s for '-mode' supplied" % (args.mode))
@@ -260,13 +267,26 @@ def readSet(setFile):
 
                 elif param.strip() == '@phase':
                     global phase
-                    phase = int(value.strip())
+                    phases = [int(x) for x in value.strip().split(',') if x.strip() != '' ] ## phasdetect can score more than one phase in a run
+                    if args.phase:
+                        phase = int(args.phase)
+                        if phase not in phases:
+                            print("Phase %s specified by '-phase' was not analyzed by phasdetect - '@phase' is %s" % (phase,value.strip()))
+                            print("Script will exit for now\n")
+                            sys.exit()
+                    elif len(phases) == 1:
+                        phase = phases[0]
+                    else:
+                        print("phasdetect was run for more than one phase: %s" % (value.strip()))
+                        print("Please specify the phase to summarize with '-phase' parameter, like: -phase %s" % (phases[0]))
+                        print("Script will exit for now\n")
+                        sys.exit()
                     print('User Input for phase length      :',phase)
                 
                 elif param.strip() == '@libFormat':
                     global libFormat
                     libFormat = str(value.strip())
-                    if (libFormat != "T") and (libFormat != "F"):
+                    if (libFormat != "T") and (libFormat != "F") and (libFormat != "Q"):
                         print("Please input correct setting for '@libFormat' parameter in 'phasis.set' file")
                         print("Script will exit for now\n")
                         sys.exit()
@@ -442,7 +462,7 @@ def prepare(pcutoff,libs,res_folder):
 
     ### Concatanate these files #######################
     ###################################################
-    aname       = "%s/ALL.%sPHAS_p%s_srna.cluster" % (res_folder,aphase,pcutoff) ### Out file name
+    aname       = "%s/ALL.%sPHAS_p%s_srna.cluster" % (res_folder,phase,pcutoff) ### Out file name
     clustfile   = FileCombine(combL,aname)
 
     ### Sanity Check ##################################
@@ -743,16 +763,16 @@ def listConverter(afile,pcutoff):
     for i in entries:
         if i.strip(): ## Remove an empty line from end file
             ent_splt         = i.strip('\n').split('=')
-            pval,phase,trash = ent_splt[0].strip().split('|')
+            pval,aphase,trash = ent_splt[0].strip().split('|')
             chromo_start,end = ent_splt[1].strip().split('..')
             chromo,sep,start = chromo_start.rpartition(':')
-            if float(pval) <= float(pcutoff):
+            if float(pval) <= float(pcutoff) and str(aphase) == str(phase): ## List has all the phases scored by phasdetect
                 if runType      == 'G':
-                    fh_out.write('%s\t%s\t%s\t%s\t%s\tNONE\tNONE\n' % (phase,pval,chromo.strip(),start,end)) ##Chromosome has space before it which later gives error while key matching
-                    alist.append((phase,pval,chromo.strip(),start,end))
+                    fh_out.write('%s\t%s\t%s\t%s\t%s\tNONE\tNONE\n' % (aphase,pval,chromo.strip(),start,end)) ##Chromosome has space before it which later gives error while key matching
+                    alist.append((aphase,pval,chromo.strip(),start,end))
                 elif runType    == 'T' or runType == 'S': ## Header has lots of stuff
-                    fh_out.write('%s\t%s\t%s\t%s\t%s\tNONE\tNONE\n' % (phase,pval,chromo.strip(),start,end)) ##Chromosome has space before it which later gives error while key matching
-                    alist.append((phase,pval,chromo.strip(),start,end))
+                    fh_out.write('%s\t%s\t%s\t%s\t%s\tNONE\tNONE\n' % (aphase,pval,chromo.strip(),start,end)) ##Chromosome has space before it which later gives error while key matching
+                    alist.append((aphase,pval,chromo.strip(),start,end))
                 else:
                     pass
     print("%s elements in PHAS list from %s file" % (len(alist),afile))
@@ -1628,6 +1648,14 @@ def readFileToDict(index):
     """
 
     filename = libs[index]
+
+    ### Packed library from 'phasdetect --pack' is memory-mapped when queried, not cached
+    srcFile  = filename if libFormat == "T" else "%s.fas" % filename.rpartition(".")[0]
+    packFile = "%s.tpk" % filename.rpartition(".")[0]
+    if os.path.isfile(packFile) and os.path.isfile(srcFile) and os.path.getmtime(packFile) >= os.path.getmtime(srcFile):
+        print("Using packed %s to fetch phasiRNA abundances" % (packFile))
+        return({index: packFile})
+
     print("Caching %s to fetch phasiRNA abundances" % (filename))
 
     # Initialize an empty dictionary for the results
@@ -1653,7 +1681,7 @@ def readFileToDict(index):
 
         fh_in.close()
 
-    elif libFormat == "F":
+    elif libFormat == "F" or libFormat == "Q": ## FASTQ is de-duplicated to FASTA by phasdetect
         
         ### Read files
         filename    = "%s.fas" % filename.rpartition(".")[0] 
@@ -1673,7 +1701,8 @@ def readFileToDict(index):
         fh_in.close()
 
     else:
-        ## @libFormat not accepted
+        ## @libFormat not accepted - checked by readSet already
+        print("** '@libFormat' %s is not accepted for %s" % (libFormat,filename))
         sys.exit()
 
     return(fileDict)
@@ -1695,6 +1724,10 @@ def getAbunFromDict(dict, tag):
     # Pull the library index from the dictionary
     index = list(dict.keys())[0]
 
+    # Packed library, searched in memory-mapped file
+    if isinstance(dict[index], str):
+        return([index, tagPackCount(tagPackLoad(dict[index]), tag)])
+
     # Try to abundance of tag. If it doesn't exist in this library,
     # return 0 for the abundance
     try:
@@ -1707,7 +1740,13 @@ def getAbunFromDict(dict, tag):
 def PPResults(module,alist):
     npool   = Pool(int(nproc))
     res     = npool.map_async(module, alist)
-    results = (res.get())
+    try:
+        results = (res.get())
+    except Exception as err:
+        npool.terminate()
+        print("** %s failed: %s" % (module.__name__,err))
+        print("** Script will exit for now\n")
+        sys.exit()
     npool.close()
 
     return results
@@ -2848,6 +2887,13 @@ if __name__ == '__main__':
 ## v1.26 -> v1.27 [stable]
 ## Renamed to PHASIS
 
+## v1.27 -> v1.28
+## Added '-phase' to summarize one phase from a phasdetect run with more than one phase (@phase = 21,24)
+## PHAS list entries are filtered by phase, as library list has all the phases scored by phasdetect
+## Combined cluster file is named by selected phase, and not by phase of last cluster file read
+## '@libFormat' accepts Q (FASTQ) like phasdetect
+## Packed libraries (.tpk from 'phasdetect --pack') are memory-mapped and binary searched for abundances by phastpk module, instead of caching tag count text
+
 ########################################
 ## PUBLIC RELEASE
 ## Turn OFF debug mode
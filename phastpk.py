@@ -0,0 +1,174 @@
+## phastpk      : packed 2-bit tag count library (.tpk, PHASTPK1) - written and read by phasdetect,
+##                memory-mapped by phasmerge to fetch phasiRNA abundances
+## Updated      : version-v1.00 18/10/26
+## author       : kakrana@udel.edu
+
+## Copyright (c): 2016, by University of Delaware
+##              Contributor : Atul Kakrana
+##              Affilation  : Meyers Lab (Donald Danforth Plant Science Center, St. Louis, MO)
+##              License copy: Included and found at https://opensource.org/licenses/Artistic-2.0
+
+import os,sys,struct,array,mmap
+
+packCache       = {}                                ## Memory-mapped packed libraries - file:columns
+tagPackBases    = ["".join("ACGT"[(i >> ashift) & 3] for ashift in (6,4,2,0)) for i in range(256)] ## Byte to 4 bases
+
+#### FUNCTIONS ###########################################
+
+def tagPack(alib):
+    '''
+    Packs tag count (.txt) or de-duplicated FASTA (.fas) library to .tpk - little-endian,
+    sections start at 8-byte boundary:
+      header  - magic 'PHASTPK1', tags, total reads, packed bytes (u64) and source format
+      columns - length (u16, top bit set if stored as text - tags with other than ACGT),
+                count (u32), offset to packed bytes (u32 x tags+1), and tag indexes in
+                sequence order (u32) for binary search
+      packed  - tags in file order, 4 bases a byte (A:0 C:1 G:2 T:3, first base in high bits)
+    '''
+    print ("\n#### Fn: Tag packer #########################")
+    if not os.path.isfile(alib):
+        print("** %s - library not found" % (alib))
+        sys.exit()
+
+    packFile    = "%s.tpk" % (alib.rpartition('.')[0])
+    aformat     = b"F" if alib.endswith((".fas",".fa",".fasta")) else b"T"
+    tobase4     = bytes.maketrans(b"ACGT",b"0123")
+    lens        = array.array('H')
+    counts      = array.array('I')
+    offs        = array.array('I',[0])
+    packed      = bytearray()
+    seqL        = []
+    total       = 0
+
+    fh_in       = open(alib,'rb',buffering=1048576)
+    if aformat == b"F":
+        arecs   = ((ahead.rstrip(b"\n").rpartition(b"|")[2],aseq.rstrip(b"\n")) for ahead,aseq in zip(fh_in,fh_in))
+    else:
+        arecs   = (line.rstrip(b"\n").split(b"\t")[::-1] for line in fh_in if line.strip())
+    for acount,aseq in arecs:
+        aseq    = aseq.strip()
+        alen    = len(aseq)
+        if alen > 32767:
+            print("** %s has a tag longer than 32767nt, it can't be packed" % (alib))
+            sys.exit()
+        if alen and not aseq.strip(b"ACGT"):
+            nbytes  = (alen+3)//4
+            packed.extend(int(aseq.translate(tobase4)+b"0"*(nbytes*4-alen),4).to_bytes(nbytes,'big'))
+            lens.append(alen)
+        else: ## Kept as text
+            packed.extend(aseq)
+            lens.append(alen | 32768)
+        counts.append(int(acount))
+        if len(packed) > 4294967295:
+            print("** %s is too big to pack, packed tags exceed 4GB" % (alib))
+            sys.exit()
+        offs.append(len(packed))
+        seqL.append(aseq)
+        total  += int(acount)
+    fh_in.close()
+
+    order       = array.array('I',sorted(range(len(seqL)),key=seqL.__getitem__))
+    sectionL    = [lens,counts,offs,order]
+    if sys.byteorder != "little":
+        for asection in sectionL:
+            asection.byteswap()
+
+    tmpFile     = "%s.tmp" % (packFile)
+    fh_out      = open(tmpFile,'wb')
+    fh_out.write(b"PHASTPK1")
+    fh_out.write(struct.pack("<QQQ8s",len(seqL),total,len(packed),aformat))
+    for asection in sectionL:
+        fh_out.write(asection.tobytes())
+        fh_out.write(b"\0"*(-fh_out.tell()%8))
+    fh_out.write(packed)
+    fh_out.close()
+    os.replace(tmpFile,packFile)
+    packCache.pop(packFile,None) ## Columns of earlier file are stale
+    print("%s packed to %s | Tags: %s | Reads: %s | %s -> %s bytes" % (alib,packFile,len(seqL),total,
+        os.path.getsize(alib),os.path.getsize(packFile)))
+
+    return packFile
+
+def tagPackLoad(packFile):
+    '''
+    Memory-maps packed library once per process, columns are zero-copy views of the file
+    '''
+    if packFile in packCache:
+        return packCache[packFile]
+
+    fh_in       = open(packFile,'rb')
+    amap        = mmap.mmap(fh_in.fileno(),0,access=mmap.ACCESS_READ)
+    fh_in.close()
+    if amap[:8] != b"PHASTPK1":
+        print("** %s is not a packed library" % (packFile))
+        sys.exit()
+    ntags,total,nbytes,aformat = struct.unpack_from("<QQQ8s",amap,8)
+
+    aview       = memoryview(amap)
+    apos        = 40
+    packD       = {"tags":ntags,"total":total,"format":aformat.rstrip(b"\0").decode()}
+    for aname,atype,alen in (("len",'H',ntags),("count",'I',ntags),("off",'I',ntags+1),("order",'I',ntags)):
+        asize   = alen*struct.calcsize(atype)
+        packD[aname] = aview[apos:apos+asize].cast(atype)
+        apos   += asize+(-asize%8)
+    packD["packed"] = aview[apos:apos+nbytes]
+    packCache[packFile] = packD
+
+    return packD
+
+def tagPackSeq(packD,i):
+    '''
+    Sequence of i-th tag of packed library
+    '''
+    alen        = packD["len"][i]
+    achunk      = bytes(packD["packed"][packD["off"][i]:packD["off"][i+1]])
+    if alen & 32768:
+        return achunk.decode()
+
+    return "".join(tagPackBases[abyte] for abyte in achunk)[:alen]
+
+def tagPackCount(packD,aseq):
+    '''
+    Count of a tag in packed library by binary search, 0 if absent
+    '''
+    lo,hi       = 0,packD["tags"]
+    order       = packD["order"]
+    while lo < hi:
+        mid     = (lo+hi)//2
+        mseq    = tagPackSeq(packD,order[mid])
+        if mseq < aseq:
+            lo  = mid+1
+        elif mseq > aseq:
+            hi  = mid
+        else:
+            return packD["count"][order[mid]]
+
+    return 0
+
+def tagUnpack(packFile):
+    '''
+    Writes packed library back to the format it was packed from, in same tag order
+    '''
+    print ("\n#### Fn: Tag unpacker #######################")
+    if not os.path.isfile(packFile):
+        print("** %s - packed library not found" % (packFile))
+        sys.exit()
+    packD       = tagPackLoad(packFile)
+    outFile     = "%s.%s" % (packFile.rpartition('.')[0],"fas" if packD["format"] == "F" else "txt")
+    if os.path.exists(outFile):
+        print("** %s exists, it is not overwritten - move it to unpack %s" % (outFile,packFile))
+        return None
+
+    fh_out      = open(outFile,'w',buffering=1048576)
+    for i in range(packD["tags"]):
+        if packD["format"] == "F":
+            fh_out.write(">seq_%s|%s\n%s\n" % (i+1,packD["count"][i],tagPackSeq(packD,i)))
+        else:
+            fh_out.write("%s\t%s\n" % (tagPackSeq(packD,i),packD["count"][i]))
+    fh_out.close()
+    print("%s unpacked to %s | Tags: %s | Reads: %s" % (packFile,outFile,packD["tags"],packD["total"]))
+
+    return outFile
+
+## v1.00
+## PHASTPK1 format in one module - packer/unpacker of phasdetect and memory-mapped lookups of phasmerge
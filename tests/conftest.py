@@ -0,0 +1,129 @@
+'''
+Shared fixtures - phasdetect and phasmerge parse their arguments at import, so these
+are loaded as modules with arguments of the test. Bowtie is replaced by a script that
+reports hits from a table, so results don't depend on an index
+'''
+
+import os,sys,random,subprocess,importlib.util
+import pytest
+
+PKG             = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,PKG) ## Modules next to scripts are imported, as when scripts are run
+
+def scriptLoad(ascript,argv=()):
+    '''
+    Loads a script of package as a module with given arguments. Module is registered in
+    sys.modules, so that pool workers find its functions
+    '''
+    aname       = ascript.rpartition('.')[0]
+    saved       = sys.argv
+    sys.argv    = [ascript]+list(argv)
+    try:
+        spec    = importlib.util.spec_from_file_location(aname,os.path.join(PKG,ascript))
+        amod    = importlib.util.module_from_spec(spec)
+        sys.modules[aname] = amod
+        spec.loader.exec_module(amod)
+    finally:
+        sys.argv = saved
+
+    return amod
+
+def perlReady():
+    '''
+    Checks that phasis-core scripts can run - perl with Parallel::ForkManager
+    '''
+    try:
+        return subprocess.call(["perl","-MParallel::ForkManager","-e1"],stderr=subprocess.DEVNULL) == 0
+    except OSError:
+        return False
+
+def phasedData(seed,targets,nloci=3):
+    '''
+    Synthetic sRNAs with hits - phased loci of 21 and 24-nt on both strands (2-nt overhang),
+    background sRNAs and multimappers. Returns hits table (seq:[(strand,target,offset)]) and
+    tag counts (seq:count)
+    '''
+    rnd         = random.Random(seed)
+    rseq        = lambda n: "".join(rnd.choice("ACGT") for i in range(n))
+    hitsD       = {}
+    for atarget in targets:
+        alen    = rnd.randint(3000,8000)
+        for i in range(nloci):
+            rl      = rnd.choice([21,21,24])
+            astart  = rnd.randint(1,alen-20*rl)
+            for j in range(rnd.randint(6,12)):
+                apos = astart+j*rl
+                if rnd.random() < 0.85:
+                    hitsD.setdefault(rseq(rnd.choice([rl,rl,rl,20,23])),[]).append(('+',atarget,apos-1))
+                if rnd.random() < 0.7:
+                    aseq = rseq(rnd.choice([rl,rl,24]))
+                    hitsD.setdefault(aseq,[]).append(('-',atarget,apos+rl-3-len(aseq)))
+        for i in range(rnd.randint(20,60)):
+            hitsD.setdefault(rseq(rnd.randint(20,24)),[]).append((rnd.choice('+-'),atarget,rnd.randint(0,alen-30)))
+    for aseq in rnd.sample(sorted(hitsD),len(hitsD)//10): ## Multimappers, some above ceiling
+        for i in range(rnd.randint(1,20)):
+            hitsD[aseq].append((rnd.choice('+-'),rnd.choice(targets),rnd.randint(0,2000)))
+    for i in range(20): ## Unmapped
+        hitsD.setdefault(rseq(21),[])
+
+    countD      = dict((aseq,rnd.choice([1,1,2,3,4,5,8,15,40,200])) for aseq in hitsD)
+
+    return hitsD,countD
+
+def tagsWrite(countD,afile):
+    '''
+    Writes tag count library
+    '''
+    fh_out      = open(afile,'w')
+    for aseq,acount in countD.items():
+        fh_out.write("%s\t%s\n" % (aseq,acount))
+    fh_out.close()
+
+    return afile
+
+FAKEBOWTIE      = '''#!%s
+## Bowtie v1 stand-in - reports hits of reads from table, same columns as bowtie
+import sys
+argL = sys.argv[1:]
+mhits = int(argL[argL.index('-m')+1]) if '-m' in argL else int(argL[argL.index('-k')+1]) if '-k' in argL else 10**9
+hitsD = {}
+for line in open(%r):
+    aseq,_,ahits = line.rstrip('\\n').partition('\\t')
+    hitsD[aseq] = [x.split(',') for x in ahits.split(';')] if ahits else []
+comp = str.maketrans('ACGT','TGCA')
+fh_in = sys.stdin if argL[-1] == '-' else open(argL[-1])
+name = None
+for line in fh_in:
+    line = line.rstrip('\\n')
+    if line.startswith('>'):
+        name = line[1:].split()[0]
+        continue
+    hitL = hitsD.get(line,[])
+    if '-m' in argL and len(hitL) > mhits:
+        continue
+    for astrand,atarget,apos in hitL[:mhits]:
+        aseq = line if astrand == '+' else line[::-1].translate(comp)
+        sys.stdout.write('%%s\\t%%s\\t%%s\\t%%s\\t%%s\\t%%s\\t0\\t\\n' %% (name,astrand,atarget,apos,aseq,'I'*len(aseq)))
+'''
+
+@pytest.fixture
+def fakeBowtie(tmp_path,monkeypatch):
+    '''
+    Puts bowtie stand-in first in PATH - call with hits table (seq:[(strand,target,offset)])
+    '''
+    binDir      = tmp_path/"bin"
+    binDir.mkdir()
+
+    def install(hitsD):
+        tableFile = tmp_path/"hits.tsv"
+        fh_out  = open(tableFile,'w')
+        for aseq,hitL in hitsD.items():
+            fh_out.write("%s\t%s\n" % (aseq,";".join("%s,%s,%s" % x for x in hitL)))
+        fh_out.close()
+        abowtie = binDir/"bowtie"
+        abowtie.write_text(FAKEBOWTIE % (sys.executable,str(tableFile)))
+        abowtie.chmod(0o755)
+        monkeypatch.setenv("PATH","%s%s%s" % (binDir,os.pathsep,os.environ["PATH"]))
+        return str(abowtie)
+
+    return install
@@ -0,0 +1,68 @@
+'''
+Alignment cache - phasis-core and numpy engine read cached alignments instead of running
+bowtie, results are same to the byte as from fresh alignments
+'''
+
+import os
+import pytest
+from conftest import scriptLoad,perlReady,phasedData,tagsWrite,PKG
+
+pytestmark      = pytest.mark.skipif(not perlReady(),reason="phasis-core needs perl with Parallel::ForkManager")
+
+def resRead(afolder):
+    '''
+    Result files of a folder with contents
+    '''
+    resD        = {}
+    for afile in sorted(os.listdir(afolder)):
+        fh_in   = open(os.path.join(afolder,afile),'rb')
+        resD[afile] = fh_in.read()
+        fh_in.close()
+
+    return resD
+
+@pytest.mark.parametrize("runType,targets",[
+    ('G',['1','2','10','11']),
+    ('T',['Tx%s.1' % (i) for i in range(1,13)]+['AT2G%05d.1' % (i) for i in range(3)])])
+def test_cache_core(tmp_path,monkeypatch,fakeBowtie,runType,targets):
+    '''
+    phasis-core caches alignments on first run, and on next run reads these from an
+    alignment file (-al) without bowtie. Numpy engine reads same cache entry
+    '''
+    monkeypatch.chdir(tmp_path)
+    pd          = scriptLoad("phasdetect.py",["--engine","numpy"])
+    hitsD,countD = phasedData(7,targets)
+    abowtie     = fakeBowtie(hitsD)
+    lib         = tagsWrite(countD,"lib1.txt")
+
+    pd.runType      = runType
+    pd.libFormat    = 'T'
+    pd.phase        = [21,24]
+    pd.minDepth     = 3
+    pd.phaster_path = PKG
+    pd.anc_folder   = str(tmp_path/"ancillary")
+    pd.align_cache  = str(tmp_path/"align_cache")
+    aninput     = (lib,runType,"index",'N',1,pd.noiseLimit,pd.hitsLimit,300)
+
+    def phaseRun(afolder,afunc):
+        pd.res_folder = afolder
+        os.mkdir(afolder)
+        afunc(aninput)
+        return resRead(afolder)
+
+    freshD      = phaseRun("fresh",pd.PHASBatch2)
+    assert not os.path.isdir(pd.align_cache)
+
+    pd.alignIndex = "index"
+    missD       = phaseRun("miss",pd.PHASBatch2)
+    assert [x for x in os.listdir(pd.align_cache) if x.endswith(".aln")]
+
+    os.remove(abowtie) ## Results from here on can only come from cache
+    hitD        = phaseRun("hit",pd.PHASBatch2)
+    numpyD      = phaseRun("numpy",pd.PHASBatchNP)
+
+    assert any(b"|" in freshD[x] for x in freshD if x.endswith(".list")), "no clusters called, fixture is too sparse"
+    for aname,resD in (("miss",missD),("hit",hitD),("numpy",numpyD)):
+        assert sorted(resD) == sorted(freshD), aname
+        for afile in freshD:
+            assert resD[afile] == freshD[afile], (aname,afile)
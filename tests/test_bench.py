@@ -0,0 +1,39 @@
+'''
+Benchmark script - phasdetect is loaded from same folder with numpy engine, and planted
+loci are counted against clusters of list file
+'''
+
+import os,sys,random
+from conftest import scriptLoad
+
+def test_bench_load(monkeypatch):
+    '''
+    phasdetect found next to phasbench, its arguments don't come from command line of phasbench
+    '''
+    monkeypatch.setattr(sys,"argv",["phasbench","--save"])
+    pb          = scriptLoad("phasbench.py",["--save"])
+    pd          = pb.phasLoad()
+    assert pb.args.save
+    assert pd.args.engine == "numpy"
+    assert sys.modules["phasdetect"] is pd
+    assert hasattr(pd,"libAlign") and not hasattr(pd,"phasBench")
+
+def test_bench_loci(tmp_path,monkeypatch):
+    '''
+    Loci that overlap a cluster of same phase are recovered, ones with cluster of other
+    phase or none are not
+    '''
+    monkeypatch.chdir(tmp_path)
+    pb          = scriptLoad("phasbench.py")
+    pb.bench_genome = 0.02
+    pb.bench_loci   = 4
+    chromD,lociL = pb.benchGenome(random.Random(3),"genome.fa")
+    assert len(lociL) == 8 and os.path.isfile("genome.fa")
+
+    fh_out      = open("lib1.list",'w')
+    for i,(achr,astart,aend,rl) in enumerate(lociL[:6]):
+        arl     = rl if i < 4 else 45-rl ## Last two have other phase
+        fh_out.write("%s|%s|lib1.txt = %s:%s..%s\n" % (i,arl,achr,astart+5,aend+40))
+    fh_out.close()
+
+    assert pb.benchLoci(lociL,"lib1.list") == 4
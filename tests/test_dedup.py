@@ -0,0 +1,63 @@
+'''
+De-duplication of FASTA libraries - tags spilled to disk under a small memory budget are
+merged to same counts file, in same order, as when all of these fit in memory
+'''
+
+import os,random,collections
+import pytest
+from conftest import scriptLoad
+
+def readsWrite(afile,seed,nreads=2000,ntags=600):
+    '''
+    FASTA library of reads drawn from a set of tags, with repeats. Returns tags with counts
+    in order of first occurence
+    '''
+    rnd         = random.Random(seed)
+    tagL        = ["".join(rnd.choice("ACGT") for i in range(rnd.randint(18,26))) for j in range(ntags)]
+    readL       = tagL+[rnd.choice(tagL) for i in range(nreads-ntags)]
+    rnd.shuffle(readL)
+    fh_out      = open(afile,'w')
+    for i,aseq in enumerate(readL):
+        fh_out.write(">read_%s\n%s\n" % (i,aseq))
+    fh_out.close()
+
+    return list(collections.Counter(readL).items())
+
+def dedupRun(pd,alib,abudget):
+    '''
+    Counts file of library with memory budget (GB), and its spilled runs
+    '''
+    pd.dedup_mem = abudget
+    countFile   = pd.dedup_process(alib)
+    fh_in       = open(countFile,'r')
+    acounts     = fh_in.read()
+    fh_in.close()
+    os.remove(countFile)
+
+    return acounts
+
+@pytest.mark.parametrize("abudget,minRuns",[
+    (20000/1024**3,2),      ## Few runs, single merge
+    (1/1024**3,257)])       ## Run for each tag, runs are merged in passes of 256
+def test_dedup_spill(tmp_path,monkeypatch,capsys,abudget,minRuns):
+    '''
+    Spilled and merged counts file is same to the byte as in-memory one, which has tags in
+    order of first occurence
+    '''
+    monkeypatch.chdir(tmp_path)
+    pd          = scriptLoad("phasdetect.py")
+    countL      = readsWrite("lib1.fa",11)
+    pd.libFormat = 'F'
+    pd.libs     = ["lib1.fa"]
+    pd.nproc    = 1
+
+    inmem       = dedupRun(pd,"lib1.fa",8)
+    assert "Spilled runs: 0" in capsys.readouterr().out
+    assert inmem == "".join(">seq_%s|%s\n%s\n" % (i+1,acount,aseq) for i,(aseq,acount) in enumerate(countL))
+
+    spilled     = dedupRun(pd,"lib1.fa",abudget)
+    aout        = capsys.readouterr().out
+    nruns       = int(aout.split("Spilled runs: ")[1].split()[0])
+    assert nruns >= minRuns
+    assert spilled == inmem
+    assert not os.path.exists("lib1.dedup")
@@ -0,0 +1,50 @@
+'''
+Numpy engine against phasis-core - both score same alignments, results must be same to
+the byte
+'''
+
+import os
+import pytest
+from conftest import scriptLoad,perlReady,phasedData,tagsWrite,PKG
+
+pytestmark      = pytest.mark.skipif(not perlReady(),reason="phasis-core needs perl with Parallel::ForkManager")
+
+@pytest.mark.parametrize("runType,targets",[
+    ('G',['1','2','10','11']),
+    ('T',['Tx%s.1' % (i) for i in range(1,13)]+['AT2G%05d.1' % (i) for i in range(3)])])
+def test_engine_results(tmp_path,monkeypatch,fakeBowtie,runType,targets):
+    '''
+    .txt results, clusters and lists of numpy engine are same as of phasis-core
+    '''
+    monkeypatch.chdir(tmp_path)
+    pd          = scriptLoad("phasdetect.py",["--engine","numpy"])
+    hitsD,countD = phasedData(7,targets)
+    fakeBowtie(hitsD)
+    lib         = tagsWrite(countD,"lib1.txt")
+
+    pd.runType      = runType
+    pd.libFormat    = 'T'
+    pd.phase        = [21,24]
+    pd.minDepth     = 3
+    pd.phaster_path = PKG
+    pd.anc_folder   = str(tmp_path/"ancillary")
+    aninput     = (lib,runType,"index",'N',1,pd.noiseLimit,pd.hitsLimit,300)
+
+    resL        = []
+    for aengine,afunc in (("perl",pd.PHASBatch2),("numpy",pd.PHASBatchNP)):
+        pd.res_folder = aengine
+        os.mkdir(aengine)
+        afunc(aninput)
+        resD    = {}
+        for afile in sorted(os.listdir(aengine)):
+            fh_in = open(os.path.join(aengine,afile),'rb')
+            resD[afile] = fh_in.read()
+            fh_in.close()
+        resL.append(resD)
+
+    perlD,numpyD = resL
+    assert sorted(perlD) == sorted(numpyD)
+    assert any(x.endswith(".cluster") for x in perlD)
+    assert any(b"|" in perlD[x] for x in perlD if x.endswith(".list")), "no clusters called, fixture is too sparse"
+    for afile in perlD:
+        assert perlD[afile] == numpyD[afile], afile
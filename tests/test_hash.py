@@ -0,0 +1,57 @@
+'''
+File hashes and hash memory - an unchanged file re-uses its hash, a file changed in place
+is hashed again even if its size and mtime are same as before
+'''
+
+import os,time,hashlib
+from conftest import scriptLoad
+
+def md5(afile):
+    '''
+    MD5 of whole file
+    '''
+    fh_in       = open(afile,'rb')
+    ahash       = hashlib.md5(fh_in.read()).hexdigest()
+    fh_in.close()
+
+    return ahash
+
+def test_hash_reuse(tmp_path,monkeypatch,capsys):
+    '''
+    Second hash of unchanged file comes from hash memory
+    '''
+    monkeypatch.chdir(tmp_path)
+    pd          = scriptLoad("phasdetect.py")
+    pd.anc_folder = str(tmp_path/"ancillary")
+    afile       = tmp_path/"genome.fa"
+    afile.write_bytes(os.urandom(1024**2))
+
+    assert pd.fileHash(str(afile)) == md5(afile)
+    capsys.readouterr()
+    assert pd.fileHash(str(afile)) == md5(afile)
+    assert "hash re-used" in capsys.readouterr().out
+
+def test_hash_inplace(tmp_path,monkeypatch):
+    '''
+    Byte changed between sampled blocks, with size and mtime put back - file is hashed again
+    '''
+    monkeypatch.chdir(tmp_path)
+    pd          = scriptLoad("phasdetect.py")
+    pd.anc_folder = str(tmp_path/"ancillary")
+    afile       = tmp_path/"genome.fa"
+    afile.write_bytes(b"A"*1024**2)
+    before      = pd.fileHash(str(afile))
+    astat       = os.stat(afile)
+
+    time.sleep(0.01)
+    fh_out      = open(afile,'r+b')
+    fh_out.seek(200000) ## Not in a sampled block
+    fh_out.write(b"C")
+    fh_out.close()
+    os.utime(afile,ns=(astat.st_atime_ns,astat.st_mtime_ns))
+    assert os.stat(afile).st_size == astat.st_size
+    assert os.stat(afile).st_mtime_ns == astat.st_mtime_ns
+
+    after       = pd.fileHash(str(afile))
+    assert after == md5(afile)
+    assert after != before
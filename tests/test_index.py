@@ -0,0 +1,17 @@
+'''
+Index build settings - '--lowmem' is on by default and '--no-lowmem' turns it off
+'''
+
+from conftest import scriptLoad
+
+def test_index_lowmem():
+    '''
+    Default leaves bowtie-build on its automatic settings, '--no-lowmem' gives the fixed ones
+    '''
+    pd          = scriptLoad("phasdetect.py")
+    assert pd.args.lowmem
+    assert pd.indexParams() == []
+
+    pd          = scriptLoad("phasdetect.py",["--no-lowmem"])
+    assert not pd.args.lowmem
+    assert pd.indexParams() == ["--noauto","--dcv","256","--bmaxdivn","6"]
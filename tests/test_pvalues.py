@@ -0,0 +1,74 @@
+'''
+p-value tables against per-call hm_chen, over whole table range (n 0..22*rl, k 0..22) -
+in phasdetect, and in phasis-core scripts that read tables written by phasdetect
+'''
+
+import os,re,shutil,subprocess
+import pytest
+from conftest import scriptLoad,PKG
+
+RLS             = (21,22,24)
+
+PERLCHECK       = '''
+my $pval_dir = 0;
+my %%pval_table = ();
+%s
+%s
+my ($dir,$rl) = @ARGV;
+$pval_dir = $dir;
+die "p-value table of ${rl}nt not loaded\\n" unless (pval_table($rl));
+my ($checked,$differ) = (0,0);
+for my $n (0..22*$rl) {
+	for my $k (0..22) {
+		$pval_dir = 0;
+		my $pcall = hm_chen($n,$k,$rl);
+		$pval_dir = $dir;
+		my $plook = hm_chen($n,$k,$rl);
+		$differ++ unless ($pcall == $plook);
+		$checked++;
+	}
+}
+print "$checked $differ\\n";
+'''
+
+def perlSub(ascript,aname):
+    '''
+    Source of a sub from phasis-core script
+    '''
+    fh_in       = open(os.path.join(PKG,ascript),'r',newline='')
+    asource     = fh_in.read().replace("\r\n","\n")
+    fh_in.close()
+
+    return re.search(r"^sub %s \{.*?^\}\n" % (aname),asource,re.M|re.S).group(0)
+
+@pytest.mark.parametrize("rl",RLS)
+def test_table_percall(tmp_path,monkeypatch,rl):
+    '''
+    Table of phasdetect has same p-values as per-call evaluation, to the last bit
+    '''
+    monkeypatch.chdir(tmp_path)
+    pd          = scriptLoad("phasdetect.py")
+    ptable      = pd.pvalTable(rl)
+    assert len(ptable) == (22*rl+1)*23
+
+    differL     = [(n,k) for n in range(22*rl+1) for k in range(23) if pd.hm_chen(n,k,rl) != ptable[n*23+k]]
+    assert not differL
+
+@pytest.mark.skipif(not shutil.which("perl"),reason="phasis-core needs perl")
+@pytest.mark.parametrize("ascript",["phasclust.genome.v2.pl","phasclust.MUL.v2.pl"])
+@pytest.mark.parametrize("rl",RLS)
+def test_table_core(tmp_path,monkeypatch,ascript,rl):
+    '''
+    phasis-core looks up same p-values from table file of phasdetect as it computes per call
+    '''
+    monkeypatch.chdir(tmp_path)
+    pd          = scriptLoad("phasdetect.py")
+    pd.anc_folder = str(tmp_path/"ancillary")
+    pd.pvalPrepare([rl])
+
+    checkFile   = tmp_path/"check.pl"
+    checkFile.write_text(PERLCHECK % (perlSub(ascript,"hm_chen"),perlSub(ascript,"pval_table")))
+    aout        = subprocess.check_output(["perl",str(checkFile),pd.anc_folder,str(rl)]).decode()
+    checked,differ = [int(x) for x in aout.split()]
+    assert checked == (22*rl+1)*23
+    assert differ == 0
@@ -0,0 +1,124 @@
+'''
+Compressed and FASTQ libraries - tags read from bgzip, gzip and FASTQ files give same
+counts file as plain FASTA, and a bgzip block that fails its CRC check stops the run
+'''
+
+import os,gzip,random,struct,zlib
+import pytest
+from conftest import scriptLoad
+
+def readsMake(seed,nreads=3000):
+    '''
+    Reads drawn from a set of tags, with repeats
+    '''
+    rnd         = random.Random(seed)
+    tagL        = ["".join(rnd.choice("ACGT") for i in range(rnd.randint(18,26))) for j in range(700)]
+
+    return [rnd.choice(tagL) for i in range(nreads)]
+
+def fastaText(readL):
+    '''
+    Reads as FASTA
+    '''
+    return "".join(">read_%s\n%s\n" % (i,aseq) for i,aseq in enumerate(readL)).encode()
+
+def fastqText(readL):
+    '''
+    Reads as FASTQ
+    '''
+    return "".join("@read_%s\n%s\n+\n%s\n" % (i,aseq,"I"*len(aseq)) for i,aseq in enumerate(readL)).encode()
+
+def bgzfWrite(afile,adata,blockSize=4096,badBlock=None):
+    '''
+    Writes data as BGZF blocks, lines run across blocks. CRC of badBlock is broken
+    '''
+    fh_out      = open(afile,'wb')
+    chunkL      = [adata[i:i+blockSize] for i in range(0,len(adata),blockSize)]+[b''] ## Last is EOF block
+    for i,achunk in enumerate(chunkL):
+        acomp   = zlib.compressobj(6,zlib.DEFLATED,-15)
+        cdata   = acomp.compress(achunk)+acomp.flush()
+        acrc    = zlib.crc32(achunk) ^ (1 if i == badBlock else 0)
+        fh_out.write(struct.pack('<4BIBBH2BHH',0x1f,0x8b,8,4,0,0,255,6,66,67,2,len(cdata)+25))
+        fh_out.write(cdata)
+        fh_out.write(struct.pack('<II',acrc,len(achunk)))
+    fh_out.close()
+
+    return afile
+
+def gzipWrite(afile,adata):
+    '''
+    Writes data as a single gzip member
+    '''
+    fh_out      = gzip.open(afile,'wb')
+    fh_out.write(adata)
+    fh_out.close()
+
+    return afile
+
+def plainWrite(afile,adata):
+    '''
+    Writes data uncompressed
+    '''
+    fh_out      = open(afile,'wb')
+    fh_out.write(adata)
+    fh_out.close()
+
+    return afile
+
+def dedupRun(pd,alib,libFormat):
+    '''
+    Counts file of library
+    '''
+    pd.libFormat = libFormat
+    pd.libs     = [alib]
+    countFile   = pd.dedup_process(alib)
+    fh_in       = open(countFile,'r')
+    acounts     = fh_in.read()
+    fh_in.close()
+    os.remove(countFile)
+
+    return acounts
+
+@pytest.fixture
+def pd(tmp_path,monkeypatch):
+    '''
+    phasdetect loaded in test folder
+    '''
+    monkeypatch.chdir(tmp_path)
+    pd          = scriptLoad("phasdetect.py")
+    pd.nproc    = 2 ## Blocks are inflated in two threads
+
+    return pd
+
+@pytest.mark.parametrize("libFormat,atext",[('F',fastaText),('Q',fastqText)])
+@pytest.mark.parametrize("acompress",["bgzip","gzip","gzip-module","plain"])
+def test_reader_formats(pd,monkeypatch,libFormat,atext,acompress):
+    '''
+    FASTA and FASTQ, plain or compressed, are counted same as plain FASTA. gzip-module is
+    gzip file read without pigz/gzip in PATH
+    '''
+    readL       = readsMake(5)
+    expected    = dedupRun(pd,plainWrite("ref.fa",fastaText(readL)),'F')
+
+    if acompress == "bgzip":
+        alib    = bgzfWrite("lib1.gz",atext(readL))
+    elif acompress == "plain":
+        alib    = plainWrite("lib1.txt",atext(readL))
+    else:
+        alib    = gzipWrite("lib1.gz",atext(readL))
+        if acompress == "gzip-module":
+            monkeypatch.setattr(pd.shutil,"which",lambda x: None)
+
+    assert dedupRun(pd,alib,libFormat) == expected
+
+def test_reader_crc(pd,capsys):
+    '''
+    Corrupt bgzip block - run stops with a message, no counts file is left
+    '''
+    readL       = readsMake(6)
+    alib        = bgzfWrite("lib1.gz",fastaText(readL),badBlock=3)
+
+    with pytest.raises(SystemExit):
+        dedupRun(pd,alib,'F')
+    assert "failed CRC check" in capsys.readouterr().out
+    assert not os.path.exists("lib1.fas")
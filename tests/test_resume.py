@@ -0,0 +1,122 @@
+'''
+Resume of runs - libraries without completion marker or with changed results are phased
+again and complete ones are skipped, a run with other settings can't be resumed
+'''
+
+import os
+import pytest
+from conftest import scriptLoad,phasedData,tagsWrite
+
+LIBS            = ["lib1.txt","lib2.txt","lib3.txt"]
+
+@pytest.fixture
+def resumeData(tmp_path,monkeypatch,fakeBowtie):
+    '''
+    Three libraries on own targets, in test folder with bowtie stand-in
+    '''
+    monkeypatch.chdir(tmp_path)
+    hitsD       = {}
+    for i,(alib,targets) in enumerate(zip(LIBS,[['1','2'],['9'],['10']])):
+        ahits,acounts = phasedData(7+i,targets)
+        hitsD.update(ahits)
+        tagsWrite(acounts,alib)
+    fakeBowtie(hitsD)
+
+    return tmp_path
+
+def runLoad(argv=(),minDepth=3):
+    '''
+    phasdetect with run settings, libraries are recorded as in main
+    '''
+    pd          = scriptLoad("phasdetect.py",["--engine","numpy"]+list(argv))
+    pd.runType      = 'G'
+    pd.libFormat    = 'T'
+    pd.phase        = [21,24]
+    pd.minDepth     = minDepth
+    pd.clustBuffer  = 300
+    pd.deg          = 'N'
+    pd.index        = "index"
+    pd.anc_folder   = os.path.abspath("ancillary")
+    pd.res_folder   = "res"
+    pd.runKey       = pd.runParams()
+    for alib in LIBS:
+        pd.libOrigin[pd.libPrefix(alib)] = (alib,pd.fileHash(alib))
+
+    return pd
+
+def libPhase(pd,alib):
+    '''
+    Phases a library as a run does, with marker written once it is done
+    '''
+    aninput     = (alib,'G',"index",'N',1,pd.noiseLimit,pd.hitsLimit,300)
+    assert pd.PHASLib(aninput) == (alib,True)
+
+def resRead():
+    '''
+    Files of results folder with contents
+    '''
+    resD        = {}
+    for afile in sorted(os.listdir("res")):
+        fh_in   = open(os.path.join("res",afile),'rb')
+        resD[afile] = fh_in.read()
+        fh_in.close()
+
+    return resD
+
+def test_resume_partial(resumeData):
+    '''
+    lib2 was stopped before its marker was written, and a result of lib3 changed since. Resume
+    skips lib1, phases lib2 and lib3 again, and results are same as of a complete run
+    '''
+    pd          = runLoad()
+    os.mkdir("res")
+    pd.manifestWrite(LIBS,dict((x,"pending") for x in LIBS),[])
+    for alib in LIBS:
+        libPhase(pd,alib)
+    completeD   = resRead()
+    assert [x for x in completeD if x.endswith(".done")] == ["%s.done" % (x) for x in LIBS]
+
+    os.remove("res/lib2.txt.done")
+    fh_out      = open("res/lib2.txt.cluster.boundary.without.PARE.validation.list",'w') ## Stopped while writing
+    fh_out.close()
+    alist       = "res/lib3.txt.cluster.boundary.without.PARE.validation.list"
+    fh_in       = open(alist,'rb')
+    adata       = fh_in.read()
+    fh_in.close()
+    fh_out      = open(alist,'wb') ## Same size, other content
+    fh_out.write(adata[::-1])
+    fh_out.close()
+    lib1M       = os.stat("res/lib1.txt.done").st_mtime_ns
+
+    pd          = runLoad(["--resume","res"])
+    pendL,keepL = pd.resumeCheck(LIBS)
+    assert pendL == ["lib2.txt","lib3.txt"]
+    assert not [x for x in os.listdir("res") if x.startswith(("lib2","lib3"))]
+    for alib in pendL:
+        libPhase(pd,alib)
+
+    assert resRead() == completeD
+    assert os.stat("res/lib1.txt.done").st_mtime_ns == lib1M
+    pendL,keepL = pd.resumeCheck(LIBS)
+    assert pendL == []
+
+def test_resume_settings(resumeData,capsys):
+    '''
+    Run with other minDepth is rejected and results are left as such, run with same settings
+    goes on
+    '''
+    pd          = runLoad()
+    os.mkdir("res")
+    pd.manifestWrite(LIBS,dict((x,"pending") for x in LIBS),[])
+    libPhase(pd,"lib1.txt")
+    beforeD     = resRead()
+
+    pd          = runLoad(["--resume","res"],minDepth=5)
+    with pytest.raises(SystemExit):
+        pd.resumeCheck(LIBS)
+    assert "Settings differ" in capsys.readouterr().out
+    assert resRead() == beforeD
+
+    pd          = runLoad(["--resume","res"])
+    pendL,keepL = pd.resumeCheck(LIBS)
+    assert pendL == ["lib2.txt","lib3.txt"]
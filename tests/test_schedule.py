@@ -0,0 +1,92 @@
+'''
+Scheduler of numpy engine - a library that fails is left without results, and rest of
+the libraries are phased and written
+'''
+
+import os,signal
+import pytest
+from conftest import scriptLoad,phasedData,tagsWrite,PKG
+
+LIST            = "lib1.txt.cluster.boundary.without.PARE.validation.list"
+
+def scheduleSetup(tmp_path,monkeypatch,fakeBowtie):
+    '''
+    Two libraries on own targets, lib2 has target '9' that lib1 doesn't
+    '''
+    monkeypatch.chdir(tmp_path)
+    pd          = scriptLoad("phasdetect.py",["--engine","numpy","--schedule"])
+    hits1,count1 = phasedData(7,['1','2'])
+    hits2,count2 = phasedData(8,['9'])
+    hitsD       = dict(hits1)
+    hitsD.update(hits2)
+    fakeBowtie(hitsD)
+    tagsWrite(count1,"lib1.txt")
+    tagsWrite(count2,"lib2.txt")
+
+    pd.runType      = 'G'
+    pd.libFormat    = 'T'
+    pd.phase        = [21,24]
+    pd.minDepth     = 3
+    pd.nproc        = 2
+    pd.nthread      = 1
+    pd.phaster_path = PKG
+    pd.anc_folder   = str(tmp_path/"ancillary")
+    pd.res_folder   = "res"
+    pd.runKey       = "test"
+    for lib in ("lib1.txt","lib2.txt","missing.txt"):
+        pd.libOrigin[pd.libPrefix(lib)] = (lib,"hash")
+    os.mkdir("res")
+
+    return pd
+
+def scheduleRun(pd,libs):
+    '''
+    Runs scheduler on libraries, a hung pool fails the test instead of blocking it
+    '''
+    rawInputs   = [(lib,'G',"index",'N',1,pd.noiseLimit,pd.hitsLimit,300) for lib in libs]
+    signal.signal(signal.SIGALRM,lambda *x: pytest.fail("scheduler hung"))
+    signal.alarm(120)
+    try:
+        pd.PHASSchedule(rawInputs)
+    finally:
+        signal.alarm(0)
+
+    resD        = {}
+    for afile in sorted(os.listdir("res")):
+        fh_in   = open(os.path.join("res",afile),'rb')
+        resD[afile] = fh_in.read()
+        fh_in.close()
+
+    return resD
+
+def test_schedule_missing(tmp_path,monkeypatch,fakeBowtie):
+    '''
+    A missing library fails in aligner pool, that doesn't hang and lib1 is written
+    '''
+    pd          = scheduleSetup(tmp_path,monkeypatch,fakeBowtie)
+    resD        = scheduleRun(pd,["missing.txt","lib1.txt"])
+    assert LIST in resD
+    assert "lib1.txt.done" in resD
+    assert not [x for x in resD if x.startswith("missing")]
+
+def test_schedule_score_error(tmp_path,monkeypatch,fakeBowtie):
+    '''
+    Scoring error in a unit of lib2 leaves lib2 without results and its units are removed,
+    lib1 is written same as when phased alone
+    '''
+    pd          = scheduleSetup(tmp_path,monkeypatch,fakeBowtie)
+    ascore      = pd.phasScore
+    def phasScore(achr,arecs,rl):
+        if str(achr) == '9':
+            raise ValueError("unit of lib2")
+        return ascore(achr,arecs,rl)
+    monkeypatch.setattr(pd,"phasScore",phasScore)
+
+    bothD       = scheduleRun(pd,["lib1.txt","lib2.txt"])
+    assert LIST in bothD
+    assert "lib1.txt.done" in bothD
+    assert not [x for x in bothD if x.startswith("lib2")]
+
+    os.rename("res","both")
+    os.mkdir("res")
+    assert scheduleRun(pd,["lib1.txt"]) == bothD
@@ -0,0 +1,76 @@
+'''
+Cores of phasing libraries - threads given to starting libraries fill the core budget when
+pool slots are full, and all of them are returned once libraries finish
+'''
+
+import multiprocessing
+import pytest
+from conftest import scriptLoad
+
+WORK            = [400,300,200,100,100,50]
+
+@pytest.fixture
+def pd():
+    '''
+    phasdetect with a core budget of 8
+    '''
+    pd          = scriptLoad("phasdetect.py")
+    pd.nproc    = 8
+
+    return pd
+
+@pytest.mark.parametrize("aconc",[1,2,3])
+def test_threads_budget(pd,aconc):
+    '''
+    Libraries start longest first as slots free up - threads of running libraries add up to
+    the budget while queue has libraries, and counters are back to 0 at the end
+    '''
+    amanager    = multiprocessing.Manager()
+    ashare      = pd.libShare(amanager,WORK)
+    runL        = [] ## (position,threads) of running libraries
+    for apos in range(len(WORK)):
+        if len(runL) == aconc: ## Longest running one finishes first
+            pd.libThreadsFree(ashare,runL.pop(0)[1])
+        runL.append((apos,pd.libThreads(ashare,apos,aconc)))
+        assert sum(x[1] for x in runL) <= 8
+        if len(runL) == aconc:
+            assert sum(x[1] for x in runL) == 8
+    for apos,athread in runL:
+        pd.libThreadsFree(ashare,athread)
+
+    assert ashare[1][:3] == [0,0,0]
+    assert ashare[1][3:] == [1]*len(WORK)
+    amanager.shutdown()
+
+def test_threads_dedup(pd):
+    '''
+    Cores of a library being de-duplicated are left to it, and are free once it is done
+    '''
+    amanager    = multiprocessing.Manager()
+    ashare      = pd.libShare(amanager,WORK)
+    pd.libThreadsDedup(ashare,3)
+    athread     = pd.libThreads(ashare,0,1)
+    assert athread == 5
+    pd.libThreadsFree(ashare,athread)
+    pd.libThreadsDedup(ashare,-3)
+    assert pd.libThreads(ashare,1,1) == 8
+    amanager.shutdown()
+
+def test_threads_workers(pd):
+    '''
+    Share is passed to pool workers as argument, threads taken and returned there are
+    seen by main and by other workers
+    '''
+    amanager    = multiprocessing.Manager()
+    ashare      = pd.libShare(amanager,WORK)
+    apool       = multiprocessing.Pool(2)
+    threadL     = [apool.apply_async(pd.libThreads,(ashare,apos,2)).get() for apos in (0,1)]
+    assert sum(threadL) == 8
+    assert ashare[1][:2] == [8,2]
+    for athread in threadL:
+        apool.apply_async(pd.libThreadsFree,(ashare,athread)).get()
+    apool.close()
+    apool.join()
+
+    assert ashare[1][:3] == [0,0,0]
+    amanager.shutdown()
@@ -0,0 +1,84 @@
+'''
+Packed tag count libraries - packing and unpacking gives back same file, and counts looked
+up in packed library by phasmerge are same as from the text library
+'''
+
+import os,random
+import pytest
+import phastpk
+from conftest import scriptLoad
+
+def tagsMake(seed,ntags=500):
+    '''
+    Tags of 18-34nt with counts, some with N that are kept as text
+    '''
+    rnd         = random.Random(seed)
+    tagD        = {}
+    while len(tagD) < ntags:
+        aseq    = "".join(rnd.choice("ACGT") for i in range(rnd.randint(18,34)))
+        if rnd.random() < 0.05:
+            aseq = aseq[:5]+"N"+aseq[6:]
+        tagD[aseq] = rnd.choice([1,1,2,5,40,70000])
+
+    return tagD
+
+def libWrite(tagD,afile):
+    '''
+    Writes tags as tag count (.txt) or de-duplicated FASTA (.fas) library
+    '''
+    fh_out      = open(afile,'w')
+    for i,(aseq,acount) in enumerate(tagD.items()):
+        if afile.endswith(".fas"):
+            fh_out.write(">seq_%s|%s\n%s\n" % (i+1,acount,aseq))
+        else:
+            fh_out.write("%s\t%s\n" % (aseq,acount))
+    fh_out.close()
+
+    fh_in       = open(afile,'rb')
+    adata       = fh_in.read()
+    fh_in.close()
+
+    return adata
+
+@pytest.mark.parametrize("alib",["lib1.txt","lib1.fas"])
+def test_tpk_roundtrip(tmp_path,monkeypatch,alib):
+    '''
+    Unpacked library is same to the byte, every tag is found with its count and others are 0
+    '''
+    monkeypatch.chdir(tmp_path)
+    tagD        = tagsMake(4)
+    adata       = libWrite(tagD,alib)
+    packFile    = phastpk.tagPack(alib)
+    os.rename(alib,"orig")
+
+    packD       = phastpk.tagPackLoad(packFile)
+    assert packD["tags"] == len(tagD)
+    assert packD["total"] == sum(tagD.values())
+    for aseq,acount in tagD.items():
+        assert phastpk.tagPackCount(packD,aseq) == acount
+    for aseq in ("A"*21,"ACGTN","T"*40):
+        assert phastpk.tagPackCount(packD,aseq) == 0
+
+    assert phastpk.tagUnpack(packFile) == alib
+    fh_in       = open(alib,'rb')
+    assert fh_in.read() == adata
+    fh_in.close()
+
+def test_tpk_merge(tmp_path,monkeypatch):
+    '''
+    phasmerge fetches abundances from packed library that is newer than text one, same as
+    from text
+    '''
+    monkeypatch.chdir(tmp_path)
+    pm          = scriptLoad("phasmerge.py",["-mode","merge","-dir","res"])
+    tagD        = tagsMake(5)
+    libWrite(tagD,"lib1.txt")
+    pm.libs     = ["lib1.txt"]
+    pm.libFormat = "T"
+    textD       = pm.readFileToDict(0)
+
+    phastpk.tagPack("lib1.txt")
+    packD       = pm.readFileToDict(0)
+    assert packD == {0:"lib1.tpk"}
+    for aseq in list(tagD)+["A"*21]:
+        assert pm.getAbunFromDict(packD,aseq) == pm.getAbunFromDict(textD,aseq)